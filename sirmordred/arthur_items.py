@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import pickletools
+import struct
+
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+# Opcodes pushing the value of their argument, and the constants
+VALUE_OPCODES = frozenset(['INT', 'BININT', 'BININT1', 'BININT2', 'LONG', 'LONG1', 'LONG4',
+                           'UNICODE', 'BINUNICODE', 'SHORT_BINUNICODE', 'BINUNICODE8',
+                           'FLOAT', 'BINFLOAT', 'BINBYTES', 'SHORT_BINBYTES', 'BINBYTES8'])
+CONST_OPCODES = {'NONE': None, 'NEWTRUE': True, 'NEWFALSE': False}
+MEMO_PUT_OPCODES = frozenset(['PUT', 'BINPUT', 'LONG_BINPUT', 'MEMOIZE'])
+MEMO_GET_OPCODES = frozenset(['GET', 'BINGET', 'LONG_BINGET'])
+# Opcodes adding the objects on top of the stack to the object below them
+UPDATE_OPCODES = frozenset(['SETITEM', 'SETITEMS', 'APPEND', 'APPENDS', 'ADDITEMS', 'BUILD'])
+
+
+def get_pickled_tag(payload, key='tag'):
+    """ Return the value of `key` in a pickled dict without unpickling it
+
+    The opcodes of the pickle are walked with pickletools keeping a light
+    version of the unpickler stack and memo, with the simple values
+    (strings, numbers) and placeholders for the rest of objects. The walk
+    stops once the value of `key` has been set in the top level dict, or
+    once it has been pushed in the items of the top level dict and it is
+    followed by the next key. So the items stored after it (i.e. the data)
+    are not read.
+
+    A pushed string can only be told apart from the first element of a
+    tuple when the items are set, so the dict is expected to be a JSON like
+    document, as the perceval items are, without tuples nor objects.
+
+    :returns: the value, or None if it is not a simple value or it can not be found
+    """
+    unknown = object()  # placeholder for the objects which are not simple values
+    mark = object()
+    top = object()  # the top level dict
+    stack = []
+    memo = {}
+    found = None  # stack index of the pushed value of key, until it is confirmed
+    in_top_items = False  # the value is pushed in the items of the top level dict
+
+    try:
+        for opcode, arg, _ in pickletools.genops(payload):
+            name = opcode.name
+            if name in MEMO_PUT_OPCODES:
+                memo[len(memo) if name == 'MEMOIZE' else arg] = stack[-1]
+                continue
+            if name in ('FRAME', 'PROTO'):
+                continue
+
+            before = opcode.stack_before
+            if pickletools.markobject in before:
+                start = len(stack) - 1 - stack[::-1].index(mark)
+            else:
+                start = len(stack) - len(before) + (1 if name in UPDATE_OPCODES else 0)
+
+            if name in VALUE_OPCODES:
+                value = arg
+            elif name in CONST_OPCODES:
+                value = CONST_OPCODES[name]
+            elif name in MEMO_GET_OPCODES:
+                value = memo.get(arg, unknown)
+            elif name in ('EMPTY_DICT', 'DICT') and start == 0 and not memo:
+                value = top
+            else:
+                value = unknown
+
+            if found is not None:
+                if start <= found:
+                    # the value is popped: set in a dict or added to a bigger object
+                    if name not in ('SETITEM', 'SETITEMS'):
+                        return None
+                    first_key = start + (1 if name == 'SETITEMS' else 0)
+                    if stack[start - 1] is top and (found - 1 - first_key) % 2 == 0:
+                        return stack[found] if stack[found] is not unknown else None
+                    found = None
+                elif stack[found] is not unknown:
+                    # a simple value is followed by the next key of the top level dict
+                    return stack[found] if in_top_items and isinstance(value, str) else None
+
+            del stack[start:]
+            if name in UPDATE_OPCODES:
+                continue
+            for item in opcode.stack_after:
+                stack.append(mark if item is pickletools.markobject else value)
+
+            if found is None and len(stack) > 2 and isinstance(stack[-2], str) and stack[-2] == key:
+                # items of the top level dict are pushed after its first mark
+                in_top_items = stack[0] is top and len(stack) > 3 and stack[1] is mark \
+                    and mark not in stack[2:] and len(stack) % 2 == 0
+                if in_top_items or (len(stack) == 3 and stack[0] is top):
+                    found = len(stack) - 1
+    except (IndexError, KeyError, ValueError) as ex:
+        logger.debug("Can not read the tag of a pickled item: %s", ex)
+
+    return None
+
+
+class ArthurItem():
+    """
+    Item collected from the arthur queue, kept pickled until it is consumed
+
+    Only the tag of the item is read when it is created. The item is fully
+    unpickled when it is loaded, unless the tag can not be read from the
+    pickle, in which case it is unpickled once and kept.
+    """
+
+    __slots__ = ('payload', 'tag', '_item')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self._item = None
+        self.tag = get_pickled_tag(payload)
+        if self.tag is None:
+            self._item = pickle.loads(payload)
+            self.tag = self._item['tag']
+
+    @property
+    def size(self):
+        return len(self.payload)
+
+    def load(self):
+        """ Return the unpickled item """
+
+        if self._item is not None:
+            return self._item
+        return pickle.loads(self.payload)
+
+
+class ArthurItemsSegment():
+    """
+    Append-only file with the pickled items of a tag spilled to disk
+
+    Each item is written as its length (4 bytes) followed by its pickled
+    payload. Items are read in order using a memory map of the file, and
+    the file is truncated once all of them have been read. If items keep
+    being appended while they are read, the pending items are moved to the
+    beginning of the file once more than half of it has been read, so the
+    file doesn't grow without limit.
+    """
+
+    LENGTH_FORMAT = '>I'
+    LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+    COMPACT_MIN_SIZE = 1024 * 1024  # min bytes read before compacting the file
+    COMPACT_CHUNK = 1024 * 1024  # bytes moved at once when compacting the file
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb+')
+        self.count = 0  # items pending to be read
+        self.size = 0  # bytes of the pending payloads
+        self._write_offset = 0
+        self._read_offset = 0
+        self._mmap = None
+
+    def append(self, payload):
+        self.file.seek(self._write_offset)
+        self.file.write(struct.pack(self.LENGTH_FORMAT, len(payload)))
+        self.file.write(payload)
+        self._write_offset += self.LENGTH_SIZE + len(payload)
+        self.count += 1
+        self.size += len(payload)
+
+    def pop(self):
+        """ Return the payload of the first pending item, None if there are no items """
+
+        if not self.count:
+            return None
+
+        if self._mmap is None or len(self._mmap) < self._write_offset:
+            # the file has grown since it was mapped
+            self.file.flush()
+            self.__unmap()
+            self._mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (length,) = struct.unpack_from(self.LENGTH_FORMAT, self._mmap, self._read_offset)
+        start = self._read_offset + self.LENGTH_SIZE
+        payload = self._mmap[start:start + length]
+        self._read_offset = start + length
+        self.count -= 1
+        self.size -= length
+
+        if not self.count:
+            # all the items have been read, the file space is reused
+            self.__unmap()
+            self.file.truncate(0)
+            self._write_offset = 0
+            self._read_offset = 0
+        elif self._read_offset >= self.COMPACT_MIN_SIZE and self._read_offset * 2 >= self._write_offset:
+            self.__compact()
+
+        return payload
+
+    def close(self):
+        self.__unmap()
+        self.file.close()
+        os.remove(self.path)
+
+    def __compact(self):
+        """ Move the pending items to the beginning of the file and truncate it """
+
+        pending = self._write_offset - self._read_offset
+        moved = 0
+        while moved < pending:
+            # the items are moved backwards, so they are read before being overwritten
+            start = self._read_offset + moved
+            chunk = self._mmap[start:start + min(self.COMPACT_CHUNK, pending - moved)]
+            self.file.seek(moved)
+            self.file.write(chunk)
+            moved += len(chunk)
+
+        self.file.flush()
+        self.__unmap()
+        self.file.truncate(pending)
+        self._write_offset = pending
+        self._read_offset = 0
+
+    def __unmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class ArthurItemsQueue():
+    """ Pending items of a tag, in memory and spilled to disk """
+
+    __slots__ = ('lock', 'items', 'size', 'segment', 'removed')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.items = []  # ArthurItem in memory
+        self.size = 0  # bytes of the pickled items in memory
+        self.segment = None  # ArthurItemsSegment with the items spilled to disk
+        self.removed = False  # the tag was removed, its items are dropped
+
+    @property
+    def count(self):
+        return len(self.items) + (self.segment.count if self.segment else 0)
+
+    @property
+    def total_size(self):
+        """ Size in bytes of the pickled items in memory and on disk """
+        return self.size + (self.segment.size if self.segment else 0)
+
+
+class ArthurItemsBuffer():
+    """
+    Buffer with the items collected from the arthur queue, by tag
+
+    The items are kept pickled until they are popped. The buffer keeps the
+    size of the items in it: the size of the pickled payload of an item is
+    added when it is appended and subtracted when it is popped, so the size
+    of the buffer is known in constant time.
+
+    If a spill directory is configured, the items appended once the memory
+    buffer reaches `max_memory` bytes are written to a segment file per tag,
+    so the memory used is bounded. Items are popped from memory first and
+    then from disk.
+
+    Each tag has its own queue and lock, so the tasks consuming different
+    tags don't block each other. The queue of a tag is bounded by
+    `max_tag_size` bytes, in memory and on disk, so a busy tag can't take
+    the buffer of the rest: the items of a full tag are not appended, and
+    they must be kept by the caller until the tag is consumed.
+
+    The items of a removed tag are dropped, until the tag is added again.
+    """
+
+    SEGMENT_SUFFIX = '.items'
+
+    def __init__(self, max_memory=None, spill_dir=None, max_tag_size=None):
+        self._tags_lock = Lock()  # to add and remove tags
+        self._queues = {}  # tag -> ArthurItemsQueue
+        self._removed_tags = set()  # tags removed, whose items are dropped
+        self._size_lock = Lock()
+        self._size = 0  # bytes of the pickled items in memory
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.max_tag_size = max_tag_size
+
+    def set_spill(self, max_memory, spill_dir):
+        """ Spill the items to disk in spill_dir when the buffer has more than max_memory bytes """
+
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def set_max_tag_size(self, max_tag_size):
+        """ Don't append the items of a tag when its queue has more than max_tag_size bytes """
+
+        self.max_tag_size = max_tag_size
+
+    @property
+    def size(self):
+        """ Size in bytes of the pickled items in memory """
+        return self._size
+
+    @property
+    def spilled_size(self):
+        """ Size in bytes of the pickled items spilled to disk """
+        return sum([queue.segment.size for queue in self.__get_queues() if queue.segment])
+
+    @property
+    def is_full(self):
+        """ True if the memory is full and the items can not be spilled to disk """
+        return not self.spill_dir and self.max_memory is not None and self._size > self.max_memory
+
+    def __contains__(self, tag):
+        return tag in self._queues
+
+    def __len__(self):
+        return sum([queue.count for queue in self.__get_queues()])
+
+    def keys(self):
+        with self._tags_lock:
+            return list(self._queues.keys())
+
+    def add_tag(self, tag):
+        """ Register a tag, so its items are kept in the buffer """
+
+        with self._tags_lock:
+            self._removed_tags.discard(tag)
+        self.__get_queue(tag, create=True)
+
+    def remove_tag(self, tag):
+        """ Remove a tag and its pending items from the buffer, its next items are dropped """
+
+        with self._tags_lock:
+            queue = self._queues.pop(tag, None)
+            self._removed_tags.add(tag)
+        if not queue:
+            return
+
+        with queue.lock:
+            queue.removed = True
+            self.__add_size(-queue.size)
+            queue.items = []
+            queue.size = 0
+            if queue.segment:
+                queue.segment.close()
+                queue.segment = None
+
+    def append(self, item):
+        """ Add an ArthurItem to the buffer
+
+        :returns: False if the queue of the tag is full and the item is not added
+        """
+        queue = self.__get_queue(item.tag, create=True)
+        if queue is None:
+            logger.debug("Dropping arthur item of removed tag %s", item.tag)
+            return True
+
+        with queue.lock:
+            if queue.removed:
+                # the tag was removed after getting its queue
+                logger.debug("Dropping arthur item of removed tag %s", item.tag)
+                return True
+            if self.max_tag_size is not None and queue.total_size + item.size > self.max_tag_size \
+                    and queue.count:
+                return False
+            if self.spill_dir and self.max_memory is not None and self._size + item.size > self.max_memory:
+                if not queue.segment:
+                    queue.segment = self.__create_segment(item.tag)
+                queue.segment.append(item.payload)
+            else:
+                queue.items.append(item)
+                queue.size += item.size
+                self.__add_size(item.size)
+
+        return True
+
+    def is_tag_full(self, tag):
+        """ True if the items of a tag are not appended until some of them are popped """
+
+        queue = self.__get_queue(tag)
+        return queue is not None and self.max_tag_size is not None and queue.total_size >= self.max_tag_size
+
+    def count(self, tag):
+        """ Number of pending items for a tag """
+
+        queue = self.__get_queue(tag)
+        return queue.count if queue else 0
+
+    def pop(self, tag):
+        """ Remove and return the next item of a tag unpickled, None if there are no items """
+
+        queue = self.__get_queue(tag)
+        if not queue:
+            return None
+
+        item = None
+        payload = None
+        with queue.lock:
+            if queue.items:
+                item = queue.items.pop()
+                queue.size -= item.size
+                self.__add_size(-item.size)
+            elif queue.segment:
+                payload = queue.segment.pop()
+
+        # the item is unpickled out of the lock
+        if item is not None:
+            return item.load()
+        return pickle.loads(payload) if payload is not None else None
+
+    def __add_size(self, size):
+        with self._size_lock:
+            self._size += size
+
+    def __get_queue(self, tag, create=False):
+        """ Return the queue of a tag, created if needed unless the tag was removed """
+
+        queue = self._queues.get(tag)
+        if queue is None and create:
+            with self._tags_lock:
+                if tag in self._removed_tags:
+                    return None
+                queue = self._queues.setdefault(tag, ArthurItemsQueue())
+        return queue
+
+    def __get_queues(self):
+        with self._tags_lock:
+            return list(self._queues.values())
+
+    def __create_segment(self, tag):
+        name = hashlib.sha1(tag.encode('utf-8')).hexdigest() + self.SEGMENT_SUFFIX
+        segment = ArthurItemsSegment(os.path.join(self.spill_dir, name))
+        logger.debug("Spilling arthur items of %s to %s", tag, segment.path)
+        return segment
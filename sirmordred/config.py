@@ -103,6 +103,18 @@ class Config():
                     "type": int,
                     "description": "Short delay between tasks (collect, enrich ...)"
                 },
+                "adaptive_update": {
+                    "optional": True,
+                    "default": False,
+                    "type": bool,
+                    "description": "Adapt the delay between tasks of each backend section to its new items"
+                },
+                "max_update_delay": {
+                    "optional": True,
+                    "default": 3600,
+                    "type": int,
+                    "description": "Max delay between tasks of a backend section without new items (adaptive_update)"
+                },
                 "update": {
                     "optional": False,
                     "default": False,
@@ -127,6 +139,18 @@ class Config():
                     "type": str,
                     "description": "Directory with the logs of sirmordred"
                 },
+                "http_keep_alive": {
+                    "optional": True,
+                    "default": True,
+                    "type": bool,
+                    "description": "Keep alive the HTTP connections to ES and Kibiter"
+                },
+                "http_pool_size": {
+                    "optional": True,
+                    "default": 10,
+                    "type": int,
+                    "description": "Max number of HTTP connections kept to each ES and Kibiter host"
+                },
                 "log_handler": {
                     "optional": True,
                     "default": "file",
@@ -174,6 +198,41 @@ class Config():
                     "default": None,
                     "type": int,
                     "description": "The maximum number of hours wrt the current date to retain the data"
+                },
+                "retention_requests_per_second": {
+                    "optional": True,
+                    "default": None,
+                    "type": int,
+                    "description": "Max requests per second of the ES tasks deleting the data out of retention "
+                                   "(None: unlimited)"
+                },
+                "retention_slices": {
+                    "optional": True,
+                    "default": None,
+                    "type": int,
+                    "description": "Slices of the ES tasks deleting the data out of retention (None: auto)"
+                },
+                "process_managers": {
+                    "optional": True,
+                    "default": False,
+                    "type": bool,
+                    "description": "Execute the tasks of each backend section in its own process "
+                                   "(not supported with arthur)"
+                },
+                "scheduler": {
+                    "optional": True,
+                    "default": "managers",
+                    "type": str,
+                    "values": ["managers", "dag"],
+                    "description": "Tasks scheduling: managers (a tasks manager per backend section) "
+                                   "or dag (a graph of tasks executed as soon as their inputs are ready, "
+                                   "without process_managers nor adaptive_update)"
+                },
+                "dag_max_workers": {
+                    "optional": True,
+                    "default": 8,
+                    "type": int,
+                    "description": "Max number of tasks executed at the same time by the dag scheduler"
                 }
             }
         }
@@ -195,7 +254,7 @@ class Config():
                     "optional": True,
                     "default": False,
                     "type": bool,
-                    "description": "Load the projects from Eclipse"
+                    "description": "Load the projects from Eclipse, ignored if projects_url is set"
                 }
             }
         }
@@ -279,11 +338,60 @@ class Config():
                     "type": str,
                     "description": "URL for the arthur service"
                 },
+                "arthur_task_delay": {
+                    "optional": True,
+                    "default": 60,
+                    "type": int,
+                    "description": "Seconds between the executions of the arthur tasks"
+                },
+                "arthur_max_memory_size": {
+                    "optional": True,
+                    "default": 200,
+                    "type": int,
+                    "description": "Max size in MB of the arthur items kept in memory"
+                },
+                "arthur_max_tag_size": {
+                    "optional": True,
+                    "default": 100,
+                    "type": int,
+                    "description": "Max size in MB of the pending arthur items of a repository, in memory "
+                                   "and on disk. The items of a full repository are kept in redis"
+                },
+                "arthur_redis_items": {
+                    "optional": True,
+                    "default": 1000,
+                    "type": int,
+                    "description": "Min number of arthur items read from redis in each batch"
+                },
+                "arthur_redis_batches": {
+                    "optional": True,
+                    "default": 10,
+                    "type": int,
+                    "description": "Max number of batches read from redis each time the arthur items are collected"
+                },
+                "arthur_spill_dir": {
+                    "optional": True,
+                    "default": None,
+                    "type": str,
+                    "description": "Directory to spill the arthur items to disk when the memory buffer is full"
+                },
                 "redis_url": {
                     "optional": True,
                     "default": None,
                     "type": str,
                     "description": "URL for the redis service"
+                },
+                "collection_workers": {
+                    "optional": True,
+                    "default": 1,
+                    "type": int,
+                    "description": "Number of repositories collected in parallel per backend section"
+                },
+                "collection_workers_per_host": {
+                    "optional": True,
+                    "default": 2,
+                    "type": int,
+                    "description": "Max number of repositories collected in parallel from the same host"
                 }
             }
         }
@@ -308,6 +416,25 @@ class Config():
                     "type": int,
                     "description": "Set time interval (days) for autorefresh identities"
                 },
+                "pooled_enrichment": {
+                    "optional": True,
+                    "default": False,
+                    "type": bool,
+                    "description": "Enrich the repositories in a pool of workers which reuse their backends"
+                },
+                "enrich_workers": {
+                    "optional": True,
+                    "default": 1,
+                    "type": int,
+                    "description": "Number of workers of the pooled enrichment per backend section"
+                },
+                "enrich_pool": {
+                    "optional": True,
+                    "default": "thread",
+                    "type": str,
+                    "values": ["thread", "process"],
+                    "description": "Kind of workers of the pooled enrichment: thread or process"
+                },
                 "user": {
                     "optional": True,
                     "default": None,
@@ -504,6 +631,18 @@ class Config():
                     "type": str,
                     "description": "Format of the identities data to be loaded"
                 },
+                "incremental_unify": {
+                    "optional": True,
+                    "default": False,
+                    "type": bool,
+                    "description": "Unify only the identities modified since the last unify"
+                },
+                "inprocess": {
+                    "optional": True,
+                    "default": False,
+                    "type": bool,
+                    "description": "Execute the SortingHat commands in process instead of with the sortinghat CLI"
+                },
                 "strict_mapping": {
                     "optional": True,
                     "default": True,
@@ -646,6 +785,8 @@ class Config():
             logger.error('Config section %s and param %s not exists', section, param)
         else:
             self.conf[section][param] = value
+            # The backends built with the old value must be built again
+            Task.invalidate_backends(None if section in Task.BACKENDS_CONF_SECTIONS else section)
 
     @classmethod
     def get_backend_sections(cls):
@@ -712,6 +853,11 @@ class Config():
                         msg = "Wrong type for section param: %s %s %s should be %s" % \
                               (section, param, ptype, ptype_ok)
                         raise RuntimeError(msg)
+                    pvalues = check_params[section][param].get("values")
+                    if pvalues and config[section][param] not in pvalues:
+                        msg = "Wrong value for section param: %s %s %s should be one of %s" % \
+                              (section, param, config[section][param], pvalues)
+                        raise RuntimeError(msg)
 
         # And now the backend_section entries
         # A backend section entry could have specific perceval params which are
@@ -731,6 +877,16 @@ class Config():
                                   (section, param, ptype, ptype_ok)
                             raise RuntimeError(msg)
 
+        # Options of the tasks managers not supported by the dag scheduler
+        if config['general']['scheduler'] == 'dag':
+            for param in ['process_managers', 'adaptive_update']:
+                if config['general'][param]:
+                    logger.warning("general.%s is ignored by the dag scheduler", param)
+        elif config['general']['process_managers'] and config['es_collection']['arthur']:
+            # The arthur items of all the backend sections are drained from a single
+            # redis queue into a buffer of the process draining it
+            raise RuntimeError("general.process_managers is not supported with es_collection.arthur")
+
     def __add_types(self, raw_conf):
         """ Convert to int, boolean, list, None types config items """
 
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import os
+
+from threading import Lock
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+
+logger = logging.getLogger(__name__)
+
+# Same retries policy used by grimoire_con(conn_retries=12): 30m retry
+BACKOFF_FACTOR = 0.2
+MAX_RETRIES = 21
+MAX_RETRIES_ON_CONNECT = 12
+MAX_RETRIES_ON_READ = 8
+MAX_RETRIES_ON_REDIRECT = 5
+STATUS_FORCE_LIST = [408, 409, 429, 502, 503, 504]
+
+# urllib3 < 1.26 only knows the deprecated name of allowed_methods
+if hasattr(urllib3.util.Retry, 'DEFAULT_ALLOWED_METHODS'):
+    ALLOWED_METHODS_ARG = 'allowed_methods'
+else:
+    ALLOWED_METHODS_ARG = 'method_whitelist'
+
+
+class CountingRetry(urllib3.util.Retry):
+    """ Retry policy counting the retries done by all the sessions """
+
+    retries_lock = Lock()
+    retries_count = 0
+
+    def increment(self, *args, **kwargs):
+        with self.retries_lock:
+            CountingRetry.retries_count += 1
+        return super().increment(*args, **kwargs)
+
+
+class HTTPSessions():
+    """
+    Registry with the HTTP sessions shared by all the tasks, by base URL
+
+    A base URL (scheme, host and port) always gets the same session, so the
+    connections to it are reused by all the tasks of the process.
+
+    The sessions belong to the process that created them: a forked process
+    (tasks managers and enrichment workers run as processes) drops the
+    inherited ones and opens its own connections, so the sockets are never
+    shared with the parent. The stats are those of the current process too.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sessions = {}  # base URL -> requests.Session
+        self.pid = os.getpid()
+        self.pool_size = 10
+        self.keep_alive = True
+
+    def reset_after_fork(self):
+        """ Drop the sessions and counters inherited from the parent process """
+
+        self.lock = Lock()
+        self.sessions = {}
+        self.pid = os.getpid()
+        CountingRetry.retries_lock = Lock()
+        CountingRetry.retries_count = 0
+
+    def configure(self, pool_size, keep_alive=True):
+        """ Set the pool size and keep-alive of the sessions created from now on """
+
+        with self.lock:
+            self.pool_size = pool_size
+            self.keep_alive = keep_alive
+
+    @staticmethod
+    def base_url(url):
+        parsed = urlparse(url)
+        return "%s://%s" % (parsed.scheme, parsed.netloc.split('@')[-1])
+
+    def get_session(self, url):
+        """ Return the session for the base URL of url """
+
+        base_url = self.base_url(url)
+        if self.pid != os.getpid():
+            self.reset_after_fork()
+        with self.lock:
+            if base_url not in self.sessions:
+                self.sessions[base_url] = self.__create_session()
+                logger.debug("HTTP session created for %s", base_url)
+            return self.sessions[base_url]
+
+    def __create_session(self):
+        session = requests.Session()
+        retries = CountingRetry(total=MAX_RETRIES, connect=MAX_RETRIES_ON_CONNECT, read=MAX_RETRIES_ON_READ,
+                                redirect=MAX_RETRIES_ON_REDIRECT, backoff_factor=BACKOFF_FACTOR,
+                                status_forcelist=STATUS_FORCE_LIST, **{ALLOWED_METHODS_ARG: False})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                                max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        session.verify = False
+
+        return session
+
+    def stats(self):
+        """ Return the requests, connections and retries done by the sessions
+
+        The requests done over an already open connection are the ones
+        reusing connections. Only the sessions of the current process are
+        counted, the ones of the forked processes are not aggregated.
+        """
+        requests_count = 0
+        connections_count = 0
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool:
+                        requests_count += pool.num_requests
+                        connections_count += pool.num_connections
+
+        return {
+            "sessions": len(sessions),
+            "requests": requests_count,
+            "connections": connections_count,
+            "reused": max(requests_count - connections_count, 0),
+            "retries": CountingRetry.retries_count
+        }
+
+
+HTTP_SESSIONS = HTTPSessions()  # sessions shared by the whole process
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=HTTP_SESSIONS.reset_after_fork)
+
+
+class SharedSession():
+    """ requests.Session like API sending each request with the shared session of its URL """
+
+    def __init__(self, sessions=HTTP_SESSIONS):
+        self.sessions = sessions
+
+    def request(self, method, url, **kwargs):
+        return self.sessions.get_session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import datetime
+import json
+import logging
+
+from threading import Lock
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+HEADER_JSON = {"Content-Type": "application/json"}
+
+
+class DataRetention():
+    """
+    Delete the items older than the retention horizon from the ES indexes
+
+    The items are deleted with delete by query tasks running in ES in the
+    background, so the caller doesn't wait for the deletion. Only one task
+    per index is submitted at a time: while the task of an index is running,
+    the retention of the index is skipped. Once completed, the result of the
+    task is deleted, so the results don't pile up in the .tasks index. The
+    index is also skipped when its oldest item is newer than the horizon,
+    which is checked with a min aggregation before submitting any task.
+    """
+
+    TIME_FIELD = "metadata__updated_on"
+
+    tasks_lock = Lock()
+    tasks = {}  # index URL -> (ES URL, id of the ES task deleting its items)
+
+    def __init__(self, es_con, slices=None, requests_per_second=None):
+        """
+        :param es_con: requests session to access ES
+        :param slices: slices of the delete by query tasks, auto if None
+        :param requests_per_second: max requests per second of the delete tasks, unlimited if None
+        """
+        self.es_con = es_con
+        self.slices = slices if slices else "auto"
+        self.requests_per_second = requests_per_second if requests_per_second else -1
+
+    def retain(self, hours_to_retain, es_url, index):
+        """ Submit the deletion of the items of index updated before hours_to_retain
+
+        :returns: id of the ES task deleting the items, None if no task was submitted
+        """
+
+        from .task import Task
+
+        if hours_to_retain is None:
+            logger.debug("[retention] Retention policy disabled, no items will be deleted.")
+            return None
+
+        if hours_to_retain <= 0:
+            logger.debug("[retention] Hours to retain must be greater than 0.")
+            return None
+
+        es_url = es_url.rstrip('/')
+        index_url = es_url + '/' + index
+
+        if self.is_running(index_url):
+            logger.debug("[retention] Items of %s are still being deleted", Task.anonymize_url(index_url))
+            return None
+
+        before_date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=hours_to_retain)
+        oldest_date = self.get_oldest_date(index_url)
+        if oldest_date is None or oldest_date > before_date:
+            logger.debug("[retention] No items to delete from %s before %s",
+                         Task.anonymize_url(index_url), before_date.isoformat())
+            return None
+
+        query = {
+            "query": {
+                "range": {
+                    self.TIME_FIELD: {
+                        "lte": before_date.isoformat()
+                    }
+                }
+            }
+        }
+        params = {
+            "wait_for_completion": "false",
+            "conflicts": "proceed",
+            "slices": self.slices,
+            "requests_per_second": self.requests_per_second
+        }
+        res = self.es_con.post(index_url + "/_delete_by_query", params=params,
+                               data=json.dumps(query), headers=HEADER_JSON)
+        try:
+            res.raise_for_status()
+        except requests.exceptions.HTTPError as ex:
+            logger.error("[retention] Error deleting items from %s: %s", Task.anonymize_url(index_url), ex)
+            return None
+
+        task_id = res.json()['task']
+        with self.tasks_lock:
+            self.tasks[index_url] = (es_url, task_id)
+
+        logger.info("[retention] Deleting items from %s before %s in task %s",
+                    Task.anonymize_url(index_url), before_date.isoformat(), task_id)
+
+        return task_id
+
+    def get_oldest_date(self, index_url):
+        """ Return the date of the oldest item in the index, None if there are no items """
+
+        query = {
+            "size": 0,
+            "aggs": {
+                "oldest": {
+                    "min": {
+                        "field": self.TIME_FIELD
+                    }
+                }
+            }
+        }
+        res = self.es_con.post(index_url + "/_search", data=json.dumps(query), headers=HEADER_JSON)
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+
+        oldest = res.json()['aggregations']['oldest']['value']
+        if oldest is None:
+            return None
+
+        # dates are returned as milliseconds since the epoch
+        return datetime.datetime.fromtimestamp(oldest / 1000, tz=datetime.timezone.utc)
+
+    def is_running(self, index_url):
+        """ Check if the deletion task of an index is running, forgetting it once completed """
+
+        from .task import Task
+
+        with self.tasks_lock:
+            if index_url not in self.tasks:
+                return False
+            es_url, task_id = self.tasks[index_url]
+
+        res = self.es_con.get(es_url + "/_tasks/" + task_id)
+        if res.status_code == 404:
+            # the task is unknown, i.e. ES was restarted
+            completed = True
+        else:
+            res.raise_for_status()
+            status = res.json()
+            completed = status.get('completed', False)
+            if completed:
+                deleted = status.get('response', {}).get('deleted')
+                logger.info("[retention] %s items deleted from %s in task %s",
+                            deleted, Task.anonymize_url(index_url), task_id)
+
+        if completed:
+            with self.tasks_lock:
+                self.tasks.pop(index_url, None)
+            self.delete_task_result(es_url, task_id)
+
+        return not completed
+
+    def delete_task_result(self, es_url, task_id):
+        """ Delete the result of a completed task, stored by ES in the .tasks index """
+
+        query = {
+            "query": {
+                "ids": {
+                    "values": [task_id]
+                }
+            }
+        }
+        try:
+            res = self.es_con.post(es_url + "/.tasks/_delete_by_query", params={"ignore_unavailable": "true"},
+                                   data=json.dumps(query), headers=HEADER_JSON)
+            res.raise_for_status()
+        except requests.exceptions.RequestException as ex:
+            logger.warning("[retention] Can not delete the result of task %s: %s", task_id, ex)
@@ -24,6 +24,7 @@
 
 import json
 import logging
+import multiprocessing
 import queue
 import sys
 import threading
@@ -41,18 +42,23 @@ warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 
 from arthur.common import Q_STORAGE_ITEMS
 
-from grimoire_elk.enriched.utils import grimoire_con
-
 from sirmordred.config import Config
 from sirmordred.error import DataCollectionError
 from sirmordred.error import DataEnrichmentError
+from sirmordred.http_sessions import HTTP_SESSIONS, SharedSession
 from sirmordred.task_collection import TaskRawDataCollection, TaskRawDataArthurCollection
 from sirmordred.task_enrich import TaskEnrich
 from sirmordred.task_identities import TaskIdentitiesExport, TaskIdentitiesLoad, TaskIdentitiesMerge, TaskInitSortingHat
-from sirmordred.task_manager import TasksManager
+from sirmordred.task_manager import (ProcessCommQueue,
+                                     ProcessPhaseGate,
+                                     ProcessProjectsUpdates,
+                                     ProcessTasksManager,
+                                     TasksManager,
+                                     TasksSpec)
 from sirmordred.task_panels import TaskPanels, TaskPanelsMenu
 from sirmordred.task_projects import TaskProjects
 from sirmordred.task_report import TaskReport
+from sirmordred.task_scheduler import TasksScheduler
 from sirmordred.task_track import TaskTrackItems
 
 logger = logging.getLogger(__name__)
@@ -64,7 +70,17 @@ class SirMordred:
         """ config is a Config object """
         self.config = config
         self.conf = config.get_conf()
-        self.grimoire_con = grimoire_con(conn_retries=12)  # 30m retry
+        HTTP_SESSIONS.configure(self.conf['general']['http_pool_size'],
+                                self.conf['general']['http_keep_alive'])
+        self.grimoire_con = SharedSession()
+        self.dag_tasks = {}  # tasks executed by the DAG scheduler, kept between cycles
+        self.last_dag_global_tasks = None  # last time global tasks were executed by the DAG scheduler
+
+    @staticmethod
+    def log_http_stats():
+        stats = HTTP_SESSIONS.stats()
+        logger.info("HTTP sessions: %i sessions, %i requests, %i connections (%i reused), %i retries",
+                    stats['sessions'], stats['requests'], stats['connections'], stats['reused'], stats['retries'])
 
     def check_redis_access(self):
         redis_access = False
@@ -158,29 +174,15 @@ class SirMordred:
         #
         # return dict with backend and list of repositories
         #
-        output = {}
-        projects = TaskProjects.get_projects()
-
-        for pro in projects:
-            # remove duplicates in backends_section with list(set(..))
-            backend_sections = list(set([sect for sect in projects[pro].keys()
-                                         for backend_section in Config.get_backend_sections()
-                                         if sect and sect.startswith(backend_section)]))
-
-            # sort backends section
-            backend_sections.sort()
-            for backend_section in backend_sections:
-                if backend_section not in output:
-                    output[backend_section] = projects[pro][backend_section]
-                else:
-                    output[backend_section] += projects[pro][backend_section]
+        backend_sections = Config.get_backend_sections()
+        sections_index = TaskProjects.get_sections_index()
 
         # backend could be in project/repo file but not enabled in
         # sirmordred conf file
         enabled = {}
-        for k in output:
-            if k in self.conf:
-                enabled[k] = output[k]
+        for section in sections_index:
+            if section in self.conf and any([section.startswith(bs) for bs in backend_sections]):
+                enabled[section] = list(sections_index[section]['all'])
 
         # logger.debug('repos to be retrieved: %s ', enabled)
         return enabled
@@ -197,9 +199,11 @@ class SirMordred:
         """
         self.execute_batch_tasks(tasks_cls,
                                  self.conf['sortinghat']['sleep_for'],
-                                 self.conf['general']['min_update_delay'], False)
+                                 self.conf['general']['min_update_delay'], False,
+                                 self.conf['general']['process_managers'])
 
-    def execute_batch_tasks(self, tasks_cls, big_delay=0, small_delay=0, wait_for_threads=True):
+    def execute_batch_tasks(self, tasks_cls, big_delay=0, small_delay=0, wait_for_threads=True,
+                            processes=False):
         """
         Start a task manager per backend to complete the tasks.
 
@@ -208,6 +212,8 @@ class SirMordred:
         :param small_delay: seconds before backend tasks are executed, should be minutes
         :param wait_for_threads: boolean to set when threads are infinite or
                                 should be synchronized in a meeting point
+        :param processes: boolean to run each task manager in its own process
+                          instead of in a thread
         """
 
         def _split_tasks(tasks_cls):
@@ -229,15 +235,38 @@ class SirMordred:
 
         threads = []
 
-        # stopper won't be set unless wait_for_threads is True
-        stopper = threading.Event()
+        if processes:
+            # stopper won't be set unless wait_for_threads is True
+            stopper = multiprocessing.Event()
+            comm_queue = ProcessCommQueue()
+            gate = ProcessPhaseGate()
+            projects = TaskProjects.get_projects()
+            projects_updates = ProcessProjectsUpdates()
+
+            def new_manager(tasks, backend_section, timer, max_timer=None):
+                spec = TasksSpec.from_tasks_cls(tasks, backend_section, timer, max_timer)
+                return ProcessTasksManager(spec, stopper, self.config, comm_queue, gate, projects,
+                                           projects_updates)
+        else:
+            # stopper won't be set unless wait_for_threads is True
+            stopper = threading.Event()
+            comm_queue = TasksManager.COMM_QUEUE
+            gate = TasksManager.IDENTITIES_GATE
+
+            def new_manager(tasks, backend_section, timer, max_timer=None):
+                return TasksManager(tasks, backend_section, stopper, self.config, timer, max_timer)
+
+        # the delay of each backend section is adapted to its new items
+        max_delay = None
+        if self.conf['general']['adaptive_update'] and not wait_for_threads:
+            max_delay = self.conf['general']['max_update_delay']
 
         # launching threads for tasks by backend
         if len(backend_tasks) > 0:
             repos_backend = self._get_repos_by_backend()
             for backend in repos_backend:
                 # Start new Threads and add them to the threads list to complete
-                t = TasksManager(backend_tasks, backend, stopper, self.config, small_delay)
+                t = new_manager(backend_tasks, backend, small_delay, max_delay)
                 threads.append(t)
                 t.start()
 
@@ -245,7 +274,7 @@ class SirMordred:
         if len(global_tasks) > 0:
             # FIXME timer is applied to all global_tasks, does it make sense?
             # All tasks are executed in the same thread sequentially
-            gt = TasksManager(global_tasks, "Global tasks", stopper, self.config, big_delay)
+            gt = new_manager(global_tasks, "Global tasks", big_delay)
             threads.append(gt)
             gt.start()
             if big_delay > 0:
@@ -261,20 +290,128 @@ class SirMordred:
         for t in threads:
             t.join()
 
+        for section, stats in gate.get_wait_stats().items():
+            logger.debug("[thread:main] %s waited %0.2fs at the identities gate (%i waits, max %0.2fs)",
+                         section, stats['total'], stats['waits'], stats['max'])
+        if processes:
+            gate.close()
+
         # Checking for exceptions in threads to log them
-        self.__check_queue_for_errors()
+        self.__check_queue_for_errors(comm_queue)
 
         logger.debug("[thread:main] All threads (and their tasks) are finished")
 
-    def __check_queue_for_errors(self):
+    def __get_dag_task(self, task_cls, backend_section=None):
+        """ Return the task instance for a node, created just once so it keeps its state """
+
+        key = (task_cls, backend_section)
+        if key not in self.dag_tasks:
+            task = task_cls(self.config)
+            task.set_backend_section(backend_section)
+            self.dag_tasks[key] = task
+        return self.dag_tasks[key]
+
+    def build_tasks_graph(self, tasks_cls, global_tasks=True):
+        """
+        Build the graph of tasks for a cycle of the DAG scheduler.
+
+        Each (task, backend_section) is a node: collection -> enrich ->
+        autorefresh -> studies -> studies autorefresh for each backend
+        section, as TaskEnrich.execute does, and identities
+        load -> merge -> enrich for the identities. The backend sections
+        are the ones of the current projects, so the projects must be
+        updated before building the graph.
+
+        :param tasks_cls: list of tasks classes to be executed
+        :param global_tasks: include the tasks not executed per backend
+        """
+        scheduler = TasksScheduler(self.conf['general']['dag_max_workers'])
+
+        identities_deps = []
+        if global_tasks:
+            if TaskIdentitiesLoad in tasks_cls:
+                scheduler.add_node('identities_load', self.__get_dag_task(TaskIdentitiesLoad).execute)
+                identities_deps = ['identities_load']
+            if TaskIdentitiesMerge in tasks_cls:
+                scheduler.add_node('identities_merge', self.__get_dag_task(TaskIdentitiesMerge).execute,
+                                   identities_deps)
+                identities_deps = ['identities_merge']
+            if TaskIdentitiesExport in tasks_cls:
+                scheduler.add_node('identities_export', self.__get_dag_task(TaskIdentitiesExport).execute,
+                                   identities_deps)
+
+        backend_tasks = [tc for tc in tasks_cls if tc.is_backend_task(tc)]
+        last_backend_nodes = []
+        if backend_tasks:
+            for backend_section in self._get_repos_by_backend():
+                deps = []
+                for tc in backend_tasks:
+                    task = self.__get_dag_task(tc, backend_section)
+                    name = tc.__name__ + ':' + backend_section
+                    if tc == TaskEnrich:
+                        # enrichment must wait also for the identities merge
+                        deps += identities_deps
+                        steps = [('enrich', task.execute_enrich),
+                                 ('autorefresh', task.execute_autorefresh),
+                                 ('studies', task.execute_studies),
+                                 ('autorefresh_studies', task.execute_autorefresh_studies)]
+                        for (step, execute) in steps:
+                            name = step + ':' + backend_section
+                            scheduler.add_node(name, execute, deps)
+                            deps = [name]
+                        continue
+                    if tc in (TaskRawDataCollection, TaskRawDataArthurCollection):
+                        name = 'collection:' + backend_section
+                    scheduler.add_node(name, task.execute, deps)
+                    deps = [name]
+                last_backend_nodes += deps
+
+        if global_tasks:
+            for tc in tasks_cls:
+                if tc.is_backend_task(tc) or tc in (TaskProjects, TaskIdentitiesLoad,
+                                                    TaskIdentitiesMerge, TaskIdentitiesExport):
+                    continue
+                # Other global tasks (track items, report) work with the enriched data
+                scheduler.add_node(tc.__name__, self.__get_dag_task(tc).execute,
+                                   last_backend_nodes)
+
+        return scheduler
+
+    def execute_dag_tasks(self, tasks_cls, global_tasks=None):
+        """
+        Execute a cycle of the tasks using the DAG scheduler.
+
+        :param tasks_cls: list of tasks classes to be executed
+        :param global_tasks: include the global tasks in the cycle. If None,
+            they are included only when `sleep_for` seconds have passed since
+            the last time they were executed
+        """
+        if global_tasks is None:
+            global_tasks = self.last_dag_global_tasks is None or \
+                time.time() - self.last_dag_global_tasks >= self.conf['sortinghat']['sleep_for']
+        if global_tasks:
+            self.last_dag_global_tasks = time.time()
+
+        # Everything depends on the projects, and the backend nodes are built from them
+        if TaskProjects in tasks_cls:
+            self.__get_dag_task(TaskProjects).execute()
+
+        scheduler = self.build_tasks_graph(tasks_cls, global_tasks)
+        logger.debug("[thread:main] DAG cycle with %i nodes", len(scheduler.nodes))
+        scheduler.run()
+
+    def __check_queue_for_errors(self, comm_queue):
         try:
-            exc = TasksManager.COMM_QUEUE.get(block=False)
+            exc = comm_queue.get(block=False)
         except queue.Empty:
             logger.debug("[thread:main] No exceptions in threads queue. Let's continue ..")
         else:
             exc_type, exc_obj, exc_trace = exc
             # deal with the exception
             logger.error(exc_type)
+            if isinstance(exc_trace, str):
+                # exceptions from processes come with the traceback already formatted
+                logger.error(exc_trace)
             raise exc_obj
 
     def __execute_initial_load(self):
@@ -368,13 +505,25 @@ class SirMordred:
                 break
 
             try:
-                if not self.conf['general']['update']:
+                if self.conf['general']['scheduler'] == 'dag' and not self.conf['general']['update']:
+                    # as in the batch execution, the global tasks are executed in both passes
+                    self.execute_dag_tasks(all_tasks_cls, global_tasks=True)
+                    self.log_http_stats()
+                    self.execute_dag_tasks(all_tasks_cls, global_tasks=True)
+                    break
+                elif self.conf['general']['scheduler'] == 'dag':
+                    self.execute_dag_tasks(all_tasks_cls)
+                    self.log_http_stats()
+                    time.sleep(self.conf['general']['min_update_delay'])
+                elif not self.conf['general']['update']:
                     self.execute_batch_tasks(all_tasks_cls,
                                              self.conf['sortinghat']['sleep_for'],
-                                             self.conf['general']['min_update_delay'])
+                                             self.conf['general']['min_update_delay'],
+                                             processes=self.conf['general']['process_managers'])
                     self.execute_batch_tasks(all_tasks_cls,
                                              self.conf['sortinghat']['sleep_for'],
-                                             self.conf['general']['min_update_delay'])
+                                             self.conf['general']['min_update_delay'],
+                                             processes=self.conf['general']['process_managers'])
                     break
                 else:
                     self.execute_nonstop_tasks(all_tasks_cls)
@@ -392,4 +541,5 @@ class SirMordred:
                 var = traceback.format_exc()
                 logger.error(var)
 
+        self.log_http_stats()
         logger.info("Finished SirMordred engine ...")
@@ -26,9 +26,15 @@ import json
 import logging
 import re
 
+from threading import Lock
+
+import requests
+
 from grimoire_elk.elk import get_ocean_backend
 from grimoire_elk.utils import get_connector_from_name, get_elastic
-from grimoire_elk.enriched.utils import grimoire_con
+
+from sirmordred.http_sessions import SharedSession
+from sirmordred.retention import DataRetention
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +46,12 @@ class Task():
                          'collect', 'pair-programming', 'fetch-archive', 'studies',
                          'node_regex']
     PARAMS_WITH_SPACES = ['blacklist-jobs']
+    BACKENDS_CONF_SECTIONS = ['es_collection', 'es_enrichment', 'github', 'projects', 'sortinghat']
+
+    BACKENDS_LOCK = Lock()
+    backends_cache = {}  # backend section -> (cache key, enrich backend, ocean elastic)
+    backends_version = 0  # incremented each time the backends of all sections are invalidated
+    backends_sections_versions = {}  # backend section -> times its backends were invalidated
 
     def __init__(self, config):
         self.backend_section = None
@@ -49,7 +61,9 @@ class Task():
         self.db_user = self.conf['sortinghat']['user']
         self.db_password = self.conf['sortinghat']['password']
         self.db_host = self.conf['sortinghat']['host']
-        self.grimoire_con = grimoire_con(conn_retries=12)  # 30m retry
+        self.grimoire_con = SharedSession()  # HTTP sessions shared by all the tasks
+        self.new_items = None  # new items found in the last execution, None if unknown
+        self.repos_delta = None  # if set, only these repos are processed in the next execution
 
     @staticmethod
     def anonymize_url(url):
@@ -79,6 +93,26 @@ class Task():
         """ Execute the Task """
         logger.debug("A bored task. It does nothing!")
 
+    def _count_index_items(self, es_url, index):
+        """ Return the number of items in an index, None if it can not be counted """
+
+        try:
+            res = self.grimoire_con.get(es_url.rstrip('/') + '/' + index + '/_count')
+            res.raise_for_status()
+            return res.json()['count']
+        except Exception as ex:
+            logger.debug("Can not count the items in %s: %s", index, ex)
+            return None
+
+    def _filter_repos_delta(self, repos):
+        """ Return the repos to process in this execution: all of them or the ones in the delta """
+
+        if self.repos_delta is None:
+            return repos
+
+        delta = set(self.repos_delta)
+        return [repo for repo in repos if repo in delta]
+
     @classmethod
     def get_backend(self, backend_section):
         # To support the same data source with different configs
@@ -176,7 +210,63 @@ class Task():
             logger.warning("No config for the backend %s", self.backend_section)
         return es_col_url
 
+    @classmethod
+    def invalidate_backends(cls, backend_section=None):
+        """ Remove from the cache the backends of a section, or of all sections if None
+
+        The config params changed with set_param and the projects updates
+        invalidate the backends built with their old values.
+        """
+        with cls.BACKENDS_LOCK:
+            if backend_section is None:
+                cls.backends_cache.clear()
+                Task.backends_version += 1
+            else:
+                cls.backends_cache.pop(backend_section, None)
+                versions = cls.backends_sections_versions
+                versions[backend_section] = versions.get(backend_section, 0) + 1
+
+    def _backends_cache_key(self):
+        """ Key of the backends built with the current projects and config of the section """
+
+        from .task_projects import TaskProjects
+        return (TaskProjects.get_projects_version(), Task.backends_version,
+                self.backends_sections_versions.get(self.backend_section, 0))
+
     def _get_enrich_backend(self):
+        """ Return the enrich backend of the section, built once while the projects and config don't change """
+
+        key = self._backends_cache_key()
+        with self.BACKENDS_LOCK:
+            cached = self.backends_cache.get(self.backend_section)
+            if cached and cached[0] == key:
+                return cached[1]
+
+        enrich_backend = self._build_enrich_backend()
+        with self.BACKENDS_LOCK:
+            self.backends_cache[self.backend_section] = (key, enrich_backend, None)
+        return enrich_backend
+
+    def _get_ocean_backend(self, enrich_backend):
+        """ Return a new ocean backend of the section for enrich_backend
+
+        The ocean backend is built each time, as its from_date or offset is
+        read from the enriched index when it is built. Its connection to the
+        raw index is reused if enrich_backend is the cached one.
+        """
+        with self.BACKENDS_LOCK:
+            cached = self.backends_cache.get(self.backend_section)
+            elastic_ocean = cached[2] if cached and cached[1] is enrich_backend else None
+
+        ocean_backend = self._build_ocean_backend(enrich_backend, elastic_ocean)
+        if elastic_ocean is None:
+            with self.BACKENDS_LOCK:
+                cached = self.backends_cache.get(self.backend_section)
+                if cached and cached[1] is enrich_backend:
+                    self.backends_cache[self.backend_section] = (cached[0], enrich_backend, ocean_backend.elastic)
+        return ocean_backend
+
+    def _build_enrich_backend(self, es_aliases=None):
         db_projects_map = None
         json_projects_map = None
         clean = False
@@ -189,7 +279,7 @@ class Task():
                                       self.db_user, self.db_password, self.db_host)
         elastic_enrich = get_elastic(self.conf['es_enrichment']['url'],
                                      self.conf[self.backend_section]['enriched_index'],
-                                     clean, enrich_backend)
+                                     clean, enrich_backend, es_aliases)
         enrich_backend.set_elastic(elastic_enrich)
 
         if 'github' in self.conf.keys() and \
@@ -204,7 +294,7 @@ class Task():
 
         return enrich_backend
 
-    def _get_ocean_backend(self, enrich_backend):
+    def _build_ocean_backend(self, enrich_backend, elastic_ocean=None):
         backend_cmd = None
 
         no_incremental = False
@@ -227,9 +317,10 @@ class Task():
         else:
             ocean_backend = get_ocean_backend(backend_cmd, enrich_backend, no_incremental)
 
-        elastic_ocean = get_elastic(self._get_collection_url(),
-                                    self.conf[self.backend_section]['raw_index'],
-                                    clean, ocean_backend)
+        if elastic_ocean is None:
+            elastic_ocean = get_elastic(self._get_collection_url(),
+                                        self.conf[self.backend_section]['raw_index'],
+                                        clean, ocean_backend)
         ocean_backend.set_elastic(elastic_ocean)
 
         return ocean_backend
@@ -253,7 +344,13 @@ class Task():
             raise
         return major
 
-    @staticmethod
-    def retain_data(hours_to_retain, es_url, index):
-        elastic = get_elastic(es_url, index)
-        elastic.delete_items(hours_to_retain)
+    def retain_data(self, hours_to_retain, es_url, index):
+        """ Delete in background the items of index older than hours_to_retain """
+
+        retention = DataRetention(self.grimoire_con,
+                                  slices=self.conf['general']['retention_slices'],
+                                  requests_per_second=self.conf['general']['retention_requests_per_second'])
+        try:
+            retention.retain(hours_to_retain, es_url, index)
+        except requests.exceptions.RequestException as ex:
+            logger.error("Error applying the data retention to %s: %s", index, ex)
@@ -22,16 +22,17 @@
 #     Alvaro del Castillo <acs@bitergia.com>
 #
 
+import functools
 import inspect
 import json
 import logging
+import multiprocessing
 import os
-import pickle
-import sys
 import time
-import traceback
 
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import BoundedSemaphore, Event, Lock, Thread
+from urllib.parse import urlparse
 
 import redis
 
@@ -39,11 +40,14 @@ import requests
 
 from arthur.common import Q_STORAGE_ITEMS
 
+from grimoirelab_toolkit.datetime import str_to_datetime
+
 from grimoire_elk.elk import feed_backend
 from grimoire_elk.elastic_items import ElasticItems
 from grimoire_elk.elastic import ElasticSearch
 from grimoire_elk.utils import get_connector_from_name, get_elastic
 
+from sirmordred.arthur_items import ArthurItem, ArthurItemsBuffer
 from sirmordred.error import DataCollectionError
 from sirmordred.task import Task
 from sirmordred.task_projects import TaskProjects
@@ -51,10 +55,34 @@ from sirmordred.task_projects import TaskProjects
 
 logger = logging.getLogger(__name__)
 
+HEADER_JSON = {"Content-Type": "application/json"}
+
+REDIS_POOLS = {}  # redis connection pools by URL, shared by all the tasks
+REDIS_POOLS_LOCK = Lock()
+
+
+def get_redis_connection(url):
+    """ Return a redis connection using the connection pool of url """
+
+    with REDIS_POOLS_LOCK:
+        if url not in REDIS_POOLS:
+            REDIS_POOLS[url] = redis.ConnectionPool.from_url(url)
+        return redis.StrictRedis(connection_pool=REDIS_POOLS[url])
+
+
+@functools.lru_cache(maxsize=None)
+def get_fetch_parameters(klass):
+    """ Return the parameters of the fetch method of a perceval backend class """
+
+    return inspect.signature(klass.fetch).parameters
+
 
 class TaskRawDataCollection(Task):
     """ Basic class shared by all collection tasks """
 
+    HOSTS_LOCK = Lock()
+    hosts_semaphores = {}  # (host, max collections) -> semaphore limiting the collections of the host
+
     def __init__(self, config, backend_section=None):
         super().__init__(config)
 
@@ -75,6 +103,8 @@ class TaskRawDataCollection(Task):
 
     def execute(self):
         cfg = self.config.get_conf()
+        # unknown until the items are counted after the collection
+        self.new_items = None
 
         if 'scroll_size' in cfg['general']:
             ElasticItems.scroll_size = cfg['general']['scroll_size']
@@ -89,7 +119,6 @@ class TaskRawDataCollection(Task):
         t2 = time.time()
         logger.info('[%s] collection phase starts', self.backend_section)
         print("Collection for {}: starting...".format(self.backend_section))
-        clean = False
 
         fetch_archive = False
         if 'fetch-archive' in cfg[self.backend_section] and cfg[self.backend_section]['fetch-archive']:
@@ -101,6 +130,15 @@ class TaskRawDataCollection(Task):
         if not repos:
             logger.warning("No collect repositories for %s", self.backend_section)
 
+        repos = self._filter_repos_delta(repos)
+
+        es_col_url = self._get_collection_url()
+        raw_index = cfg[self.backend_section]['raw_index']
+        items_before = None
+        if cfg['general']['adaptive_update']:
+            items_before = self._count_index_items(es_col_url, raw_index)
+
+        collect_repos = []
         for repo in repos:
             p2o_args = self._compose_p2o_params(self.backend_section, repo)
             filter_raw = p2o_args['filter-raw'] if 'filter-raw' in p2o_args else None
@@ -112,28 +150,28 @@ class TaskRawDataCollection(Task):
                 # in `unknown` is considered in this phase.
                 logging.warning("Not collecting filter raw repository: %s", repo)
                 continue
-
-            url = p2o_args['url']
-            backend_args = self._compose_perceval_params(self.backend_section, repo)
-            logger.debug(backend_args)
-            logger.info('[%s] collection starts for %s', self.backend_section, repo)
-            es_col_url = self._get_collection_url()
-            ds = self.backend_section
-            backend = self.get_backend(self.backend_section)
-            project = None  # just used for github in cauldron
-
-            es_aliases = self.select_aliases(cfg, self.backend_section)
-
-            try:
-                feed_backend(es_col_url, clean, fetch_archive, backend, backend_args,
-                             cfg[ds]['raw_index'], cfg[ds]['enriched_index'], project,
-                             es_aliases=es_aliases)
-            except Exception:
-                logger.error("Something went wrong collecting data from this %s repo: %s . "
-                             "Using the backend_args: %s " % (ds, url, str(backend_args)))
-                traceback.print_exc()
-                raise DataCollectionError('Failed to collect data from %s' % url)
-            logger.info('[%s] collection finished for %s', self.backend_section, repo)
+            collect_repos.append((repo, p2o_args['url']))
+
+        # Repos are collected in parallel, but a failure in one of them
+        # doesn't stop the collection of the rest
+        workers = max(cfg['es_collection']['collection_workers'], 1)
+        failures = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.__collect_repo, cfg, repo, url, fetch_archive): url
+                       for (repo, url) in collect_repos}
+            for future in as_completed(futures):
+                ex = future.exception()
+                if ex:
+                    url = self.anonymize_url(futures[future])
+                    logger.error("[%s] collection failed for %s: %s", self.backend_section, url, ex, exc_info=ex)
+                    failures.append("%s (%s)" % (url, ex))
+
+        if failures:
+            raise DataCollectionError('Failed to collect data from %s' % ", ".join(failures))
+
+        if items_before is not None:
+            items_after = self._count_index_items(es_col_url, raw_index)
+            self.new_items = max(items_after - items_before, 0) if items_after is not None else None
 
         t3 = time.time()
         spent_time = time.strftime("%H:%M:%S", time.gmtime(t3 - t2))
@@ -146,100 +184,182 @@ class TaskRawDataCollection(Task):
                          self.conf['es_collection']['url'],
                          self.conf[self.backend_section]['raw_index'])
 
+    @classmethod
+    def get_host_semaphore(cls, host, max_collections):
+        """ Return the semaphore limiting the concurrent collections for a host
+
+        The semaphores are kept by host and limit, so a new limit set in the
+        config is applied to the collections started after the change.
+        """
+        key = (host, max_collections)
+        with cls.HOSTS_LOCK:
+            if key not in cls.hosts_semaphores:
+                cls.hosts_semaphores[key] = BoundedSemaphore(max_collections)
+            return cls.hosts_semaphores[key]
+
+    @staticmethod
+    def get_repo_host(url):
+        """ Return the host of a repository URL, or its first token if it is not a URL """
+
+        netloc = urlparse(url).netloc
+        if netloc:
+            # remove the credentials, if any
+            return netloc.rsplit('@', 1)[-1]
+
+        return url.split()[0].split('/')[0]
+
+    def __collect_repo(self, cfg, repo, url, fetch_archive):
+        clean = False
+        backend_args = self._compose_perceval_params(self.backend_section, repo)
+        logger.debug(backend_args)
+        es_col_url = self._get_collection_url()
+        ds = self.backend_section
+        backend = self.get_backend(self.backend_section)
+        project = None  # just used for github in cauldron
+
+        es_aliases = self.select_aliases(cfg, self.backend_section)
+
+        host = self.get_repo_host(url)
+        with self.get_host_semaphore(host, cfg['es_collection']['collection_workers_per_host']):
+            logger.info('[%s] collection starts for %s', self.backend_section, repo)
+            # the errors are logged and aggregated by execute, with the URL anonymized
+            feed_backend(es_col_url, clean, fetch_archive, backend, backend_args,
+                         cfg[ds]['raw_index'], cfg[ds]['enriched_index'], project,
+                         es_aliases=es_aliases)
+            logger.info('[%s] collection finished for %s', self.backend_section, repo)
+
+
+class ArthurItemsDrainer(Thread):
+    """
+    Thread moving the items from the arthur redis queue to the items buffer
+
+    The items are appended to the queue of their tag in the buffer, where
+    the collection tasks of each backend section consume them. All the
+    items of the queue are moved, whatever their tag, so a single drainer
+    must run for all the backend sections collected with arthur.
+
+    The items of the tags whose queue is full are pushed back to the end of
+    the redis queue, so they are moved once their tag is consumed while the
+    items of the rest of tags keep being moved.
+    """
+
+    IDLE_WAIT = 1  # seconds to wait when there are no items in redis
+    MAX_BATCH_FACTOR = 10  # max size of a batch from redis, in times of arthur_redis_items
+
+    def __init__(self, conf, arthur_items):
+        super().__init__(name="arthur-drainer", daemon=True)
+        self.conf = conf
+        self.arthur_items = arthur_items
+        self.stopper = Event()
+
+    def stop(self):
+        self.stopper.set()
+
+    def run(self):
+        logger.info("Arthur items drainer started")
+        while not self.stopper.is_set():
+            try:
+                collected = self.drain()
+            except Exception as ex:
+                logger.error("Error collecting items from redis queue: %s", ex)
+                collected = 0
+            if not collected:
+                self.stopper.wait(self.IDLE_WAIT)
+        logger.info("Arthur items drainer stopped")
+
+    def drain(self):
+        """ Move the pending items from redis to the buffer, in batches
+
+        :returns: number of items collected
+        """
+        # Don't feed items from redis if the current buffer is
+        # larger than arthur_max_memory_size and it can't be spilled to disk
+        if self.arthur_items.is_full:
+            logger.debug("Items queue full. Not collecting items from redis queue.")
+            return 0
+
+        db_url = self.conf['es_collection']['redis_url']
+        conn = get_redis_connection(db_url)
+
+        # The batches are larger when there are more items waiting in redis
+        redis_items = self.conf['es_collection']['arthur_redis_items']
+        redis_batches = self.conf['es_collection']['arthur_redis_batches']
+        pending = conn.llen(Q_STORAGE_ITEMS)
+        if not pending:
+            return 0
+        batch_size = max(redis_items, -(-pending // max(redis_batches, 1)))
+        batch_size = min(batch_size, redis_items * self.MAX_BATCH_FACTOR)
+
+        collected = 0
+        for _ in range(redis_batches):
+            if not pending or self.arthur_items.is_full:
+                break
+            # Get and remove queued items in an atomic transaction
+            pipe = conn.pipeline()
+            pipe.lrange(Q_STORAGE_ITEMS, 0, batch_size - 1)
+            pipe.ltrim(Q_STORAGE_ITEMS, batch_size, -1)
+            pipe.llen(Q_STORAGE_ITEMS)
+            items, _, pending = pipe.execute()
+
+            # the item is unpickled when it is consumed
+            full_items = [item for item in items if not self.arthur_items.append(ArthurItem(item))]
+            if full_items:
+                conn.rpush(Q_STORAGE_ITEMS, *full_items)
+                pending += len(full_items)
+                logger.debug("%i items of full tags pushed back to redis queue", len(full_items))
+            collected += len(items) - len(full_items)
+            if len(full_items) == len(items):
+                # the pending items are of full tags, wait for them to be consumed
+                break
+
+        logger.debug("Collected %i items from redis queue in batches of %i, %i items pending",
+                     collected, batch_size, pending)
+        logger.debug("Arthur items memory size: %0.2f MB (%0.2f MB on disk)",
+                     self.arthur_items.size / (1024 * 1024), self.arthur_items.spilled_size / (1024 * 1024))
+
+        return collected
+
 
 class TaskRawDataArthurCollection(Task):
     """ Basic class to control arthur for data collection """
 
-    ARTHUR_TASK_DELAY = 60  # sec, it should be configured per kind of backend
     REPOSITORY_DIR = "/tmp"
-    ARTHUR_FEED_LOCK = Lock()
-    ARTHUR_LAST_MEMORY_CHECK = time.time()
-    ARTHUR_LAST_MEMORY_CHECK_TIME = 0  # seconds needed to check the memory
-    ARTHUR_LAST_MEMORY_SIZE = 0  # size in MB of the python dict
-    ARTHUR_MAX_MEMORY_SIZE = 200  # max size in MB of the python dict
-    ARTHUR_REDIS_ITEMS = 1000  # number of raw items to collect from redis
+    DRAINER_LOCK = Lock()
+    ARTHUR_TASKS_CHUNK = 100  # tasks added to arthur in each request
 
-    arthur_items = {}  # Hash with tag list with all items collected from arthur queue
+    arthur_items = ArthurItemsBuffer()  # Buffer by tag with all items collected from arthur queue
+    arthur_drainer = None  # ArthurItemsDrainer moving the items from redis to arthur_items
 
     def __init__(self, config, backend_section=None):
         super().__init__(config)
 
         self.arthur_url = config.get_conf()['es_collection']['arthur_url']
+        self.arthur_items.set_spill(self.conf['es_collection']['arthur_max_memory_size'] * 1024 * 1024,
+                                    self.conf['es_collection']['arthur_spill_dir'])
+        self.arthur_items.set_max_tag_size(self.conf['es_collection']['arthur_max_tag_size'] * 1024 * 1024)
 
         self.backend_section = backend_section
+        self.projects_version = None  # projects version of the last execution
+        self.last_activity_param = None  # from_date or offset, param of the backend for incremental fetch
+        self.last_activities = {}  # last from_date or offset in the raw index by tag, for the current execution
 
-    # https://goshippo.com/blog/measure-real-size-any-python-object/
     @classmethod
-    def measure_memory(cls, obj, seen=None):
-        """Recursively finds size of objects"""
-        size = sys.getsizeof(obj)
-        if seen is None:
-            seen = set()
-        obj_id = id(obj)
-        if obj_id in seen:
-            return 0
-        # Important mark as seen *before* entering recursion to gracefully handle
-        # self-referential objects
-        seen.add(obj_id)
-        if isinstance(obj, dict):
-            size += sum([cls.measure_memory(v, seen) for v in obj.values()])
-            size += sum([cls.measure_memory(k, seen) for k in obj.keys()])
-        elif hasattr(obj, '__dict__'):
-            size += cls.measure_memory(obj.__dict__, seen)
-        elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
-            size += sum([cls.measure_memory(i, seen) for i in obj])
-        return size
-
-    def __feed_arthur(self):
-        """ Feed Ocean with backend data collected from arthur redis queue"""
+    def start_drainer(cls, conf):
+        """ Start the thread draining the arthur redis queue, if it is not running
 
-        with self.ARTHUR_FEED_LOCK:
-
-            # This is a expensive operation so don't do it always
-            if (time.time() - self.ARTHUR_LAST_MEMORY_CHECK) > 5 * self.ARTHUR_LAST_MEMORY_CHECK_TIME:
-                self.ARTHUR_LAST_MEMORY_CHECK = time.time()
-                logger.debug("Measuring the memory used by the raw items dict ...")
-                try:
-                    memory_size = self.measure_memory(self.arthur_items) / (1024 * 1024)
-                except RuntimeError as ex:
-                    # During memory usage measure, other thread could change the dict
-                    logger.warning("Can't get the memory used by the raw items dict: %s", ex)
-                    memory_size = self.ARTHUR_LAST_MEMORY_SIZE
-                self.ARTHUR_LAST_MEMORY_CHECK_TIME = time.time() - self.ARTHUR_LAST_MEMORY_CHECK
-                logger.debug("Arthur items memory size: %0.2f MB (%is to check)",
-                             memory_size, self.ARTHUR_LAST_MEMORY_CHECK_TIME)
-                self.ARTHUR_LAST_MEMORY_SIZE = memory_size
-
-            # Don't feed items from redis if the current python dict is
-            # larger than ARTHUR_MAX_MEMORY_SIZE
-
-            if self.ARTHUR_LAST_MEMORY_SIZE > self.ARTHUR_MAX_MEMORY_SIZE:
-                logger.debug("Items queue full. Not collecting items from redis queue.")
-                return
-
-            logger.info("Collecting items from redis queue")
-
-            db_url = self.config.get_conf()['es_collection']['redis_url']
-
-            conn = redis.StrictRedis.from_url(db_url)
-            logger.debug("Redis connection stablished with %s.", db_url)
-
-            # Get and remove queued items in an atomic transaction
-            pipe = conn.pipeline()
-            # pipe.lrange(Q_STORAGE_ITEMS, 0, -1)
-            pipe.lrange(Q_STORAGE_ITEMS, 0, self.ARTHUR_REDIS_ITEMS - 1)
-            pipe.ltrim(Q_STORAGE_ITEMS, self.ARTHUR_REDIS_ITEMS, -1)
-            items = pipe.execute()[0]
-
-            for item in items:
-                arthur_item = pickle.loads(item)
-                if arthur_item['tag'] not in self.arthur_items:
-                    self.arthur_items[arthur_item['tag']] = []
-                self.arthur_items[arthur_item['tag']].append(arthur_item)
+        The drainer moves the items of all the tags to the buffer of its
+        process, so it only runs in the main process, the one executing the
+        collection of all the arthur backend sections.
+        """
+        if multiprocessing.current_process().name != 'MainProcess':
+            msg = "The arthur items can not be collected in the process %s" % multiprocessing.current_process().name
+            raise DataCollectionError(msg)
 
-            for tag in self.arthur_items:
-                if self.arthur_items[tag]:
-                    logger.debug("Arthur items for %s: %i", tag, len(self.arthur_items[tag]))
+        with cls.DRAINER_LOCK:
+            if cls.arthur_drainer and cls.arthur_drainer.is_alive():
+                return
+            cls.arthur_drainer = ArthurItemsDrainer(conf, cls.arthur_items)
+            cls.arthur_drainer.start()
 
     def backend_tag(self, repo):
         tag = repo  # the default tag in general
@@ -254,12 +374,149 @@ class TaskRawDataArthurCollection(Task):
 
         return tag
 
+    def __remove_arthur_tasks(self, repos):
+        """ Remove from arthur the tasks of the repos removed from the projects since the last execution """
+
+        version = TaskProjects.get_projects_version()
+        last_version = self.projects_version
+        self.projects_version = version
+        if last_version is None or last_version == version:
+            return
+
+        diff = TaskProjects.get_repos_diff(self.backend_section, last_version)
+        if diff is None:
+            logger.warning("[%s] Too many projects updates, removed repos can not be removed from arthur",
+                           self.backend_section)
+            return
+
+        # a tag could be shared by several repos
+        current_tags = set([self.backend_tag(repo) for repo in repos])
+        removed_tags = [tag for tag in set([self.backend_tag(repo) for repo in diff['removed']])
+                        if tag not in current_tags and tag in self.arthur_items]
+        if not removed_tags:
+            return
+
+        logger.info("[%s] Removing %i arthur tasks of removed repos", self.backend_section, len(removed_tags))
+        r = requests.post(self.arthur_url + "/remove",
+                          json={"tasks": [{"task_id": tag} for tag in removed_tags]})
+        r.raise_for_status()
+        for tag in removed_tags:
+            self.arthur_items.remove_tag(tag)
+
+    def get_last_activities(self, tags):
+        """ Get the last activity of the tags in the raw index
+
+        The max value of the from_date or offset field is read for all the
+        tags with a single terms aggregation query.
+
+        :param tags: list of tags
+        :returns: dict with the from_date (ISO format) or offset of each tag
+        """
+        connector = get_connector_from_name(self.backend_section)
+        klass = connector[0]  # Backend for the connector
+        parameters = get_fetch_parameters(klass)
+
+        if 'from_date' in parameters:
+            self.last_activity_param, field = 'from_date', 'metadata__updated_on'
+        elif 'offset' in parameters:
+            self.last_activity_param, field = 'offset', 'offset'
+        else:
+            self.last_activity_param = None
+            return {}
+
+        if not tags:
+            return {}
+
+        query = {
+            "size": 0,
+            "aggs": {
+                "tags": {
+                    "terms": {
+                        "field": "tag",
+                        "include": tags,
+                        "size": len(tags)
+                    },
+                    "aggs": {
+                        "last_activity": {
+                            "max": {
+                                "field": field
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+        es_col_url = self._get_collection_url()
+        es_index = self.conf[self.backend_section]['raw_index']
+        url = es_col_url.rstrip('/') + '/' + es_index + '/_search'
+        res = self.grimoire_con.post(url, data=json.dumps(query), headers=HEADER_JSON)
+        if res.status_code == 404:
+            # the raw index does not exist yet
+            return {}
+        res.raise_for_status()
+
+        last_activities = {}
+        for bucket in res.json()['aggregations']['tags']['buckets']:
+            last_activity = bucket['last_activity']
+            if last_activity['value'] is None:
+                continue
+            if field == 'offset':
+                last_activities[bucket['key']] = int(last_activity['value'])
+            else:
+                last_activities[bucket['key']] = str_to_datetime(last_activity['value_as_string']).isoformat()
+
+        logger.debug("[%s] Last activity found for %i of %i tags", self.backend_section,
+                     len(last_activities), len(tags))
+
+        return last_activities
+
+    def add_arthur_tasks(self, tasks):
+        """ Add to arthur the tasks which don't exist yet in it, in chunks
+
+        The tags of the tasks are registered in the items buffer once they
+        are in arthur, so the tasks not added are tried again next time.
+
+        :param tasks: list with the JSON config of the tasks
+        :returns: list with the ids of the tasks added
+        """
+        if not tasks:
+            return []
+
+        # The tasks in arthur are listed once for all the tasks to add
+        try:
+            r = requests.post(self.arthur_url + "/tasks")
+        except requests.exceptions.ConnectionError as ex:
+            logging.error("Can not connect to %s", self.arthur_url)
+            raise RuntimeError("Can not connect to " + self.arthur_url)
+        r.raise_for_status()
+
+        task_ids = set([task['task_id'] for task in r.json()['tasks']])
+        # TODO: if a tasks already exists maybe we should delete and readd it
+        already_tasks = [task['task_id'] for task in tasks if task['task_id'] in task_ids]
+        if already_tasks:
+            logger.warning("Tasks not added to arthur because there are already existing tasks %s", already_tasks)
+        for task_id in already_tasks:
+            self.arthur_items.add_tag(task_id)
+
+        new_tasks = [task for task in tasks if task['task_id'] not in task_ids]
+        for i in range(0, len(new_tasks), self.ARTHUR_TASKS_CHUNK):
+            chunk = new_tasks[i:i + self.ARTHUR_TASKS_CHUNK]
+            r = requests.post(self.arthur_url + "/add", json={"tasks": chunk})
+            r.raise_for_status()
+            for task in chunk:
+                self.arthur_items.add_tag(task['task_id'])
+            logger.debug('[%s] %i tasks added to arthur', self.backend_section, len(chunk))
+
+        if new_tasks:
+            logger.info('[%s] collection configured in arthur for %i repositories',
+                        self.backend_section, len(new_tasks))
+
+        return [task['task_id'] for task in new_tasks]
+
     def __feed_backend_arthur(self, repo):
         """ Feed Ocean with backend data collected from arthur redis queue"""
 
-        # Always get pending items from arthur for all data sources
-        self.__feed_arthur()
-
         tag = self.backend_tag(repo)
 
         logger.debug("Arthur items available for %s", self.arthur_items.keys())
@@ -268,8 +525,11 @@ class TaskRawDataArthurCollection(Task):
 
         if tag in self.arthur_items:
             logger.debug("Found items for %s.", tag)
-            while self.arthur_items[tag]:
-                yield self.arthur_items[tag].pop()
+            item = self.arthur_items.pop(tag)
+            while item is not None:
+                self.new_items += 1
+                yield item
+                item = self.arthur_items.pop(tag)
 
     def __create_arthur_json(self, repo, backend_args):
         """ Create the JSON for configuring arthur to collect data
@@ -312,58 +572,17 @@ class TaskRawDataArthurCollection(Task):
         ajson["tasks"][0]['backend_args'] = backend_args
         ajson["tasks"][0]['category'] = backend_args['category']
         ajson["tasks"][0]['archive'] = {}
-        ajson["tasks"][0]['scheduler'] = {"delay": self.ARTHUR_TASK_DELAY}
+        ajson["tasks"][0]['scheduler'] = {"delay": self.conf['es_collection']['arthur_task_delay']}
         # from-date or offset param must be added
-        es_col_url = self._get_collection_url()
-        es_index = self.conf[self.backend_section]['raw_index']
-        # Get the last activity for the data source
-        es = ElasticSearch(es_col_url, es_index)
-        connector = get_connector_from_name(self.backend_section)
-
-        klass = connector[0]  # Backend for the connector
-        signature = inspect.signature(klass.fetch)
-
-        last_activity = None
-        filter_ = {"name": "tag", "value": backend_args['tag']}
-        if 'from_date' in signature.parameters:
-            last_activity = es.get_last_item_field('metadata__updated_on', [filter_])
-            if last_activity:
-                ajson["tasks"][0]['backend_args']['from_date'] = last_activity.isoformat()
-        elif 'offset' in signature.parameters:
-            last_activity = es.get_last_item_field('offset', [filter_])
-            if last_activity:
-                ajson["tasks"][0]['backend_args']['offset'] = last_activity
-
+        last_activity = self.last_activities.get(backend_args['tag'])
         if last_activity:
+            ajson["tasks"][0]['backend_args'][self.last_activity_param] = last_activity
             logging.info("Getting raw item with arthur since %s", last_activity)
 
         return(ajson)
 
     def execute(self):
 
-        def check_arthur_task(repo, backend_args):
-            """ Check if a task exists in arthur and if not, create it """
-            arthur_repo_json = self.__create_arthur_json(repo, backend_args)
-            logger.debug('JSON config for arthur %s', json.dumps(arthur_repo_json, indent=True))
-
-            # First check is the task already exists
-            try:
-                r = requests.post(self.arthur_url + "/tasks")
-            except requests.exceptions.ConnectionError as ex:
-                logging.error("Can not connect to %s", self.arthur_url)
-                raise RuntimeError("Can not connect to " + self.arthur_url)
-
-            task_ids = [task['task_id'] for task in r.json()['tasks']]
-            new_task_ids = [task['task_id'] for task in arthur_repo_json['tasks']]
-            # TODO: if a tasks already exists maybe we should delete and readd it
-            already_tasks = list(set(task_ids).intersection(set(new_task_ids)))
-            if len(already_tasks) > 0:
-                logger.warning("Tasks not added to arthur because there are already existing tasks %s", already_tasks)
-            else:
-                r = requests.post(self.arthur_url + "/add", json=arthur_repo_json)
-                r.raise_for_status()
-                logger.info('[%s] collection configured in arthur for %s', self.backend_section, repo)
-
         def collect_arthur_items(repo):
             aitems = self.__feed_backend_arthur(repo)
             if not aitems:
@@ -391,6 +610,8 @@ class TaskRawDataArthurCollection(Task):
             ElasticSearch.max_items_bulk = cfg['general']['bulk_size']
 
         logger.info('Programming arthur for [%s] raw data collection', self.backend_section)
+        self.start_drainer(self.conf)
+        self.new_items = 0
         clean = False
 
         fetch_archive = False
@@ -403,11 +624,21 @@ class TaskRawDataArthurCollection(Task):
         if not repos:
             logger.warning("No collect repositories for %s", self.backend_section)
 
+        self.__remove_arthur_tasks(repos)
+        repos = self._filter_repos_delta(repos)
+
+        # the last activity of the new repos is read once for all of them
+        new_tags = [self.backend_tag(repo) for repo in repos]
+        new_tags = [tag for tag in new_tags if tag not in self.arthur_items]
+        self.last_activities = self.get_last_activities(new_tags) if new_tags else {}
+
+        collect_repos = []
+        arthur_tasks = []
+        arthur_tags = set()
         for repo in repos:
             # If the repo already exists don't try to add it to arthur
             tag = self.backend_tag(repo)
-            if tag not in self.arthur_items:
-                self.arthur_items[tag] = []
+            if tag not in self.arthur_items and tag not in arthur_tags:
                 p2o_args = self._compose_p2o_params(self.backend_section, repo)
                 filter_raw = p2o_args['filter-raw'] if 'filter-raw' in p2o_args else None
                 if filter_raw:
@@ -415,11 +646,20 @@ class TaskRawDataArthurCollection(Task):
                     # in the `unknown` section of the projects.json. Thus the URL with
                     # filter-raw is ignored in the collection phase, while the URL
                     # in `unknown` is considered in this phase.
+                    self.arthur_items.add_tag(tag)
                     logging.warning("Not collecting filter raw repository: %s", repo)
                     continue
                 backend_args = self._compose_perceval_params(self.backend_section, repo)
                 logger.debug(backend_args)
 
-                check_arthur_task(repo, backend_args)
+                arthur_repo_json = self.__create_arthur_json(repo, backend_args)
+                logger.debug('JSON config for arthur %s', json.dumps(arthur_repo_json, indent=True))
+                arthur_tasks.extend(arthur_repo_json['tasks'])
+                arthur_tags.add(tag)
+
+            collect_repos.append(repo)
+
+        self.add_arthur_tasks(arthur_tasks)
 
+        for repo in collect_repos:
             collect_arthur_items(repo)
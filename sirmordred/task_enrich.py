@@ -23,20 +23,25 @@
 #
 
 import logging
+import threading
 import time
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
 from elasticsearch import Elasticsearch
 
 from grimoire_elk.elk import (do_studies,
                               enrich_backend,
+                              enrich_items,
+                              get_ocean_backend,
+                              load_identities,
                               refresh_projects,
                               refresh_identities)
 from grimoire_elk.elastic_items import ElasticItems
 from grimoire_elk.elastic import ElasticSearch
 from grimoire_elk.enriched.git import GitEnrich
-from grimoire_elk.utils import get_elastic
+from grimoire_elk.utils import get_connector_from_name, get_elastic
 
 from sirmordred.error import DataEnrichmentError
 from sirmordred.task import Task
@@ -49,6 +54,32 @@ from sortinghat.db.database import Database
 
 logger = logging.getLogger(__name__)
 
+# Tasks and backends reused by each worker of the pooled enrichment
+pooled_workers = threading.local()
+
+
+def enrich_repo_pooled(config, backend_section, repo, backends_key):
+    """Enrich a repository reusing the backends of the current worker
+
+    This function is the entry point of the thread and process pools
+    used by the pooled enrichment, so it must be picklable. The workers
+    live as long as the pool of the task, so their backends are reused
+    in all the executions until backends_key, the cache key of the
+    backends in the main process, changes.
+
+    :returns: tuple with the repository, the number of enriched items
+        and the seconds spent
+    """
+    if not hasattr(pooled_workers, 'tasks'):
+        pooled_workers.tasks = {}
+    task = pooled_workers.tasks.get(backend_section)
+    if not task or not task.pooled_backends or task.pooled_backends[0] != backends_key:
+        # the config of the process workers is a copy which could be outdated
+        task = TaskEnrich(config, backend_section=backend_section)
+        pooled_workers.tasks[backend_section] = task
+
+    return task.enrich_repo(repo, backends_key)
+
 
 class TaskEnrich(Task):
     """ Basic class shared by all enriching tasks """
@@ -63,10 +94,20 @@ class TaskEnrich(Task):
         self.sh_kwargs = {'user': self.db_user, 'password': self.db_password,
                           'database': self.db_sh, 'host': self.db_host,
                           'port': None}
-        self.db = Database(**self.sh_kwargs)
+        self.__db = None  # only needed by the autorefresh, so it is created on first use
         autorefresh_interval = self.conf['es_enrichment']['autorefresh_interval']
         self.last_autorefresh = self.__update_last_autorefresh(days=autorefresh_interval)
         self.last_autorefresh_studies = self.last_autorefresh
+        # backends of the worker, and their cache key, in the pooled enrichment
+        self.pooled_backends = None
+        # pool of the pooled enrichment, and its kind and workers, kept between executions
+        self.enrich_pool = None
+
+    @property
+    def db(self):
+        if not self.__db:
+            self.__db = Database(**self.sh_kwargs)
+        return self.__db
 
     def select_aliases(self, cfg, backend_section):
 
@@ -141,6 +182,11 @@ class TaskEnrich(Task):
         if not repos:
             logger.warning("No enrich repositories for %s", self.backend_section)
 
+        repos = self._filter_repos_delta(repos)
+
+        if cfg['es_enrichment']['pooled_enrichment']:
+            repos = self.__enrich_items_pooled(repos)
+
         for repo in repos:
             # First process p2o params from repo
             p2o_args = self._compose_p2o_params(self.backend_section, repo)
@@ -203,6 +249,153 @@ class TaskEnrich(Task):
         print("Enrichment for {}: finished after {} hours".format(self.backend_section,
                                                                   spent_time))
 
+    def __enrich_items_pooled(self, repos):
+        """Enrich the repos in a pool of workers which reuse their backends
+
+        Repos with raw filters or a jenkins rename file need specific
+        backends, so they are not pooled.
+
+        :returns: list of repos to be enriched without the pool
+        """
+        cfg = self.config.get_conf()
+
+        pooled_repos = []
+        unpooled_repos = []
+        for repo in repos:
+            p2o_args = self._compose_p2o_params(self.backend_section, repo)
+            if 'filter-raw' in p2o_args or 'filter-raw-prefix' in p2o_args or \
+                    'jenkins-rename-file' in p2o_args:
+                unpooled_repos.append(repo)
+            else:
+                pooled_repos.append(repo)
+
+        if not pooled_repos:
+            return unpooled_repos
+
+        workers = max(cfg['es_enrichment']['enrich_workers'], 1)
+        pool = self.__get_enrich_pool(cfg['es_enrichment']['enrich_pool'], workers)
+
+        logger.info('[%s] pooled enrichment of %i repos with %i %s workers', self.backend_section,
+                    len(pooled_repos), workers, cfg['es_enrichment']['enrich_pool'])
+
+        results = []
+        failed_repos = []
+        backends_key = self._backends_cache_key()
+        futures = {pool.submit(enrich_repo_pooled, self.config, self.backend_section, repo, backends_key): repo
+                   for repo in pooled_repos}
+        for future in as_completed(futures):
+            if future.exception():
+                logger.error("Something went wrong producing enriched data for %s %s: %s",
+                             self.backend_section, futures[future], future.exception())
+                failed_repos.append(futures[future])
+            else:
+                results.append(future.result())
+
+        total_items = sum([items for (repo, items, spent) in results if items])
+        total_spent = sum([spent for (repo, items, spent) in results])
+        logger.info('[%s] pooled enrichment summary: %i repos, %i items enriched, %0.2fs of enrichment',
+                    self.backend_section, len(results), total_items, total_spent)
+        if results:
+            (repo, items, spent) = max(results, key=lambda result: result[2])
+            logger.info('[%s] slowest repo: %s (%s items in %0.2fs)', self.backend_section, repo, items, spent)
+
+        if failed_repos:
+            msg = 'Failed to produce enriched data for %s: %s' % (self.backend_section, ", ".join(failed_repos))
+            raise DataEnrichmentError(msg)
+
+        return unpooled_repos
+
+    def __get_enrich_pool(self, pool_kind, workers):
+        """Return the pool of the pooled enrichment, created once and kept between executions
+
+        The workers, and with them their backends, are reused by all the
+        executions of the task. The pool is created again only if its kind
+        or its number of workers change.
+        """
+        if self.enrich_pool and self.enrich_pool[0] == (pool_kind, workers):
+            return self.enrich_pool[1]
+
+        if self.enrich_pool:
+            self.enrich_pool[1].shutdown()
+
+        pool_class = ProcessPoolExecutor if pool_kind == 'process' else ThreadPoolExecutor
+        pool = pool_class(max_workers=workers)
+        self.enrich_pool = ((pool_kind, workers), pool)
+
+        return pool
+
+    def __get_pooled_backends(self, key):
+        """Build the backends of the worker for the pooled enrichment
+
+        The backends are private to the worker, so the params of a repo are
+        not set on a backend shared with the other workers. They are built
+        again when key, the cache key of the shared backends of the section,
+        changes.
+        """
+        if self.pooled_backends and self.pooled_backends[0] == key:
+            return self.pooled_backends[1]
+
+        cfg = self.config.get_conf()
+
+        es_enrich_aliases = self.select_aliases(cfg, self.backend_section)
+        enrich_backend = self._build_enrich_backend(es_enrich_aliases)
+        enrich_backend.set_cfg_section_name(self.backend_section)
+        if 'git' in cfg and 'pair-programming' in cfg['git'] and cfg['git']['pair-programming']:
+            enrich_backend.pair_programming = cfg['git']['pair-programming']
+        if 'jenkins' in cfg and 'node_regex' in cfg['jenkins'] and cfg['jenkins']['node_regex']:
+            enrich_backend.node_regex = cfg['jenkins']['node_regex']
+
+        connector = get_connector_from_name(self.get_backend(self.backend_section))
+        ocean_backend = self._build_ocean_backend(enrich_backend)
+
+        backends = (connector, enrich_backend, ocean_backend.elastic)
+        self.pooled_backends = (key, backends)
+
+        return backends
+
+    def enrich_repo(self, repo, backends_key=None):
+        """Enrich a repo reusing the backends already built for the section
+
+        :param repo: repository to enrich
+        :param backends_key: cache key of the backends, the one of this
+            process if None
+        :returns: tuple with the repository, the number of enriched items
+            and the seconds spent
+        """
+        time_start = time.time()
+
+        p2o_args = self._compose_p2o_params(self.backend_section, repo)
+        backend_args = self._compose_perceval_params(self.backend_section, p2o_args['url'])
+
+        if backends_key is None:
+            backends_key = self._backends_cache_key()
+        connector, enrich_backend, elastic_ocean = self.__get_pooled_backends(backends_key)
+        enrich_backend.set_params(backend_args)
+
+        logger.info('[%s] enrichment starts for %s', self.backend_section, repo)
+
+        backend_cmd = None
+        if connector[3]:
+            # Data is retrieved from Perceval
+            backend_cmd = connector[3](*backend_args)
+
+        no_incremental = False
+        ocean_backend = get_ocean_backend(backend_cmd, enrich_backend, no_incremental)
+        ocean_backend.set_elastic(elastic_ocean)
+
+        # New identities must be in SortingHat before enriching, as enrich_backend does
+        if self.db_sh and enrich_backend.has_identities():
+            logger.info('[%s] load identities process starts for %s', self.backend_section, repo)
+            load_identities(ocean_backend, enrich_backend)
+            logger.info('[%s] load identities process ends for %s', self.backend_section, repo)
+
+        items = enrich_items(ocean_backend, enrich_backend)
+
+        spent = time.time() - time_start
+        logger.info('[%s] enrichment finished for %s', self.backend_section, repo)
+
+        return (repo, items, spent)
+
     def __autorefresh(self, enrich_backend, studies=False):
         # Refresh projects
         field_id = enrich_backend.get_field_unique_id()
@@ -332,56 +525,81 @@ class TaskEnrich(Task):
         # Return studies to its original value
         enrich_backend.studies = all_studies
 
-    def execute(self):
+    def __enrich_disabled(self):
         cfg = self.config.get_conf()
 
         if 'enrich' in cfg[self.backend_section] and not cfg[self.backend_section]['enrich']:
             logger.info('%s enrich disabled', self.backend_section)
+            return True
+
+        return False
+
+    def __do_enrich(self):
+        self.__enrich_items()
+
+        self.retain_data(self.conf['general']['retention_hours'],
+                         self.conf['es_enrichment']['url'],
+                         self.conf[self.backend_section]['enriched_index'])
+
+    def __do_autorefresh(self):
+        if self.conf['es_enrichment']['autorefresh']:
+            logger.debug("Doing autorefresh for %s", self.backend_section)
+            self.__autorefresh(self._get_enrich_backend())
+        else:
+            logger.debug("Not doing autorefresh for %s", self.backend_section)
+
+    def __do_autorefresh_studies(self):
+        if self.conf['es_enrichment']['autorefresh']:
+            self.__autorefresh_studies(self.conf)
+        else:
+            logger.debug("Not doing autorefresh for %s studies", self.backend_section)
+
+    def execute_enrich(self):
+        """ Enrichment step: enrich the raw items and apply the data retention """
+
+        if self.__enrich_disabled():
             return
 
-        # ** START SYNC LOGIC **
-        # Check that identities tasks are not active before executing
-        while True:
-            time.sleep(10)  # check each 10s if the enrichment could start
-            with TasksManager.IDENTITIES_TASKS_ON_LOCK:
-                with TasksManager.NUMBER_ENRICH_TASKS_ON_LOCK:
-                    in_identities = TasksManager.IDENTITIES_TASKS_ON
-                    if not in_identities:
-                        # The enrichment can be started
-                        TasksManager.NUMBER_ENRICH_TASKS_ON += 1
-                        logger.debug("Number of enrichment tasks active: %i",
-                                     TasksManager.NUMBER_ENRICH_TASKS_ON)
-                        break
-                    else:
-                        logger.debug("%s Waiting for enrich until identities is done.",
-                                     self.backend_section)
-        #  ** END SYNC LOGIC **
-
-        try:
-            self.__enrich_items()
-
-            retention_hours = cfg['general']['retention_hours']
-            self.retain_data(retention_hours,
-                             self.conf['es_enrichment']['url'],
-                             self.conf[self.backend_section]['enriched_index'])
-
-            autorefresh = cfg['es_enrichment']['autorefresh']
-
-            if autorefresh:
-                logger.debug("Doing autorefresh for %s", self.backend_section)
-                self.__autorefresh(self._get_enrich_backend())
-            else:
-                logger.debug("Not doing autorefresh for %s", self.backend_section)
+        with TasksManager.IDENTITIES_GATE.read(self.backend_section):
+            self.__do_enrich()
 
-            self.__studies(retention_hours)
+    def execute_studies(self):
+        """ Studies step: execute the studies configured for the backend section """
 
-            if autorefresh:
-                self.__autorefresh_studies(cfg)
-            else:
-                logger.debug("Not doing autorefresh for %s studies", self.backend_section)
+        if self.__enrich_disabled():
+            return
+
+        with TasksManager.IDENTITIES_GATE.read(self.backend_section):
+            self.__studies(self.conf['general']['retention_hours'])
+
+    def execute_autorefresh(self):
+        """ Autorefresh step: refresh the identities in the enriched index """
+
+        if self.__enrich_disabled():
+            return
+
+        with TasksManager.IDENTITIES_GATE.read(self.backend_section):
+            self.__do_autorefresh()
+
+    def execute_autorefresh_studies(self):
+        """ Studies autorefresh step: refresh the identities in the studies indexes """
+
+        if self.__enrich_disabled():
+            return
+
+        with TasksManager.IDENTITIES_GATE.read(self.backend_section):
+            self.__do_autorefresh_studies()
+
+    def execute(self):
+        if self.__enrich_disabled():
+            return
 
-        except Exception as e:
-            raise e
-        finally:
-            with TasksManager.NUMBER_ENRICH_TASKS_ON_LOCK:
-                TasksManager.NUMBER_ENRICH_TASKS_ON -= 1
+        # Enrichment can not run while identities tasks are active
+        with TasksManager.IDENTITIES_GATE.read(self.backend_section):
+            self.__do_enrich()
+            if self.repos_delta is not None:
+                # only new repos are enriched, the rest of steps wait for the next full round
+                return
+            self.__do_autorefresh()
+            self.__studies(self.conf['general']['retention_hours'])
+            self.__do_autorefresh_studies()
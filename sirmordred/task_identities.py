@@ -24,32 +24,348 @@
 
 import base64
 import gzip
+import hashlib
+import io
 import json
 import logging
 import os
-import shutil
 import subprocess
 import tempfile
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from threading import Lock
 
 import requests
 
 from sirmordred.task import Task
 from sirmordred.task_manager import TasksManager
 from sortinghat import api
+from sortinghat.cmd.affiliate import Affiliate
+from sortinghat.cmd.autogender import AutoGender
+from sortinghat.cmd.autoprofile import AutoProfile
 from sortinghat.cmd.init import Init
 from sortinghat.cmd.load import Load
 from sortinghat.cmd.export import Export
-from sortinghat.command import CMD_SUCCESS
+from sortinghat.cmd.unify import Unify
+from sortinghat.command import CMD_FAILURE, CMD_SUCCESS
 from sortinghat.db.database import Database
-from sortinghat.db.model import Profile
+from sortinghat.db.model import Profile, UniqueIdentity
+from sortinghat.exceptions import NotFoundError
+from sortinghat.matcher import create_identity_matcher
 
 from grimoire_elk.elk import load_identities
 
 logger = logging.getLogger(__name__)
 
+SORTINGHAT_CLI_PORT = '3306'
+
+
+class SharedDatabaseCommand():
+    """ Mixin for the sortinghat commands to use a shared Database instead of connecting their own """
+
+    shared_db = None
+
+    def _set_database(self, **kwargs):
+        self.db = self.shared_db
+
+
+class IdentitiesSnapshot():
+    """
+    In memory copy of the unique identities of SortingHat
+
+    The unique identities are loaded once and shared by all the matching
+    algorithms of a unify. The merges done with the copy update it, so the
+    next algorithms see the merged unique identities without loading them
+    all again. Between incremental unifies the copy is kept, and only the
+    unique identities modified since the last one are loaded again.
+
+    The blocking index of each matching, the unique identities with each
+    value of its criteria, is built once and updated with the unique
+    identities changed in the copy.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.uidentities = None  # uuid -> UniqueIdentity, None until loaded
+        self.indexes = {}  # matching key -> (matcher, criteria, index, keys)
+
+    def get_unique_identities(self):
+        """ Return the unique identities by uuid, loading them if needed """
+
+        if self.uidentities is None:
+            self.uidentities = {uidentity.uuid: uidentity for uidentity in api.unique_identities(self.db)}
+            self.indexes = {}
+            logger.debug("[sortinghat] %i unique identities loaded", len(self.uidentities))
+        return self.uidentities
+
+    def invalidate(self):
+        """ Drop the copy, the unique identities were changed out of it """
+
+        self.uidentities = None
+        self.indexes = {}
+
+    def refresh(self, uuids):
+        """ Load again the unique identities in uuids, removing the ones which no longer exist """
+
+        if self.uidentities is None:
+            return
+
+        for uuid in uuids:
+            self.__load(uuid)
+        logger.debug("[sortinghat] %i unique identities refreshed", len(uuids))
+
+    def merge(self, from_uuids, to_uuid):
+        """ Merge the unique identities in from_uuids into to_uuid, updating the copy """
+
+        uidentities = self.get_unique_identities()
+        for from_uuid in from_uuids:
+            api.merge_unique_identities(self.db, from_uuid, to_uuid)
+            uidentities.pop(from_uuid, None)
+            self.__unindex(from_uuid)
+        self.__load(to_uuid)
+
+    def get_index(self, matching_key, matcher):
+        """ Return the blocking index of a matching and the keys of each uuid in it
+
+        :raises NotImplementedError: when the matching has no criteria for the fast mode
+        """
+        if matching_key not in self.indexes:
+            criteria = matcher.matching_criteria()
+            index = {}  # (criteria, value) -> uuids with that value
+            keys = {}  # uuid -> (criteria, value) of the uuid
+            self.indexes[matching_key] = (matcher, criteria, index, keys)
+            for uidentity in self.get_unique_identities().values():
+                self.__index(self.indexes[matching_key], uidentity)
+
+        (_, _, index, keys) = self.indexes[matching_key]
+        return index, keys
+
+    def __load(self, uuid):
+        self.__unindex(uuid)
+        try:
+            uidentity = api.unique_identities(self.db, uuid=uuid)[0]
+        except NotFoundError:
+            self.uidentities.pop(uuid, None)
+            return
+
+        self.uidentities[uuid] = uidentity
+        for matching_index in self.indexes.values():
+            self.__index(matching_index, uidentity)
+
+    @staticmethod
+    def __index(matching_index, uidentity):
+        (matcher, criteria, index, keys) = matching_index
+        for filtered in matcher.filter(uidentity):
+            filtered = filtered.to_dict()
+            for criterion in criteria:
+                if filtered.get(criterion) is None:
+                    continue
+                key = (criterion, filtered[criterion])
+                index.setdefault(key, set()).add(uidentity.uuid)
+                keys.setdefault(uidentity.uuid, set()).add(key)
+
+    def __unindex(self, uuid):
+        for (_, _, index, keys) in self.indexes.values():
+            for key in keys.pop(uuid, []):
+                index[key].discard(uuid)
+                if not index[key]:
+                    del index[key]
+
+
+class SortingHatCommands():
+    """
+    Run the SortingHat commands used by the identities tasks
+
+    By default the commands are executed with the sortinghat CLI. When
+    inprocess is set they are executed in process with the sortinghat API:
+    each command is created once and all of them share the same Database,
+    and with it its connections pool. If a command can not be created in
+    process, it is executed with the sortinghat CLI; the errors of a command
+    once it runs are reported, as it could have been partly applied.
+    """
+
+    DATABASES_LOCK = Lock()
+    databases = {}  # (user, host, database) -> sortinghat Database shared by the commands
+
+    def __init__(self, sh_kwargs, inprocess=False):
+        self.sh_kwargs = sh_kwargs
+        self.inprocess = inprocess
+        self.commands = {}  # command class -> command object
+
+    @classmethod
+    def get_database(cls, sh_kwargs):
+        """ Return the Database shared by all the commands for sh_kwargs """
+
+        key = (sh_kwargs['user'], sh_kwargs['host'], sh_kwargs['database'])
+        with cls.DATABASES_LOCK:
+            if key not in cls.databases:
+                cls.databases[key] = Database(**sh_kwargs)
+            return cls.databases[key]
+
+    def __get_command(self, command_cls):
+        if command_cls not in self.commands:
+            shared_command_cls = type(command_cls.__name__, (SharedDatabaseCommand, command_cls),
+                                      {'shared_db': self.get_database(self.sh_kwargs)})
+            # Unify names its recovery file with the port, use the default one of the CLI
+            command_kwargs = dict(self.sh_kwargs)
+            if command_kwargs['port'] is None:
+                command_kwargs['port'] = SORTINGHAT_CLI_PORT
+            self.commands[command_cls] = shared_command_cls(**command_kwargs)
+        return self.commands[command_cls]
+
+    def __build_cli_command(self):
+        return ['sortinghat', '-u', self.sh_kwargs['user'], '-p', self.sh_kwargs['password'],
+                '--host', self.sh_kwargs['host'], '-d', self.sh_kwargs['database']]
+
+    def __execute_cli_command(self, cmd):
+        logger.debug("Executing %s", cmd)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        outs, errs = proc.communicate()
+        if proc.returncode != 0:
+            logger.error("[sortinghat] Error in command %s", cmd)
+        return proc.returncode
+
+    def __execute(self, command_cls, method, args, kwargs, cli_args):
+        if self.inprocess:
+            try:
+                command = self.__get_command(command_cls)
+            except Exception as ex:
+                command = None
+                logger.warning("[sortinghat] Can not create %s in process, using the CLI: %s", method, ex)
+
+            if command is not None:
+                # the errors once the command runs are reported, as it could be partly applied
+                try:
+                    code = getattr(command, method)(*args, **kwargs)
+                except Exception as ex:
+                    logger.error("[sortinghat] Error in command %s %s: %s", method, cli_args, ex, exc_info=ex)
+                    return CMD_FAILURE
+                if code != CMD_SUCCESS:
+                    logger.error("[sortinghat] Error in command %s %s", method, cli_args)
+                return code
+
+        return self.__execute_cli_command(self.__build_cli_command() + cli_args)
+
+    def unify(self, matching, strict_mapping, snapshot=None):
+        """ Merge all the unique identities matching with the matching algorithm
+
+        When the commands are executed in process and a snapshot of the
+        unique identities is given, the identities are matched with it
+        instead of loading them all again. Otherwise the Unify command is
+        executed, and the snapshot is loaded again when it is needed.
+        """
+        if self.inprocess and snapshot is not None:
+            try:
+                merged = self.__merge_matching(matching, strict_mapping, snapshot)
+                logger.info("[sortinghat] Unify with %s: %i merged", matching, merged)
+                return CMD_SUCCESS
+            except NotImplementedError:
+                logger.info("[sortinghat] Matching %s can not be done in the identities snapshot", matching)
+            except Exception as ex:
+                # some identities could be merged already, the unify is not run again
+                logger.error("[sortinghat] Unify with %s in the identities snapshot failed: %s",
+                             matching, ex, exc_info=ex)
+                snapshot.invalidate()
+                return CMD_FAILURE
+
+        cli_args = ['unify', '--fast-matching', '-m', matching]
+        if not strict_mapping:
+            cli_args += ['--no-strict-matching']
+        code = self.__execute(Unify, 'unify', [],
+                              {'matching': matching, 'fast_matching': True,
+                               'no_strict_matching': not strict_mapping},
+                              cli_args)
+        if snapshot is not None:
+            snapshot.invalidate()
+        return code
+
+    def modified_unique_identities(self, after):
+        """ Return the uuids of the unique identities modified on or after a date """
+
+        return api.search_last_modified_unique_identities(self.get_database(self.sh_kwargs), after)
+
+    @staticmethod
+    def __merge_matching(matching, strict_mapping, snapshot, uuids=None):
+        """ Merge the unique identities of the snapshot matching the ones in uuids, or all of them if None
+
+        The values of the matching criteria of the identities are indexed in
+        the snapshot, and only the identities reachable from uuids through
+        them are merged.
+
+        :returns: the number of merged unique identities
+        :raises NotImplementedError: when the matching has no criteria for the fast mode
+        """
+        blacklist = api.blacklist(snapshot.db)
+        matcher = create_identity_matcher(matching, blacklist, None, strict_mapping)
+        matching_key = (matching, strict_mapping, tuple(sorted([mb.excluded for mb in blacklist])))
+        index, keys = snapshot.get_index(matching_key, matcher)
+
+        if uuids is None:
+            uuids = sorted(keys)
+
+        visited = set()
+        merged = 0
+        for uuid in uuids:
+            if uuid in visited or uuid not in keys:
+                continue
+            # all the identities matching transitively the modified one
+            group = set([uuid])
+            pending = [uuid]
+            while pending:
+                for key in keys.get(pending.pop(), []):
+                    for match in index[key] - group:
+                        group.add(match)
+                        pending.append(match)
+            visited |= group
+
+            if len(group) > 1:
+                group = sorted(group)
+                snapshot.merge(group[1:], group[0])
+                merged += len(group) - 1
+
+        return merged
+
+    def unify_incremental(self, matching, strict_mapping, uuids, snapshot=None):
+        """ Merge the unique identities in uuids with the identities matching them
+
+        Only the identities reachable from uuids through the values of the
+        matching criteria are merged. The rest of identities were already
+        unified in previous executions, so they are not matched again. If the
+        snapshot is kept between executions, only the identities in uuids must
+        be refreshed in it before. A full unify is done when the matching has
+        no criteria for the fast mode. When the incremental unify fails, it is
+        reported and not replayed, as some identities could be merged already;
+        the next execution unifies again the identities modified since the
+        last successful unify.
+        """
+        if snapshot is None:
+            snapshot = IdentitiesSnapshot(self.get_database(self.sh_kwargs))
+        try:
+            merged = self.__merge_matching(matching, strict_mapping, snapshot, uuids)
+        except NotImplementedError:
+            logger.info("[sortinghat] Matching %s can not be done incrementally", matching)
+            return self.unify(matching, strict_mapping, snapshot)
+        except Exception as ex:
+            logger.error("[sortinghat] Incremental unify with %s failed: %s", matching, ex, exc_info=ex)
+            snapshot.invalidate()
+            return CMD_FAILURE
+
+        logger.info("[sortinghat] Incremental unify with %s: %i modified identities, %i merged",
+                    matching, len(uuids), merged)
+
+        return CMD_SUCCESS
+
+    def affiliate(self):
+        return self.__execute(Affiliate, 'affiliate', [], {}, ['affiliate'])
+
+    def autoprofile(self, sources):
+        return self.__execute(AutoProfile, 'autocomplete', [sources], {}, ['autoprofile'] + sources)
+
+    def autogender(self):
+        return self.__execute(AutoGender, 'autogender', [], {}, ['autogender'])
+
 
 class TaskInitSortingHat(Task):
     """ Class aimed to create the SH database """
@@ -109,12 +425,17 @@ class TaskIdentitiesCollection(Task):
 
 
 class TaskIdentitiesLoad(Task):
+
+    IDENTITIES_FETCH_WORKERS = 4  # identities files fetched in parallel
+
     def __init__(self, config):
         super().__init__(config)
 
         self.sh_kwargs = {'user': self.db_user, 'password': self.db_password,
                           'database': self.db_sh, 'host': self.db_host,
                           'port': None}
+        self.sh_commands = SortingHatCommands(self.sh_kwargs, self.conf['sortinghat']['inprocess'])
+        self.identities_versions = {}  # identities file -> blob SHA or content hash of its last load
 
     def is_backend_task(self):
         return False
@@ -152,49 +473,97 @@ class TaskIdentitiesLoad(Task):
             if code != CMD_SUCCESS:
                 logger.error("[sortinghat] Error loading %s", filename)
             logger.info("[sortinghat] End of loading identities from file %s", filename)
+            return code
+
+        def fetch_identities_file(config, filename):
+            """
+            Get the version of an identities file, and its content if it is remote
+
+            The version is the blob SHA of the remote files and the hash of the
+            content of the local ones. The content of a remote file is not
+            downloaded if its version is the one already loaded.
+
+            :returns: tuple with the version and the content, None if not downloaded
+            """
+            if not is_remote(filename):
+                with open(filename, 'rb') as f:
+                    return hashlib.sha256(f.read()).hexdigest(), None
+
+            # Use the GitHub Data API to get the file
+            # First we need the SHA for this file
+            # https://github.com/<owner>/<repo>/blob/<branch>/<sh_identities>
+            repo_file = filename.rsplit("/", 1)[1]
+            repository_raw = filename.rsplit("/", 1)[0]
+            repository = repository_raw.rsplit("/", 2)[0]
+            repository_api = repository.replace('github.com', 'api.github.com/repos')
+            # repository_type = repository_raw.rsplit("/", 2)[1]
+            repository_branch = repository_raw.rsplit("/", 2)[2]
+            repo_file_sha = \
+                TaskIdentitiesExport.sha_github_file(config, repo_file,
+                                                     repository_api, repository_branch)
+            if not repo_file_sha:
+                logger.error("Can't find identities file %s. Not loading identities", filename)
+                return None, None
+            if self.identities_versions.get(filename) == repo_file_sha:
+                return repo_file_sha, None
+
+            file_url = repository_api + "/git/blobs/" + repo_file_sha
+            headers = {"Authorization": "token " + config.get_conf()['sortinghat']['identities_api_token']}
+            res = requests.get(file_url, headers=headers)
+            res.raise_for_status()
+            return repo_file_sha, base64.b64decode(res.json()['content'])
 
         def load_sortinghat_identities(config):
-            """ Load identities from a file in SortingHat JSON format """
+            """ Load identities from files in SortingHat JSON format
+
+            The files not changed since their last load are not loaded again.
+            The files are fetched in parallel and loaded in order.
 
+            :returns: number of files loaded
+            """
             cfg = config.get_conf()
 
-            filenames = cfg['sortinghat']['identities_file']
-            api_token = cfg['sortinghat']['identities_api_token']
-            for filename in filenames:
-                filename = filename.replace(' ', '')  # spaces used in config file list
-                if filename == '':
+            def fetch(filename):
+                try:
+                    return fetch_identities_file(config, filename)
+                except IndexError as ex:
+                    logger.error("Can not load identities from: %s", filename)
+                    logger.debug("Expected format: https://github.com/owner/repo/blob/master/file")
+                    logger.debug(ex)
+                except Exception as ex:
+                    logger.error("Can not get identities file %s: %s", filename, ex)
+                return None, None
+
+            filenames = [filename.replace(' ', '')  # spaces used in config file list
+                         for filename in cfg['sortinghat']['identities_file']]
+            filenames = [filename for filename in filenames if filename != '']
+
+            with ThreadPoolExecutor(max_workers=self.IDENTITIES_FETCH_WORKERS) as executor:
+                fetched = list(executor.map(fetch, filenames))
+
+            loaded = 0
+            for filename, (version, content) in zip(filenames, fetched):
+                if version is None:
+                    continue
+                if self.identities_versions.get(filename) == version:
+                    logger.info("[sortinghat] Identities file %s not changed. Not loading it.", filename)
                     continue
-                if is_remote(filename):
-                    # Use the GitHub Data API to get the file
-                    # First we need the SHA for this file
-                    try:
-                        # https://github.com/<owner>/<repo>/blob/<branch>/<sh_identities>
-                        repo_file = filename.rsplit("/", 1)[1]
-                        repository_raw = filename.rsplit("/", 1)[0]
-                        repository = repository_raw.rsplit("/", 2)[0]
-                        repository_api = repository.replace('github.com', 'api.github.com/repos')
-                        # repository_type = repository_raw.rsplit("/", 2)[1]
-                        repository_branch = repository_raw.rsplit("/", 2)[2]
-                        repo_file_sha = \
-                            TaskIdentitiesExport.sha_github_file(config, repo_file,
-                                                                 repository_api, repository_branch)
-                        if not repo_file_sha:
-                            logger.error("Can't find identities file %s. Not loading identities", filename)
-                            return
-                        file_url = repository_api + "/git/blobs/" + repo_file_sha
-                        headers = {"Authorization": "token " + api_token}
-                        res = requests.get(file_url, headers=headers)
-                        res.raise_for_status()
-                        with tempfile.NamedTemporaryFile() as temp:
-                            temp.write(base64.b64decode(res.json()['content']))
-                            temp.flush()
-                            load_identities_file(temp.name, cfg['sortinghat']['reset_on_load'])
-                    except IndexError as ex:
-                        logger.error("Can not load identities from: %s", filename)
-                        logger.debug("Expected format: https://github.com/owner/repo/blob/master/file")
-                        logger.debug(ex)
+
+                load_start = time.time()
+                if content is None:
+                    code = load_identities_file(filename, cfg['sortinghat']['reset_on_load'])
                 else:
-                    load_identities_file(filename, cfg['sortinghat']['reset_on_load'])
+                    with tempfile.NamedTemporaryFile() as temp:
+                        temp.write(content)
+                        temp.flush()
+                        code = load_identities_file(temp.name, cfg['sortinghat']['reset_on_load'])
+                logger.info("[sortinghat] Identities file %s loaded in %0.2fs", filename, time.time() - load_start)
+
+                if code == CMD_SUCCESS:
+                    self.identities_versions[filename] = version
+                    loaded += 1
+
+            return loaded
 
         def load_grimoirelab_identities(config):
             """ Load identities from files in GrimoireLab YAML format """
@@ -243,64 +612,96 @@ class TaskIdentitiesLoad(Task):
 
                 os.remove(json_identities)
 
-        # ** START SYNC LOGIC **
-        # Check that enrichment tasks are not active before loading identities
-        while True:
-            time.sleep(1)  # check each second if the identities load could start
-            with TasksManager.IDENTITIES_TASKS_ON_LOCK:
-                with TasksManager.NUMBER_ENRICH_TASKS_ON_LOCK:
-                    enrich_tasks = TasksManager.NUMBER_ENRICH_TASKS_ON
-                    logger.debug("[load identities] Enrich tasks active: %i", enrich_tasks)
-                    if enrich_tasks == 0:
-                        # The load of identities can be started
-                        TasksManager.IDENTITIES_TASKS_ON = True
-                        break
-        #  ** END SYNC LOGIC **
-
-        cfg = self.config.get_conf()
+        # Enrichment tasks must not be active while loading identities
+        with TasksManager.IDENTITIES_GATE.write(self.backend_section):
+            cfg = self.config.get_conf()
 
-        # code = 0 when command success
-        code = Init(**self.sh_kwargs).run(self.db_sh, '--reuse')
+            # code = 0 when command success
+            code = Init(**self.sh_kwargs).run(self.db_sh, '--reuse')
 
-        # Basic loading of organizations from a SH JSON file. Legacy stuff.
-        if 'load_orgs' in cfg['sortinghat'] and cfg['sortinghat']['load_orgs']:
-            if 'orgs_file' not in cfg['sortinghat'] or not cfg['sortinghat']['orgs_file']:
-                logger.error("Load orgs active but no orgs_file configured")
-            elif not os.path.exists(cfg['sortinghat']['orgs_file']):
-                logger.error("Orgs file not found on disk")
-            else:
-                logger.info("[sortinghat] Loading orgs from file %s", cfg['sortinghat']['orgs_file'])
-                code = Load(**self.sh_kwargs).run("--orgs", cfg['sortinghat']['orgs_file'])
-                if code != CMD_SUCCESS:
-                    logger.error("[sortinghat] Error loading %s", cfg['sortinghat']['orgs_file'])
-                # FIXME get the number of loaded orgs
-
-        # Identities loading from files. It could be in several formats.
-        # Right now GrimoireLab and SortingHat formats are supported
-        if 'identities_file' in cfg['sortinghat']:
-            try:
+            # Basic loading of organizations from a SH JSON file. Legacy stuff.
+            if 'load_orgs' in cfg['sortinghat'] and cfg['sortinghat']['load_orgs']:
+                if 'orgs_file' not in cfg['sortinghat'] or not cfg['sortinghat']['orgs_file']:
+                    logger.error("Load orgs active but no orgs_file configured")
+                elif not os.path.exists(cfg['sortinghat']['orgs_file']):
+                    logger.error("Orgs file not found on disk")
+                else:
+                    logger.info("[sortinghat] Loading orgs from file %s", cfg['sortinghat']['orgs_file'])
+                    code = Load(**self.sh_kwargs).run("--orgs", cfg['sortinghat']['orgs_file'])
+                    if code != CMD_SUCCESS:
+                        logger.error("[sortinghat] Error loading %s", cfg['sortinghat']['orgs_file'])
+                    # FIXME get the number of loaded orgs
+
+            # Identities loading from files. It could be in several formats.
+            # Right now GrimoireLab and SortingHat formats are supported
+            if 'identities_file' in cfg['sortinghat']:
                 if cfg['sortinghat']['identities_format'] == 'sortinghat':
-                    load_sortinghat_identities(self.config)
+                    if not load_sortinghat_identities(self.config):
+                        logger.info("[sortinghat] No identities files loaded. Skipping unify.")
+                        return
                 elif cfg['sortinghat']['identities_format'] == 'grimoirelab':
                     load_grimoirelab_identities(self.config)
-            except Exception:
-                with TasksManager.IDENTITIES_TASKS_ON_LOCK:
-                    TasksManager.IDENTITIES_TASKS_ON = False
-                raise
-            # After loading the identities we need to unify in order
-            # to mix the identites loaded with then ones from data sources
-            cmd = ['sortinghat', '-u', self.db_user, '-p', self.db_password,
-                   '--host', self.db_host, '-d', self.db_sh]
-            cmd += ['unify', '--fast-matching']
-            for algo in cfg['sortinghat']['matching']:
-                ucmd = cmd + ['-m', algo]
-                if not cfg['sortinghat']['strict_mapping']:
-                    ucmd += ['--no-strict-matching']
-                logger.debug("Doing unify after identities load")
-                self.__execute_command(ucmd)
-
-        with TasksManager.IDENTITIES_TASKS_ON_LOCK:
-            TasksManager.IDENTITIES_TASKS_ON = False
+                # After loading the identities we need to unify in order
+                # to mix the identites loaded with then ones from data sources
+                for algo in cfg['sortinghat']['matching']:
+                    logger.debug("Doing unify after identities load")
+                    self.sh_commands.unify(algo, cfg['sortinghat']['strict_mapping'])
+
+
+class GitHubContentBody():
+    """
+    File like JSON body to upload a file with the GitHub contents API
+
+    The file is base64 encoded while the body is read, so the request is
+    sent without loading the whole file, nor its encoding, in memory.
+    """
+
+    CHUNK_SIZE = 3 * 8192  # multiple of 3, so only the last chunk is padded
+
+    def __init__(self, fileobj, message, sha=None):
+        fileobj.seek(0, os.SEEK_END)
+        file_size = fileobj.tell()
+        fileobj.seek(0)
+
+        fields = {"message": message}
+        if sha:
+            fields["sha"] = sha
+        prefix = (json.dumps(fields)[:-1] + ', "content": "').encode('ascii')
+        suffix = b'"}'
+
+        self.length = len(prefix) + 4 * ((file_size + 2) // 3) + len(suffix)
+        self.parts = self.__read_parts(fileobj, prefix, suffix)
+        self.buffer = b''
+
+    def __read_parts(self, fileobj, prefix, suffix):
+        yield prefix
+        chunk = fileobj.read(self.CHUNK_SIZE)
+        while chunk:
+            yield base64.b64encode(chunk)
+            chunk = fileobj.read(self.CHUNK_SIZE)
+        yield suffix
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        data = self.read(self.CHUNK_SIZE)
+        while data:
+            yield data
+            data = self.read(self.CHUNK_SIZE)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            part = next(self.parts, None)
+            if part is None:
+                break
+            self.buffer += part
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
 
 
 class TaskIdentitiesExport(Task):
@@ -310,6 +711,7 @@ class TaskIdentitiesExport(Task):
         self.sh_kwargs = {'user': self.db_user, 'password': self.db_password,
                           'database': self.db_sh, 'host': self.db_host,
                           'port': None}
+        self.last_export = None  # (hash of the last exported identities, blob SHA of their upload)
 
     def is_backend_task(self):
         return False
@@ -336,6 +738,67 @@ class TaskIdentitiesExport(Task):
 
         return repo_file_sha
 
+    @staticmethod
+    def update_identities_hash(content_hash, line):
+        """ Add a line of the exported identities to their content hash, skipping the export time """
+
+        if not line.startswith(b'    "time": '):
+            content_hash.update(line)
+
+    @classmethod
+    def gzip_identities(cls, identities_file, gzipped_identities_file):
+        """ Compress the exported identities, returning the hash of their content
+
+        The export time is not part of the content hash, so the hash only
+        changes when the identities change. The gzip file has no name nor
+        mtime in its header, so the same identities are compressed to the
+        same file.
+        """
+        content_hash = hashlib.sha256()
+
+        with open(identities_file, 'rb') as f_in, open(gzipped_identities_file, 'wb') as f_out:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f_out, mtime=0) as f_gzip:
+                for line in f_in:
+                    f_gzip.write(line)
+                    cls.update_identities_hash(content_hash, line)
+
+        return content_hash.hexdigest()
+
+    @classmethod
+    def hash_github_identities(cls, config, repository_api, repo_file_sha):
+        """ Return the hash of the content of the gzipped identities in a GitHub blob
+
+        The hash is the same returned by gzip_identities, so the identities
+        exported again, with a new export time, are compared with the ones
+        already uploaded.
+        """
+        github_token = config.get_conf()['sortinghat']['identities_api_token']
+        headers = {"Authorization": "token " + github_token}
+
+        file_url = repository_api + "/git/blobs/" + repo_file_sha
+        res = requests.get(file_url, headers=headers)
+        res.raise_for_status()
+
+        content_hash = hashlib.sha256()
+        gzipped_identities = io.BytesIO(base64.b64decode(res.json()['content']))
+        with gzip.GzipFile(fileobj=gzipped_identities, mode='rb') as f_gzip:
+            for line in f_gzip:
+                cls.update_identities_hash(content_hash, line)
+
+        return content_hash.hexdigest()
+
+    @staticmethod
+    def git_blob_sha(filename):
+        """ Return the SHA of the git blob with the contents of filename """
+
+        blob_sha = hashlib.sha1()
+        blob_sha.update(b"blob %d\0" % os.path.getsize(filename))
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(GitHubContentBody.CHUNK_SIZE), b''):
+                blob_sha.update(chunk)
+
+        return blob_sha.hexdigest()
+
     def execute(self):
 
         def export_identities(filename):
@@ -344,6 +807,7 @@ class TaskIdentitiesExport(Task):
             code = Export(**self.sh_kwargs).run("--identities", filename)
             if code != CMD_SUCCESS:
                 logger.error("[sortinghat] Error exporting %s", filename)
+            return code == CMD_SUCCESS
 
         cfg = self.config.get_conf()
 
@@ -354,8 +818,6 @@ class TaskIdentitiesExport(Task):
             logger.error("identities_api_token for uploading data to GitHub not found in sortinghat section")
             return
 
-        repo_file_sha = None
-        gzipped_identities_file = None
         github_token = cfg['sortinghat']['identities_api_token']
         headers = {"Authorization": "token " + github_token}
 
@@ -375,39 +837,44 @@ class TaskIdentitiesExport(Task):
 
             return
 
-        with tempfile.NamedTemporaryFile() as temp:
-            export_identities(temp.name)
-            logger.debug("SH identities exported to tmp file: %s", temp.name)
-            # Compress the file with gzip
-            with open(temp.name, 'rb') as f_in:
-                gzipped_identities_file = temp.name + '.gz'
-                with gzip.open(gzipped_identities_file, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+        # The temp dir, with the export and its gzip, is removed on exit
+        with tempfile.TemporaryDirectory() as temp_dir:
+            identities_file = os.path.join(temp_dir, 'identities.json')
+            gzipped_identities_file = identities_file + '.gz'
+
+            if not export_identities(identities_file):
+                return
+            logger.debug("SH identities exported to tmp file: %s", identities_file)
+            identities_hash = self.gzip_identities(identities_file, gzipped_identities_file)
+
             # Get sha for the repository_file
             repo_file_sha = self.sha_github_file(self.config, repo_file,
                                                  repository_api, repository_branch)
             if repo_file_sha is None:
                 logger.debug("Can not find sha for %s. It will be created.", repository_url)
+            elif self.last_export == (identities_hash, repo_file_sha):
+                logger.info("[sortinghat] Identities not changed since their last export to %s", repository_url)
+                return
+            elif self.last_export is None or self.last_export[1] != repo_file_sha:
+                # the remote file is unknown, e.g. after a restart, its identities
+                # are compared without the export time, which changes in each export
+                if self.hash_github_identities(self.config, repository_api, repo_file_sha) == identities_hash:
+                    logger.info("[sortinghat] Identities already exported to %s", repository_url)
+                    self.last_export = (identities_hash, repo_file_sha)
+                    return
+
+            blob_sha = self.git_blob_sha(gzipped_identities_file)
 
-            # Upload gzipped file to repository_file
-            logger.debug("Encoding to base64 identities file")
+            # Upload gzipped file to repository_file, base64 encoded while it is sent
             with open(gzipped_identities_file, "rb") as raw_file:
-                base64_raw = base64.b64encode(raw_file.read())
-                # base64 is ascii encoded data
-                gzipped_base64_identities = base64_raw.decode('ascii')
-                upload_json = {
-                    "content": gzipped_base64_identities,
-                    "message": "sirmordred automatic update"
-                }
-                if repo_file_sha:
-                    upload_json["sha"] = repo_file_sha
-
-                data = json.dumps(upload_json)
+                data = GitHubContentBody(raw_file, "sirmordred automatic update", repo_file_sha)
                 url_put = repository_api + "/contents/" + repo_file
                 logger.debug("Uploading to GitHub %s", url_put)
                 upload_res = requests.put(url_put, headers=headers, data=data)
                 upload_res.raise_for_status()
 
+            self.last_export = (identities_hash, blob_sha)
+
 
 class TaskIdentitiesMerge(Task):
     """ Task for processing identities in SortingHat """
@@ -418,147 +885,160 @@ class TaskIdentitiesMerge(Task):
         self.sh_kwargs = {'user': self.db_user, 'password': self.db_password,
                           'database': self.db_sh, 'host': self.db_host,
                           'port': None}
-        self.db = Database(**self.sh_kwargs)
-        self.last_autorefresh = datetime.utcnow()  # Last autorefresh date
+        self.db = SortingHatCommands.get_database(self.sh_kwargs)
+        self.sh_commands = SortingHatCommands(self.sh_kwargs, self.conf['sortinghat']['inprocess'])
+        self.last_unify = None  # Start date of the last successful unify
+        # unique identities kept between the incremental unifies
+        self.snapshot = IdentitiesSnapshot(self.db)
+        self.last_bots_state = None  # uuids of the bots and no bots in the last execution
 
     def is_backend_task(self):
         return False
 
-    def __get_uuids_from_profile_name(self, profile_name):
-        """ Get the uuid for a profile name """
-        uuids = []
+    def __get_profiles_from_names(self, profile_names):
+        """ Get the uuid, name and bot flag of the profiles with any of the names, with a single query """
+
+        if not profile_names:
+            return []
 
         with self.db.connect() as session:
-            query = session.query(Profile).\
-                filter(Profile.name == profile_name)
-            profiles = query.all()
-            if profiles:
-                for p in profiles:
-                    uuids.append(p.uuid)
-        return uuids
-
-    def __build_sh_command(self):
-        cfg = self.config.get_conf()
+            query = session.query(Profile.uuid, Profile.name, Profile.is_bot).\
+                filter(Profile.name.in_(profile_names))
+            profiles = [(p.uuid, p.name, p.is_bot) for p in query.all()]
+        return profiles
 
-        db_user = cfg['sortinghat']['user']
-        db_password = cfg['sortinghat']['password']
-        db_host = cfg['sortinghat']['host']
-        db_name = cfg['sortinghat']['database']
-        cmd = ['sortinghat', '-u', db_user, '-p', db_password, '--host', db_host,
-               '-d', db_name]
+    def __set_bots(self, uuids, is_bot):
+        """ Set the bot flag of the profiles of uuids with a single update """
 
-        return cmd
+        if not uuids:
+            return
 
-    def __execute_sh_command(self, cmd):
-        logger.debug("Executing %s", cmd)
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        outs, errs = proc.communicate()
-        return_code = proc.returncode
-        if return_code != 0:
-            logger.error("[sortinghat] Error in command %s", cmd)
-        return return_code
+        with self.db.connect() as session:
+            session.query(Profile).\
+                filter(Profile.uuid.in_(uuids)).\
+                update({Profile.is_bot: is_bot}, synchronize_session=False)
+            # as api.edit_profile does, so the change is refreshed in the enriched data
+            session.query(UniqueIdentity).\
+                filter(UniqueIdentity.uuid.in_(uuids)).\
+                update({UniqueIdentity.last_modified: datetime.utcnow()}, synchronize_session=False)
+
+    def do_bots(self, bots_names, no_bots_names):
+        """ Mark as bots the profiles in bots_names and unmark the ones in no_bots_names
+
+        The profiles are updated only when the names or the profiles matching
+        them changed since the last execution, and only the profiles with a
+        different bot flag are updated.
+        """
+        profiles = self.__get_profiles_from_names(list(set(bots_names) | set(no_bots_names)))
+
+        no_bots = set([uuid for uuid, name, _ in profiles if name in no_bots_names])
+        bots = set([uuid for uuid, name, _ in profiles if name in bots_names]) - no_bots
+        bots_state = (bots, no_bots)
+        if bots_state == self.last_bots_state:
+            logger.debug("[sortinghat] Bots not changed. Skipping.")
+            return
+
+        new_bots = set([uuid for uuid, _, is_bot in profiles if uuid in bots and not is_bot])
+        new_no_bots = set([uuid for uuid, _, is_bot in profiles if uuid in no_bots and is_bot is not False])
+        self.__set_bots(sorted(new_bots), True)
+        self.__set_bots(sorted(new_no_bots), False)
+        logger.info("[sortinghat] %i profiles marked as bots, %i unmarked", len(new_bots), len(new_no_bots))
+
+        self.last_bots_state = bots_state
 
     def do_affiliate(self):
-        cmd = self.__build_sh_command()
-        cmd += ['affiliate']
-        self.__execute_sh_command(cmd)
+        self.sh_commands.affiliate()
         return
 
     def do_autogender(self):
-        cmd = self.__build_sh_command()
-        cmd += ['autogender']
-        self.__execute_sh_command(cmd)
+        self.sh_commands.autogender()
         return None
 
     def do_autoprofile(self, sources):
-        cmd = self.__build_sh_command()
-        cmd += ['autoprofile'] + sources
-        self.__execute_sh_command(cmd)
+        self.sh_commands.autoprofile(sources)
         return None
 
     def do_unify(self, kwargs):
-        cmd = self.__build_sh_command()
-        cmd += ['unify', '--fast-matching', '-m', kwargs['matching']]
-        if not kwargs['strict_mapping']:
-            cmd += ['--no-strict-matching']
-        self.__execute_sh_command(cmd)
-        return
+        if kwargs.get('uuids') is not None:
+            return self.sh_commands.unify_incremental(kwargs['matching'], kwargs['strict_mapping'],
+                                                      kwargs['uuids'], kwargs.get('snapshot'))
+        return self.sh_commands.unify(kwargs['matching'], kwargs['strict_mapping'], kwargs.get('snapshot'))
 
     def execute(self):
 
-        # ** START SYNC LOGIC **
-        # Check that enrichment tasks are not active before loading identities
-        while True:
-            time.sleep(1)  # check each second if the task could start
-            with TasksManager.IDENTITIES_TASKS_ON_LOCK:
-                with TasksManager.NUMBER_ENRICH_TASKS_ON_LOCK:
-                    enrich_tasks = TasksManager.NUMBER_ENRICH_TASKS_ON
-                    logger.debug("[unify] Enrich tasks active: %i", enrich_tasks)
-                    if enrich_tasks == 0:
-                        # The load of identities can be started
-                        TasksManager.IDENTITIES_TASKS_ON = True
-                        break
-        #  ** END SYNC LOGIC **
+        # Enrichment tasks must not be active while processing identities
+        with TasksManager.IDENTITIES_GATE.write(self.backend_section):
+            cfg = self.config.get_conf()
 
-        cfg = self.config.get_conf()
+            uuids_refresh = []
 
-        uuids_refresh = []
+            # Only the identities modified since the last unify are unified incrementally
+            unify_start = datetime.utcnow()
+            modified_uuids = None
+            if cfg['sortinghat']['incremental_unify'] and self.last_unify:
+                modified_uuids = self.sh_commands.modified_unique_identities(self.last_unify)
 
-        for algo in cfg['sortinghat']['matching']:
-            if not algo:
-                # cfg['sortinghat']['matching'] is an empty list
-                logger.debug('Unify not executed because empty algorithm')
-                continue
-            kwargs = {'matching': algo, 'fast_matching': True,
-                      'strict_mapping': cfg['sortinghat']['strict_mapping']}
-            logger.info("[sortinghat] Unifying identities using algorithm %s",
-                        kwargs['matching'])
-            self.do_unify(kwargs)
-
-        if not cfg['sortinghat']['affiliate']:
-            logger.debug("Not doing affiliation")
-        else:
-            # Global enrollments using domains
-            logger.info("[sortinghat] Executing affiliate")
-            self.do_affiliate()
-
-        if 'autoprofile' not in cfg['sortinghat'] or \
-                not cfg['sortinghat']['autoprofile'][0]:
-            logger.info("[sortinghat] Autoprofile not configured. Skipping.")
-        else:
-            logger.info("[sortinghat] Executing autoprofile for sources: %s",
-                        cfg['sortinghat']['autoprofile'])
-            sources = cfg['sortinghat']['autoprofile']
-            self.do_autoprofile(sources)
-
-        if 'autogender' not in cfg['sortinghat'] or \
-                not cfg['sortinghat']['autogender']:
-            logger.info("[sortinghat] Autogender not configured. Skipping.")
-        else:
-            logger.info("[sortinghat] Executing autogender")
-            self.do_autogender()
-
-        if 'bots_names' not in cfg['sortinghat']:
-            logger.info("[sortinghat] Bots name list not configured. Skipping.")
-        else:
-            logger.info("[sortinghat] Marking bots: %s",
-                        cfg['sortinghat']['bots_names'])
-            for name in cfg['sortinghat']['bots_names']:
-                # First we need the uuids for the profile name
-                uuids = self.__get_uuids_from_profile_name(name)
-                # Then we can modify the profile setting bot flag
-                profile = {"is_bot": True}
-                for uuid in uuids:
-                    api.edit_profile(self.db, uuid, **profile)
-            # For quitting the bot flag - debug feature
-            if 'no_bots_names' in cfg['sortinghat']:
-                logger.info("[sortinghat] Removing Marking bots: %s",
-                            cfg['sortinghat']['no_bots_names'])
-                for name in cfg['sortinghat']['no_bots_names']:
-                    uuids = self.__get_uuids_from_profile_name(name)
-                    profile = {"is_bot": False}
-                    for uuid in uuids:
-                        api.edit_profile(self.db, uuid, **profile)
-
-        with TasksManager.IDENTITIES_TASKS_ON_LOCK:
-            TasksManager.IDENTITIES_TASKS_ON = False
+            if modified_uuids == []:
+                logger.info("[sortinghat] No identities modified since %s. Skipping unify.", self.last_unify)
+            else:
+                unified = True
+                merged = False
+                # the unique identities are loaded once for all the algorithms, and
+                # the incremental unify only loads again the modified ones
+                if modified_uuids is None:
+                    self.snapshot.invalidate()
+                else:
+                    self.snapshot.refresh(modified_uuids)
+                for algo in cfg['sortinghat']['matching']:
+                    if not algo:
+                        # cfg['sortinghat']['matching'] is an empty list
+                        logger.debug('Unify not executed because empty algorithm')
+                        continue
+                    if merged and modified_uuids is not None:
+                        # The previous algorithm removed the merged identities and
+                        # modified the ones they were merged into
+                        modified_uuids = self.sh_commands.modified_unique_identities(self.last_unify)
+                    merged = True
+                    kwargs = {'matching': algo, 'fast_matching': True,
+                              'strict_mapping': cfg['sortinghat']['strict_mapping'],
+                              'uuids': modified_uuids, 'snapshot': self.snapshot}
+                    logger.info("[sortinghat] Unifying identities using algorithm %s",
+                                kwargs['matching'])
+                    if self.do_unify(kwargs) != CMD_SUCCESS:
+                        unified = False
+                if unified:
+                    self.last_unify = unify_start
+
+            if not cfg['sortinghat']['affiliate']:
+                logger.debug("Not doing affiliation")
+            else:
+                # Global enrollments using domains
+                logger.info("[sortinghat] Executing affiliate")
+                self.do_affiliate()
+
+            if 'autoprofile' not in cfg['sortinghat'] or \
+                    not cfg['sortinghat']['autoprofile'][0]:
+                logger.info("[sortinghat] Autoprofile not configured. Skipping.")
+            else:
+                logger.info("[sortinghat] Executing autoprofile for sources: %s",
+                            cfg['sortinghat']['autoprofile'])
+                sources = cfg['sortinghat']['autoprofile']
+                self.do_autoprofile(sources)
+
+            if 'autogender' not in cfg['sortinghat'] or \
+                    not cfg['sortinghat']['autogender']:
+                logger.info("[sortinghat] Autogender not configured. Skipping.")
+            else:
+                logger.info("[sortinghat] Executing autogender")
+                self.do_autogender()
+
+            if 'bots_names' not in cfg['sortinghat']:
+                logger.info("[sortinghat] Bots name list not configured. Skipping.")
+            else:
+                logger.info("[sortinghat] Marking bots: %s",
+                            cfg['sortinghat']['bots_names'])
+                # For quitting the bot flag - debug feature
+                no_bots_names = cfg['sortinghat'].get('no_bots_names', [])
+                if no_bots_names:
+                    logger.info("[sortinghat] Removing Marking bots: %s", no_bots_names)
+                self.do_bots(cfg['sortinghat']['bots_names'], no_bots_names)
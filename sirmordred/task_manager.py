@@ -22,15 +22,295 @@
 #     Alvaro del Castillo <acs@bitergia.com>
 #
 
+import importlib
+import json
 import logging
+import multiprocessing
+import os
+import pickle
 import queue
 import threading
 import sys
 import time
+import traceback
+
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.sharedctypes import RawValue
 
 logger = logging.getLogger(__name__)
 
 
+class PhaseGate():
+    """
+    Readers/writer gate to coordinate the enrichment and identities phases
+
+    Enrichment tasks enter the gate as readers, so several of them can run
+    at the same time. Identities tasks enter as writers, so they run alone
+    once all the active readers have left. Waiting writers are preferred
+    over new readers, but a reader which has waited for more than
+    `max_reader_wait` seconds is let in as soon as no writer is active,
+    so a steady stream of identities tasks can not starve the enrichment.
+
+    Tasks block on a condition variable and are woken up as soon as the
+    gate state changes, instead of polling it.
+    """
+
+    MAX_READER_WAIT = 300  # max seconds a reader gives way to waiting writers
+
+    def __init__(self, max_reader_wait=MAX_READER_WAIT):
+        self.max_reader_wait = max_reader_wait
+        self._cond = threading.Condition()
+        # the state is kept in ctypes values so it can be shared between processes
+        self._readers = RawValue('i', 0)
+        self._writer = RawValue('b', False)
+        self._writers_waiting = RawValue('i', 0)
+        self._wait_stats = {}
+
+    def acquire_read(self, section):
+        start = time.time()
+        with self._cond:
+            while True:
+                if not self._writer.value:
+                    waited = time.time() - start
+                    if not self._writers_waiting.value or waited >= self.max_reader_wait:
+                        break
+                    # give way to the waiting writers, but not forever
+                    self._cond.wait(self.max_reader_wait - waited)
+                else:
+                    self._cond.wait()
+            self._readers.value += 1
+            self.__add_wait(section, time.time() - start)
+            logger.debug("[%s] Entered phase gate as reader. Readers active: %i",
+                         section, self._readers.value)
+
+    def release_read(self):
+        with self._cond:
+            self._readers.value -= 1
+            if self._readers.value == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self, section):
+        start = time.time()
+        with self._cond:
+            self._writers_waiting.value += 1
+            try:
+                while self._writer.value or self._readers.value > 0:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting.value -= 1
+            self._writer.value = True
+            self.__add_wait(section, time.time() - start)
+            logger.debug("[%s] Entered phase gate as writer", section)
+
+    def release_write(self):
+        with self._cond:
+            self._writer.value = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self, section):
+        self.acquire_read(section)
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self, section):
+        self.acquire_write(section)
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def get_wait_stats(self):
+        """Return the time spent waiting at the gate by backend section
+
+        :returns: dict with the number of waits, and the total and max
+            seconds waited for each backend section
+        """
+        with self._cond:
+            return {section: dict(stats) for section, stats in self._wait_stats.items()}
+
+    def __add_wait(self, section, waited):
+        stats = self._wait_stats.get(section, {"waits": 0, "total": 0, "max": 0})
+        stats["waits"] += 1
+        stats["total"] += waited
+        stats["max"] = max(stats["max"], waited)
+        # assign it again so the change is also stored in managed dicts
+        self._wait_stats[section] = stats
+
+
+class ProcessPhaseGate(PhaseGate):
+    """
+    PhaseGate shared by tasks managers running in different processes
+
+    The condition variable comes from multiprocessing and the wait
+    stats are kept in a managed dict, so the gate must be created in
+    the parent process and passed to the tasks managers processes.
+    """
+
+    def __init__(self, max_reader_wait=PhaseGate.MAX_READER_WAIT):
+        super().__init__(max_reader_wait)
+        self._cond = multiprocessing.Condition()
+        self._manager = multiprocessing.Manager()
+        self._wait_stats = self._manager.dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the manager itself lives in the parent process
+        state['_manager'] = None
+        return state
+
+    def close(self):
+        """ Stop the manager process holding the wait stats """
+
+        if self._manager:
+            self._wait_stats = self.get_wait_stats()
+            self._manager.shutdown()
+            self._manager = None
+
+
+class ProcessCommQueue():
+    """
+    Queue to carry the exceptions from the tasks managers processes
+
+    Tracebacks can not be pickled, so they are sent formatted as text
+    together with the exception type and object.
+    """
+
+    def __init__(self):
+        self._queue = multiprocessing.Queue()
+
+    def put(self, exc_info):
+        exc_type, exc_obj, exc_trace = exc_info
+        exc_trace = "".join(traceback.format_exception(exc_type, exc_obj, exc_trace))
+        try:
+            pickle.dumps(exc_obj)
+        except Exception:
+            exc_type = RuntimeError
+            exc_obj = RuntimeError(repr(exc_obj))
+        self._queue.put((exc_type, exc_obj, exc_trace))
+
+    def get(self, block=True, timeout=None):
+        return self._queue.get(block, timeout)
+
+
+class ProcessProjectsUpdates():
+    """
+    Projects updates shared by tasks managers running in different processes
+
+    The projects are read by the process executing TaskProjects, which
+    publishes each update. The rest of processes wait for the updates to
+    reload the projects, so the repos added to them are processed without
+    waiting for the next round. It must be created in the parent process
+    and passed to the tasks managers processes.
+    """
+
+    def __init__(self):
+        self._cond = multiprocessing.Condition()
+        self._version = RawValue('i', 0)
+
+    def get_version(self):
+        with self._cond:
+            return self._version.value
+
+    def publish(self):
+        """ Notify the processes waiting for an update of the projects """
+
+        with self._cond:
+            self._version.value += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout):
+        """ Wait up to timeout seconds for an update of the projects after version
+
+        :returns: the current version of the updates
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._version.value != version, timeout)
+            return self._version.value
+
+
+class AdaptiveDelay():
+    """
+    Delay between rounds of a backend section adapted to its data change rate
+
+    The change rate is the number of new items found per second in the last
+    rounds, counting the delay before each round and its duration. After
+    each round, the delay is set so the next round is expected to find
+    `TARGET_NEW_ITEMS` items, discounting the time the rounds last, always
+    between `min_delay` and `max_delay`. While no changes are observed the
+    delay is doubled. So sections with frequent changes are updated every
+    `min_delay` seconds, while quiet ones back off up to `max_delay`.
+    The first round, which finds all the items, and the rounds which can
+    not tell the number of new items are not used to compute the rate.
+    """
+
+    HISTORY_SIZE = 10  # rounds used to compute the change rate
+    TARGET_NEW_ITEMS = 1  # new items expected in each round
+
+    def __init__(self, min_delay, max_delay):
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.delay = min_delay
+        self.rounds = 0
+        self.history = []  # (new items, duration, delay before the round) of the last rounds
+
+    def update(self, new_items, duration):
+        """ Register a round and return the delay before the next one
+
+        :new_items: items found in the round, None if unknown
+        :duration: seconds spent in the round
+        """
+        if self.rounds and new_items is not None:
+            self.history = (self.history + [(new_items, duration, self.delay)])[-self.HISTORY_SIZE:]
+        self.rounds += 1
+
+        rate = self.change_rate()
+        if rate is None or new_items is None:
+            return self.delay
+
+        if rate == 0:
+            delay = max(self.delay, 1) * 2
+        else:
+            mean_duration = sum([duration for (_, duration, _) in self.history]) / len(self.history)
+            delay = round(self.TARGET_NEW_ITEMS / rate - mean_duration)
+        self.delay = min(max(delay, self.min_delay), self.max_delay)
+
+        return self.delay
+
+    def change_rate(self):
+        """ Items per second observed in the last rounds, None if unknown """
+
+        elapsed = sum([duration + delay for (_, duration, delay) in self.history])
+        if not elapsed:
+            return None
+        return sum([items for (items, _, _) in self.history]) / elapsed
+
+
+class TasksSpec(namedtuple('TasksSpec', ['tasks_cls', 'backend_section', 'timer', 'max_timer'])):
+    """
+    Picklable description of the tasks executed by a tasks manager
+
+    The tasks classes are described by their module and class names,
+    so they can be imported again in the tasks manager process.
+    """
+
+    @classmethod
+    def from_tasks_cls(cls, tasks_cls, backend_section, timer=0, max_timer=None):
+        tasks_names = [tc.__module__ + ":" + tc.__name__ for tc in tasks_cls]
+        return cls(tasks_names, backend_section, timer, max_timer)
+
+    def get_tasks_cls(self):
+        tasks_cls = []
+        for task_name in self.tasks_cls:
+            module_name, cls_name = task_name.split(":")
+            tasks_cls.append(getattr(importlib.import_module(module_name), cls_name))
+        return tasks_cls
+
+
 class TasksManager(threading.Thread):
     """
     Class to manage tasks execution
@@ -42,18 +322,17 @@ class TasksManager(threading.Thread):
 
     # this queue supports the communication from threads to mother process
     COMM_QUEUE = queue.Queue()
-    # to control if enrichment process are active
-    NUMBER_ENRICH_TASKS_ON_LOCK = threading.Lock()
-    NUMBER_ENRICH_TASKS_ON = 0
-    # to control if identities process are active
-    IDENTITIES_TASKS_ON_LOCK = threading.Lock()
-    IDENTITIES_TASKS_ON = False
-
-    def __init__(self, tasks_cls, backend_section, stopper, config, timer=0):
+    # enrichment tasks (readers) and identities tasks (writer) can not overlap
+    IDENTITIES_GATE = PhaseGate()
+
+    def __init__(self, tasks_cls, backend_section, stopper, config, timer=0, max_timer=None):
         """
         :tasks_cls : tasks classes to be executed using the backend
         :backend_section: perceval backend section name
         :config: config object for the manager
+        :timer: seconds to wait between rounds of tasks
+        :max_timer: if set, the wait is adapted to the new items found
+                    in each round, between `timer` and `max_timer` seconds
         """
         super().__init__(name=backend_section)  # init the Thread
         self.config = config
@@ -62,7 +341,10 @@ class TasksManager(threading.Thread):
         self.backend_section = backend_section
         self.stopper = stopper  # To stop the thread from parent
         self.timer = timer
+        self.adaptive_delay = AdaptiveDelay(timer, max_timer) if max_timer else None
         self.thread_id = None
+        self.before_round = None  # callable executed before each round of tasks
+        self.wait_projects_update = None  # callable to wait for the projects updates, TaskProjects' if None
 
     def add_task(self, task):
         self.tasks.append(task)
@@ -88,12 +370,19 @@ class TasksManager(threading.Thread):
 
         logger.debug('[thread:%s][%s] Tasks will be executed in this order: %s', self.thread_id,
                      self.backend_section, self.tasks)
+        repos_delta = None  # repos added to the projects, to be processed before the next full round
+        next_round = time.time()
         while not self.stopper.is_set():
             # we give 1 extra second to the stopper, so this loop does
             # not finish before it is set.
             time.sleep(1)
 
+            if self.before_round:
+                self.before_round()
+
+            round_start = time.time()
             for task in self.tasks:
+                task.repos_delta = repos_delta
                 try:
                     task.execute()
                 except Exception as ex:
@@ -103,9 +392,157 @@ class TasksManager(threading.Thread):
                     raise
                 logger.debug('[thread:%s][%s] Tasks finished: %s', self.thread_id, self.backend_section, task)
 
-            if self.timer > 0 and self.config.get_conf()['general']['update']:
-                logger.debug("[thread:%s][%s] sleeping for %s seconds ", self.thread_id, self.backend_section,
-                             self.timer)
-                time.sleep(self.timer)
+            if repos_delta is None:
+                timer = self.timer
+                if self.adaptive_delay:
+                    timer = self.__get_adaptive_timer(time.time() - round_start)
+                next_round = time.time() + timer
+                if timer > 0 and self.config.get_conf()['general']['update']:
+                    logger.debug("[thread:%s][%s] sleeping for %s seconds ", self.thread_id, self.backend_section,
+                                 timer)
+
+            repos_delta = None
+            if self.config.get_conf()['general']['update']:
+                repos_delta = self.__wait_next_round(next_round)
 
         logger.debug('[thread:%s][%s] Thread is exiting', self.thread_id, self.backend_section)
+
+    def __wait_next_round(self, next_round):
+        """ Wait until the next full round, or until repos are added to the section in the projects
+
+        :returns: the repos added to the section, None if the full round is due
+        """
+        from .task_projects import TaskProjects
+
+        wait_projects_update = self.wait_projects_update or TaskProjects.wait_projects_update
+        version = TaskProjects.get_projects_version()
+        while True:
+            remaining = next_round - time.time()
+            if remaining <= 0:
+                return None
+
+            new_version = wait_projects_update(version, remaining)
+            if new_version == version:
+                continue
+
+            diff = TaskProjects.get_repos_diff(self.backend_section, version)
+            version = new_version
+            if diff and diff['added']:
+                logger.info("[thread:%s][%s] %i repos added to the projects, processing them now",
+                            self.thread_id, self.backend_section, len(diff['added']))
+                return diff['added']
+
+    def __get_adaptive_timer(self, duration):
+        """ Update the adaptive delay with the new items found by the tasks in the round """
+
+        reported = [task.new_items for task in self.tasks if task.new_items is not None]
+        new_items = sum(reported) if reported else None
+
+        timer = self.adaptive_delay.update(new_items, duration)
+        logger.info("[thread:%s][%s] %s new items in %0.2fs, next round in %s seconds",
+                    self.thread_id, self.backend_section,
+                    new_items if new_items is not None else "unknown", duration, timer)
+
+        return timer
+
+
+class ProcessTasksManager(multiprocessing.Process):
+    """
+    Class to manage tasks execution in its own process
+
+    The tasks are executed by a TasksManager running in the main thread
+    of the process, so the CPU bound tasks of different backend sections
+    don't compete for the same GIL. The exceptions are sent to the
+    parent using `comm_queue` and the enrichment and identities tasks
+    are coordinated using a ProcessPhaseGate. The projects updates are
+    published by the process executing TaskProjects using a
+    ProcessProjectsUpdates, and the rest of processes reload them.
+    """
+
+    def __init__(self, spec, stopper, config, comm_queue, gate, projects, projects_updates=None):
+        """
+        :spec: TasksSpec with the tasks to be executed
+        :stopper: multiprocessing event to stop the process from parent
+        :config: config object for the manager
+        :comm_queue: ProcessCommQueue to send the exceptions to the parent
+        :gate: ProcessPhaseGate shared by all the tasks managers
+        :projects: projects data at the moment of creating the process
+        :projects_updates: ProcessProjectsUpdates shared by all the tasks managers,
+                           if None the projects are reloaded only before each round
+        """
+        from .task_projects import thaw_data
+
+        super().__init__(name=spec.backend_section)
+        self.spec = spec
+        self.stopper = stopper
+        self.config = config
+        self.comm_queue = comm_queue
+        self.gate = gate
+        # the projects snapshot is read only, a plain copy is needed to pickle it
+        self.projects = thaw_data(projects)
+        self.projects_mtime = None
+        self.projects_updates = projects_updates
+        self.projects_updates_version = None  # version of the last projects update reloaded
+
+    def __reload_projects(self, force=False):
+        """ Reload the projects if they have been updated by the global tasks process """
+
+        from .task_projects import TaskProjects
+
+        projects_file = self.config.get_conf()['projects']['projects_file']
+        try:
+            mtime = os.path.getmtime(projects_file)
+        except OSError:
+            return
+
+        if self.projects_mtime is None and not force:
+            self.projects_mtime = mtime
+        elif mtime != self.projects_mtime or force:
+            logger.debug('[process:%s][%s] Reloading projects from %s', self.pid,
+                         self.spec.backend_section, projects_file)
+            self.projects_mtime = mtime
+            with open(projects_file, 'r') as fprojects:
+                TaskProjects.set_projects(json.load(fprojects))
+
+    def __wait_projects_update(self, version, timeout):
+        """ Wait for the global tasks process to publish a projects update, and reload them
+
+        :returns: the projects version of this process
+        """
+        from .task_projects import TaskProjects
+
+        updates_version = self.projects_updates.wait(self.projects_updates_version, timeout)
+        if updates_version != self.projects_updates_version:
+            self.projects_updates_version = updates_version
+            self.__reload_projects(force=True)
+
+        return TaskProjects.get_projects_version()
+
+    def run(self):
+        from .task_projects import TaskProjects
+
+        # Install the shared communication channels in this process
+        TasksManager.COMM_QUEUE = self.comm_queue
+        TasksManager.IDENTITIES_GATE = self.gate
+        TaskProjects.set_projects(self.projects)
+
+        logger.debug('[process:%s][%s] Process starts', self.pid, self.spec.backend_section)
+
+        tasks_cls = self.spec.get_tasks_cls()
+        manager = TasksManager(tasks_cls, self.spec.backend_section,
+                               self.stopper, self.config, self.spec.timer, self.spec.max_timer)
+        if TaskProjects in tasks_cls:
+            # this process reads the projects, and publishes their updates to the rest
+            TaskProjects.projects_updates = self.projects_updates
+        else:
+            manager.before_round = self.__reload_projects
+            if self.projects_updates:
+                self.projects_updates_version = self.projects_updates.get_version()
+                manager.wait_projects_update = self.__wait_projects_update
+        try:
+            manager.run()
+        except Exception:
+            # The exception is already in the comm queue
+            sys.exit(1)
+
+        logger.debug('[process:%s][%s] Process is exiting', self.pid, self.spec.backend_section)
@@ -22,120 +22,411 @@
 #     Quan Zhou <quan@bitergia.com>
 #
 
+import hashlib
 import json
 import logging
 
-from threading import Lock
+from threading import Condition, Lock
+from types import MappingProxyType
 
 import requests
 
-from copy import deepcopy
-
 from sirmordred.task import Task
 from sirmordred.eclipse_projects_lib import compose_title, compose_projects_json
 
 logger = logging.getLogger(__name__)
 
 
+class FrozenList(list):
+    """ Read only list, shared by its readers without copying it """
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("'FrozenList' object is read only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = __readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = __readonly
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def freeze_data(data):
+    """ Return a read only version of data: dicts as mapping proxies and lists as tuples """
+
+    if isinstance(data, FrozenList):
+        return data
+    if isinstance(data, (dict, MappingProxyType)):
+        return MappingProxyType({key: freeze_data(value) for (key, value) in data.items()})
+    if isinstance(data, (list, tuple)):
+        return tuple([freeze_data(value) for value in data])
+    return data
+
+
+def diff_repos(old_repos, new_repos):
+    """ Return the repos added and removed from old_repos to new_repos, keeping their order """
+
+    old_set = set(old_repos)
+    new_set = set(new_repos)
+    added = [repo for repo in unique_repos(new_repos) if repo not in old_set]
+    removed = [repo for repo in unique_repos(old_repos) if repo not in new_set]
+
+    return {'added': added, 'removed': removed}
+
+
+def unique_repos(repos):
+    """ Return the repos without duplicates, keeping their order """
+
+    seen = set()
+    unique = []
+    for repo in repos:
+        if repo not in seen:
+            seen.add(repo)
+            unique.append(repo)
+    return unique
+
+
+def thaw_data(data):
+    """ Return a plain (and picklable) copy of data frozen with freeze_data """
+
+    if isinstance(data, (dict, MappingProxyType)):
+        return {key: thaw_data(value) for (key, value) in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [thaw_data(value) for value in data]
+    return data
+
+
 class TaskProjects(Task):
     """ Task to manage the projects config """
 
     GLOBAL_PROJECT = 'unknown'  # project to download and enrich full sites
-    __projects = {}  # static projects data dict
+    __projects = MappingProxyType({})  # static projects data snapshot, read only
+    __projects_version = 0  # incremented each time the projects are set
+    __sections_index = MappingProxyType({})  # repositories by backend section, built from the projects
     projects_last_diff = []  # Projects changed in last update
+    projects_last_repos_diff = MappingProxyType({})  # Repos added and removed by project and section in last update
     projects_lock = Lock()
+    projects_updated = Condition(projects_lock)  # notified on each update of the projects
+
+    FETCH_META_SUFFIX = '.meta'  # file next to the projects file with the data of the last fetches
+    projects_unchanged_cycles = 0  # executions skipped because the projects didn't change
+    __projects_source = (None, None)  # (sha256 of the projects file, projects version) of the last load
+
+    projects_updates = None  # ProcessProjectsUpdates to publish the updates to other processes
+
+    REPOS_DIFFS_HISTORY = 10  # number of updates for which the sections diffs are kept
+    __repos_diffs = []  # (version, repos added and removed by section) of the last updates
 
     def is_backend_task(self):
         return False
 
     @classmethod
     def get_projects(cls):
-        with cls.projects_lock:
-            # Return a deepcopy so it is not changed
-            return deepcopy(cls.__projects)
+        """ Return the current projects snapshot
+
+        The snapshot is read only, so it is shared by all the callers
+        without copying it. Use thaw_data to get a modifiable copy.
+        """
+        return cls.__projects
+
+    @classmethod
+    def get_projects_version(cls):
+        """ Return the version of the projects snapshot, increased on each update """
+        return cls.__projects_version
 
     @classmethod
     def set_projects(cls, projects):
+        snapshot = freeze_data(projects)
+        index = cls.build_sections_index(snapshot)
         with cls.projects_lock:
             old_projects_set = set(cls.__projects.keys())
-            new_projects_set = set(projects.keys())
+            new_projects_set = set(snapshot.keys())
             cls.projects_last_diff = list(old_projects_set ^ new_projects_set)
             logger.debug("Update project diff %s", cls.projects_last_diff)
-            cls.__projects = projects
+            cls.projects_last_repos_diff = cls.__diff_projects_repos(cls.__projects, snapshot)
+            sections_diff = cls.__diff_sections_repos(cls.__sections_index, index)
+            cls.__projects = snapshot
+            cls.__sections_index = index
+            cls.__projects_version += 1
+            cls.__repos_diffs = (cls.__repos_diffs + [(cls.__projects_version, sections_diff)])[-cls.REPOS_DIFFS_HISTORY:]
+            cls.projects_updated.notify_all()
+
+        # The backends are built with the repos of the projects
+        Task.invalidate_backends()
+
+        for section in sections_diff:
+            logger.debug("Update repos diff for %s: %i added, %i removed", section,
+                         len(sections_diff[section]['added']), len(sections_diff[section]['removed']))
 
     @classmethod
     def get_projects_last_diff(cls):
         return cls.projects_last_diff
 
     @classmethod
-    def get_repos_by_backend_section(cls, backend_section, raw=True):
-        """ return list with the repositories for a backend_section """
-        repos = []
-        projects = TaskProjects.get_projects()
+    def get_projects_last_repos_diff(cls):
+        """ Return the repos added and removed in the last update by project and backend section """
+        return cls.projects_last_repos_diff
+
+    @staticmethod
+    def __diff_projects_repos(old_projects, new_projects):
+        diff = {}
+        for pro in set(old_projects.keys()) | set(new_projects.keys()):
+            old_sections = old_projects.get(pro, {})
+            new_sections = new_projects.get(pro, {})
+            for section in set(old_sections.keys()) | set(new_sections.keys()):
+                sdiff = diff_repos(old_sections.get(section, ()), new_sections.get(section, ()))
+                if sdiff['added'] or sdiff['removed']:
+                    diff.setdefault(pro, {})[section] = sdiff
+
+        return freeze_data(diff)
+
+    @staticmethod
+    def __diff_sections_repos(old_index, new_index):
+        diff = {}
+        for section in set(old_index.keys()) | set(new_index.keys()):
+            old_repos = old_index[section]['all'] if section in old_index else ()
+            new_repos = new_index[section]['all'] if section in new_index else ()
+            sdiff = diff_repos(old_repos, new_repos)
+            if sdiff['added'] or sdiff['removed']:
+                diff[section] = sdiff
+
+        return freeze_data(diff)
+
+    @classmethod
+    def get_repos_diff(cls, backend_section, since_version):
+        """ Return the repos added and removed in a backend section since a projects version
+
+        :returns: dict with the `added` and `removed` repos, or None if the
+                  updates since `since_version` are no longer available
+        """
+        with cls.projects_lock:
+            diffs = cls.__repos_diffs
+            version = cls.__projects_version
+
+        if since_version == version:
+            return {'added': [], 'removed': []}
+        if not diffs or diffs[0][0] > since_version + 1:
+            return None
+
+        added = []
+        removed = []
+        for (diff_version, sections_diff) in diffs:
+            if diff_version <= since_version or backend_section not in sections_diff:
+                continue
+            sdiff = sections_diff[backend_section]
+            added = [repo for repo in added if repo not in sdiff['removed']]
+            removed = [repo for repo in removed if repo not in sdiff['added']]
+            added += [repo for repo in sdiff['added'] if repo not in added]
+            removed += [repo for repo in sdiff['removed'] if repo not in removed]
+
+        return {'added': added, 'removed': removed}
+
+    @classmethod
+    def wait_projects_update(cls, version, timeout):
+        """ Wait up to timeout seconds for the projects to be updated after version
+
+        :returns: the current projects version
+        """
+        with cls.projects_updated:
+            cls.projects_updated.wait_for(lambda: cls.__projects_version != version, timeout)
+            return cls.__projects_version
+
+    @classmethod
+    def build_sections_index(cls, projects):
+        """ Build the repositories of each backend section
+
+        :returns: dict with an entry per backend section, with the repos to
+                  collect (raw), the repos to enrich (enrich), the repos of
+                  all the projects (all) and the projects of each repo (projects)
+        """
+        index = {}
+
+        def section_index(backend_section):
+            if backend_section not in index:
+                index[backend_section] = {'raw': [], 'enrich': [], 'all': [], 'projects': {}}
+            return index[backend_section]
+
+        global_project = projects.get(cls.GLOBAL_PROJECT)
 
         for pro in projects:
-            if backend_section in projects[pro]:
-                if cls.GLOBAL_PROJECT not in projects:
-                    repos += projects[pro][backend_section]
-                else:
-                    if pro == cls.GLOBAL_PROJECT:
-                        continue
-
-                    if raw:
-                        if backend_section in projects[cls.GLOBAL_PROJECT]:
-                            repos += projects[cls.GLOBAL_PROJECT][backend_section]
-                        else:
-                            repos += projects[pro][backend_section]
+            for backend_section in projects[pro]:
+                repos = projects[pro][backend_section]
+                sindex = section_index(backend_section)
+                sindex['all'] += repos
+                for repo in repos:
+                    if pro not in sindex['projects'].setdefault(repo, []):
+                        sindex['projects'][repo].append(pro)
+
+                if global_project is None:
+                    sindex['raw'] += repos
+                    sindex['enrich'] += repos
+                elif pro != cls.GLOBAL_PROJECT:
+                    # the repos of the global project are collected once per project using the section
+                    if backend_section in global_project:
+                        sindex['raw'] += global_project[backend_section]
                     else:
-                        repos += projects[pro][backend_section]
+                        sindex['raw'] += repos
+                    sindex['enrich'] += repos
+
+        # the lists returned to the callers are read only, so they are shared without copying them
+        for sindex in index.values():
+            sindex['raw'] = FrozenList(sindex['raw'])
+            sindex['enrich'] = FrozenList(sindex['enrich'])
+            sindex['projects'] = {repo: FrozenList(pros) for (repo, pros) in sindex['projects'].items()}
+
+        return freeze_data(index)
+
+    @classmethod
+    def get_sections_index(cls):
+        """ Return the index of repositories by backend section of the current projects """
+        return cls.__sections_index
 
-        logger.debug("List of repos for %s: %s (raw=%s)", backend_section, repos, raw)
+    @classmethod
+    def get_repos_by_backend_section(cls, backend_section, raw=True):
+        """ return list with the repositories for a backend_section
+
+        The list is the read only one of the sections index, shared by all
+        the callers without copying it.
+        """
+        sindex = cls.__sections_index.get(backend_section)
+        return sindex['raw' if raw else 'enrich'] if sindex else FrozenList()
+
+    @classmethod
+    def get_repo_projects(cls, backend_section, repo):
+        """ return list with the projects including a repository of a backend_section """
 
-        return repos
+        sindex = cls.__sections_index.get(backend_section)
+        if not sindex or repo not in sindex['projects']:
+            return FrozenList()
+        return sindex['projects'][repo]
 
     def execute(self):
         config = self.conf
 
-        if config['projects']['load_eclipse']:
+        if config['projects']['load_eclipse'] and config['projects']['projects_url']:
+            # The projects from the URL would replace the ones from Eclipse in the projects
+            # file, and the Eclipse ones would invalidate the conditional fetch of the URL
+            logger.warning("Projects from Eclipse not loaded, they are replaced by the ones from %s",
+                           config['projects']['projects_url'])
+        elif config['projects']['load_eclipse']:
             self.__get_eclipse_projects()
         if config['projects']['projects_url']:
-            projects = self.__get_projects_from_url()
-        else:
-            projects_file = config['projects']['projects_file']
-            logger.info("Reading projects data from  %s ", projects_file)
-            with open(projects_file, 'r') as fprojects:
-                projects = json.load(fprojects)
+            self.__get_projects_from_url()
+
+        projects_file = config['projects']['projects_file']
+        with open(projects_file, 'rb') as fprojects:
+            content = fprojects.read()
+        sha = hashlib.sha256(content).hexdigest()
+
+        if (sha, TaskProjects.get_projects_version()) == TaskProjects.__projects_source:
+            TaskProjects.projects_unchanged_cycles += 1
+            logger.info("Projects data in %s not changed (%i unchanged cycles)", projects_file,
+                        TaskProjects.projects_unchanged_cycles)
+            return
+
+        logger.info("Reading projects data from  %s ", projects_file)
+        projects = json.loads(content.decode('utf-8'))
 
         TaskProjects.set_projects(projects)
+        TaskProjects.__projects_source = (sha, TaskProjects.get_projects_version())
+        if TaskProjects.projects_updates:
+            TaskProjects.projects_updates.publish()
+
+    def __fetch_meta_file(self):
+        return self.conf['projects']['projects_file'] + self.FETCH_META_SUFFIX
+
+    def __read_fetch_meta(self):
+        try:
+            with open(self.__fetch_meta_file(), 'r') as fmeta:
+                return json.load(fmeta)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def __file_sha(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def __fetch_url(self, url):
+        """ Fetch the content of url, unless it has not changed since the last fetch
+
+        The ETag, Last-Modified and sha256 of the last response are stored
+        next to the projects file, and they are used only if the projects
+        file is still the one written after that response.
+
+        :returns: the response, None if the content has not changed
+        """
+        url_meta = self.__read_fetch_meta().get(url, {})
+        projects_file = self.conf['projects']['projects_file']
+
+        headers = {}
+        file_unchanged = url_meta.get('file_sha256') and url_meta['file_sha256'] == self.__file_sha(projects_file)
+        if file_unchanged:
+            if url_meta.get('etag'):
+                headers['If-None-Match'] = url_meta['etag']
+            if url_meta.get('last_modified'):
+                headers['If-Modified-Since'] = url_meta['last_modified']
+
+        res = requests.get(url, headers=headers)
+        res.raise_for_status()
+
+        if file_unchanged and res.status_code == 304:
+            logger.info("Projects from %s not modified", url)
+            return None
+
+        if file_unchanged and hashlib.sha256(res.content).hexdigest() == url_meta.get('sha256'):
+            logger.info("Projects from %s not changed", url)
+            self.__save_fetch_meta(url, res, url_meta['file_sha256'])
+            return None
+
+        return res
+
+    def __save_fetch_meta(self, url, res, file_sha):
+        meta = self.__read_fetch_meta()
+        meta[url] = {
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+            'sha256': hashlib.sha256(res.content).hexdigest(),
+            'file_sha256': file_sha
+        }
+        with open(self.__fetch_meta_file(), 'w') as fmeta:
+            json.dump(meta, fmeta, indent=True)
+
+    def __write_projects(self, projects):
+        """ Write the projects to the projects file and return its sha256 """
+
+        content = json.dumps(projects, indent=True)
+        with open(self.conf['projects']['projects_file'], "w") as fprojects:
+            fprojects.write(content)
+
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
     def __get_projects_from_url(self):
         config = self.conf
         projects_url = config['projects']['projects_url']
-        projects_file = config['projects']['projects_file']
 
         logger.info("Getting projects file from URL: %s ", projects_url)
-        res = requests.get(projects_url)
-        res.raise_for_status()
-        projects = res.json()
-        with open(projects_file, "w") as fprojects:
-            json.dump(projects, fprojects, indent=True)
+        res = self.__fetch_url(projects_url)
+        if res is None:
+            return
 
-        return projects
+        projects = res.json()
+        self.__save_fetch_meta(projects_url, res, self.__write_projects(projects))
 
     def __get_eclipse_projects(self):
-        config = self.conf
-        projects_file = config['projects']['projects_file']
-
         eclipse_projects_url = 'http://projects.eclipse.org/json/projects/all'
 
         logger.info("Getting Eclipse projects (1 min) from  %s ", eclipse_projects_url)
-        eclipse_projects_resp = requests.get(eclipse_projects_url)
-        eclipse_projects_resp.raise_for_status()
+        eclipse_projects_resp = self.__fetch_url(eclipse_projects_url)
+        if eclipse_projects_resp is None:
+            return
+
         eclipse_projects = eclipse_projects_resp.json()['projects']
         projects = self.convert_from_eclipse(eclipse_projects)
 
-        with open(projects_file, "w") as fprojects:
-            json.dump(projects, fprojects, indent=True)
+        self.__save_fetch_meta(eclipse_projects_url, eclipse_projects_resp, self.__write_projects(projects))
 
     def convert_from_eclipse(self, eclipse_projects):
         """ Convert from eclipse projects format to grimoire projects json format """
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class TaskNode():
+    """ Node of the tasks graph: a step to be executed once its dependencies are done """
+
+    def __init__(self, name, execute, deps=None):
+        """
+        :name: unique name of the node, i.e. enrich:git
+        :execute: callable executing the step
+        :deps: names of the nodes which must finish before this one
+        """
+        self.name = name
+        self.execute = execute
+        self.deps = deps if deps else []
+        self.start = None
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0
+        return self.end - self.start
+
+    def __repr__(self):
+        return "TaskNode(%s)" % self.name
+
+
+class TasksScheduler():
+    """
+    Scheduler executing a graph of tasks as soon as their inputs are ready
+
+    Each node is started when all its dependencies have finished, up to
+    `max_workers` nodes running at the same time. When a node fails, the
+    nodes depending on it are skipped, and the first error is raised once
+    the rest of the graph has been executed.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.nodes = {}
+
+    def add_node(self, name, execute, deps=None):
+        if name in self.nodes:
+            raise RuntimeError("Duplicated node in tasks graph: %s" % name)
+        self.nodes[name] = TaskNode(name, execute, deps)
+        return self.nodes[name]
+
+    def check_graph(self):
+        """ Check that all the dependencies exist and there are no cycles """
+
+        for node in self.nodes.values():
+            for dep in node.deps:
+                if dep not in self.nodes:
+                    raise RuntimeError("Unknown dependency %s for node %s" % (dep, node.name))
+
+        visited = set()
+        in_path = set()
+
+        def visit(name):
+            if name in in_path:
+                raise RuntimeError("Cycle in tasks graph at node %s" % name)
+            if name in visited:
+                return
+            in_path.add(name)
+            for dep in self.nodes[name].deps:
+                visit(dep)
+            in_path.remove(name)
+            visited.add(name)
+
+        for name in self.nodes:
+            visit(name)
+
+    def __run_node(self, node):
+        node.start = time.time()
+        try:
+            logger.debug("[scheduler] Node %s starts", node.name)
+            node.execute()
+        finally:
+            node.end = time.time()
+            logger.debug("[scheduler] Node %s finished in %0.2fs", node.name, node.duration)
+
+    def run(self):
+        """ Execute all the nodes of the graph
+
+        :returns: list with the nodes of the critical path
+        """
+        self.check_graph()
+
+        pending = dict(self.nodes)
+        done = set()
+        failed = set()
+        running = {}
+        errors = []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # Skip the nodes depending on failed ones
+                for name in list(pending):
+                    if any(dep in failed for dep in pending[name].deps):
+                        logger.warning("[scheduler] Skipping %s, a dependency failed", name)
+                        failed.add(name)
+                        del pending[name]
+
+                ready = [name for name in pending
+                         if all(dep in done for dep in pending[name].deps)]
+                for name in ready:
+                    node = pending.pop(name)
+                    running[executor.submit(self.__run_node, node)] = node
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    if future.exception():
+                        node.error = future.exception()
+                        logger.error("[scheduler] Node %s failed: %s", node.name, node.error)
+                        errors.append(node.error)
+                        failed.add(node.name)
+                    else:
+                        done.add(node.name)
+
+        critical_path = self.critical_path()
+        self.log_critical_path(critical_path)
+
+        if errors:
+            raise errors[0]
+
+        return critical_path
+
+    def critical_path(self):
+        """ Return the chain of nodes which determined the end of the execution
+
+        Starting from the last node to finish, the path follows the
+        dependency which finished last, since it was the one delaying
+        the start of the node.
+        """
+        executed = [node for node in self.nodes.values() if node.end is not None]
+        if not executed:
+            return []
+
+        path = []
+        node = max(executed, key=lambda n: n.end)
+        while node:
+            path.append(node)
+            deps = [self.nodes[dep] for dep in node.deps if self.nodes[dep].end is not None]
+            node = max(deps, key=lambda n: n.end) if deps else None
+
+        path.reverse()
+        return path
+
+    @staticmethod
+    def log_critical_path(path):
+        if not path:
+            return
+
+        total = path[-1].end - path[0].start
+        logger.info("[scheduler] Critical path of the cycle (%0.2fs): %s", total,
+                    " -> ".join(["%s (%0.2fs)" % (node.name, node.duration) for node in path]))
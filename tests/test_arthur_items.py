@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+# Hack to make sure that tests import the right packages
+# due to setuptools behaviour
+sys.path.insert(0, '..')
+
+from sirmordred.arthur_items import (ArthurItem,
+                                     ArthurItemsBuffer,
+                                     ArthurItemsSegment,
+                                     get_pickled_tag)
+
+
+def arthur_item(tag, uuid):
+    item = {'origin': tag, 'uuid': uuid, 'tag': tag, 'data': {'message': 'commit ' + uuid}}
+    return item, pickle.dumps(item)
+
+
+class TestArthurItem(unittest.TestCase):
+    """ArthurItem tests"""
+
+    def test_get_pickled_tag(self):
+        """Test whether the tag of the top level dict is read from the pickled items"""
+
+        tag = 'https://github.com/chaoss/grimoirelab-perceval'
+        item = {
+            'backend_name': 'Git',
+            'origin': tag,
+            'timestamp': 1533723633.452795,
+            'classified_fields_filtered': None,
+            'search_fields': {'item_id': '456a68ee1407a77f3e804a30dff245bb6c6b872f', 'tag': 'search'},
+            'tag': tag,
+            'data': {'commit': '456a68ee1407a77f3e804a30dff245bb6c6b872f', 'tag': 'data'}
+        }
+        for protocol in range(0, pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(get_pickled_tag(pickle.dumps(item, protocol=protocol)), tag)
+
+        # only the tag of the top level dict is read
+        self.assertEqual(get_pickled_tag(pickle.dumps({'data': {'tag': 'data'}, 'tag': tag})), tag)
+        self.assertEqual(get_pickled_tag(pickle.dumps({'data': ['a', 'tag', 'data'], 'tag': tag})), tag)
+        self.assertEqual(get_pickled_tag(pickle.dumps({'data': 'tag', 'tag': tag})), tag)
+        self.assertEqual(get_pickled_tag(pickle.dumps({'tag': 'tag', 'data': {}})), 'tag')
+        self.assertEqual(get_pickled_tag(pickle.dumps({'data': {'tag': ['data']}, 'tag': tag, 'a': 1})), tag)
+        self.assertEqual(get_pickled_tag(pickle.dumps({'tag': 10, 'data': {}})), 10)
+        self.assertIsNone(get_pickled_tag(pickle.dumps({'data': {'tag': 'data'}})))
+
+        self.assertIsNone(get_pickled_tag(pickle.dumps({'tag': ['a'], 'data': {}})))
+        self.assertIsNone(get_pickled_tag(pickle.dumps([tag])))
+        self.assertIsNone(get_pickled_tag(b'not a pickle'))
+
+    def test_get_pickled_tag_memoized(self):
+        """Test whether the tag is read when it is not the first key and its value is memoized"""
+
+        tag = 'https://github.com/chaoss/grimoirelab-perceval'
+        items = [
+            {'origin': tag, 'uuid': '1', 'tag': tag, 'data': {'message': tag}},
+            {'search_fields': {'tag': tag}, 'tag': tag, 'data': {}},
+            {'data': {'tag': tag, 'message': 'commit'}, 'origin': 'tag', 'tag': tag},
+            {'origin': 'tag', 'category': tag, 'tag': 'tag'}
+        ]
+        for item in items:
+            for protocol in range(0, pickle.HIGHEST_PROTOCOL + 1):
+                payload = pickle.dumps(item, protocol=protocol)
+                self.assertEqual(get_pickled_tag(payload), item['tag'])
+
+    def test_tag(self):
+        """Test whether the tag is read from the pickled items, or from the item unpickled once"""
+
+        item, payload = arthur_item('tag_a', '1')
+        self.assertEqual(ArthurItem(payload).tag, 'tag_a')
+
+        # items whose tag can not be read are unpickled
+        item = {'tag': ['tag_b'], 'data': {}}
+        aitem = ArthurItem(pickle.dumps(item))
+        self.assertEqual(aitem.tag, ['tag_b'])
+        self.assertIs(aitem.load(), aitem.load())
+
+        with self.assertRaises(KeyError):
+            ArthurItem(pickle.dumps({'data': {'tag': 'data'}}))
+
+    def test_load(self):
+        """Test whether the item is unpickled when it is loaded"""
+
+        item, payload = arthur_item('tag_a', '1')
+        aitem = ArthurItem(payload)
+
+        self.assertEqual(aitem.tag, 'tag_a')
+        self.assertEqual(aitem.size, len(payload))
+        self.assertEqual(aitem.load(), item)
+        self.assertIsNot(aitem.load(), aitem.load())
+
+
+class TestArthurItemsBuffer(unittest.TestCase):
+    """ArthurItemsBuffer tests"""
+
+    def test_size(self):
+        """Test whether the size of the buffer follows the items added and removed"""
+
+        buffer = ArthurItemsBuffer()
+        self.assertEqual(buffer.size, 0)
+
+        item_a, payload_a = arthur_item('tag_a', '1')
+        item_b, payload_b = arthur_item('tag_b', '2')
+        item_c, payload_c = arthur_item('tag_b', '3')
+        buffer.append(ArthurItem(payload_a))
+        buffer.append(ArthurItem(payload_b))
+        buffer.append(ArthurItem(payload_c))
+        size_a, size_b, size_c = len(payload_a), len(payload_b), len(payload_c)
+
+        self.assertEqual(buffer.size, size_a + size_b + size_c)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.count('tag_b'), 2)
+        self.assertEqual(sorted(buffer.keys()), ['tag_a', 'tag_b'])
+
+        self.assertEqual(buffer.pop('tag_b'), item_c)
+        self.assertEqual(buffer.size, size_a + size_b)
+        self.assertEqual(buffer.pop('tag_b'), item_b)
+        self.assertIsNone(buffer.pop('tag_b'))
+        self.assertIsNone(buffer.pop('tag_c'))
+        self.assertEqual(buffer.size, size_a)
+
+        buffer.remove_tag('tag_a')
+        self.assertEqual(buffer.size, 0)
+        self.assertFalse('tag_a' in buffer)
+
+    def test_max_tag_size(self):
+        """Test whether the items of a tag are not appended when its queue is full"""
+
+        _, payload_a = arthur_item('tag_a', '1')
+        _, payload_b = arthur_item('tag_b', '2')
+        buffer = ArthurItemsBuffer(max_tag_size=2 * len(payload_a))
+
+        self.assertTrue(buffer.append(ArthurItem(payload_a)))
+        self.assertTrue(buffer.append(ArthurItem(payload_a)))
+        self.assertTrue(buffer.is_tag_full('tag_a'))
+        self.assertFalse(buffer.append(ArthurItem(payload_a)))
+        self.assertEqual(buffer.count('tag_a'), 2)
+
+        # the rest of tags are not affected
+        self.assertFalse(buffer.is_tag_full('tag_b'))
+        self.assertTrue(buffer.append(ArthurItem(payload_b)))
+
+        buffer.pop('tag_a')
+        self.assertFalse(buffer.is_tag_full('tag_a'))
+        self.assertTrue(buffer.append(ArthurItem(payload_a)))
+
+        # an item larger than the limit is appended to an empty queue
+        _, payload_c = arthur_item('tag_c', '3' * 100)
+        self.assertTrue(buffer.append(ArthurItem(payload_c)))
+        self.assertEqual(buffer.count('tag_c'), 1)
+
+    def test_remove_tag(self):
+        """Test whether the items of a removed tag are dropped until the tag is added again"""
+
+        item, payload = arthur_item('tag_a', '1')
+        buffer = ArthurItemsBuffer()
+        buffer.add_tag('tag_a')
+        buffer.append(ArthurItem(payload))
+
+        buffer.remove_tag('tag_a')
+        self.assertTrue(buffer.append(ArthurItem(payload)))
+        self.assertFalse('tag_a' in buffer)
+        self.assertEqual(buffer.size, 0)
+
+        buffer.add_tag('tag_a')
+        buffer.append(ArthurItem(payload))
+        self.assertEqual(buffer.pop('tag_a'), item)
+
+    def test_add_tag(self):
+        """Test whether tags without items are registered"""
+
+        buffer = ArthurItemsBuffer()
+        buffer.add_tag('tag_a')
+
+        self.assertTrue('tag_a' in buffer)
+        self.assertFalse('tag_b' in buffer)
+        self.assertEqual(buffer.count('tag_a'), 0)
+        self.assertEqual(buffer.size, 0)
+
+
+class TestArthurItemsSpill(unittest.TestCase):
+    """Tests of the arthur items spilled to disk"""
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp(prefix='arthur_items_')
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def test_segment(self):
+        """Test whether the payloads are read in order from a segment"""
+
+        segment = ArthurItemsSegment(os.path.join(self.spill_dir, 'segment'))
+        segment.append(b'first')
+        segment.append(b'second')
+        self.assertEqual(segment.pop(), b'first')
+
+        # items appended after the file is mapped are read too
+        segment.append(b'third')
+        self.assertEqual(segment.count, 2)
+        self.assertEqual(segment.size, len(b'second') + len(b'third'))
+        self.assertEqual(segment.pop(), b'second')
+        self.assertEqual(segment.pop(), b'third')
+        self.assertIsNone(segment.pop())
+
+        # the file is truncated once all the items are read
+        self.assertEqual(os.path.getsize(segment.path), 0)
+        segment.append(b'fourth')
+        self.assertEqual(segment.pop(), b'fourth')
+
+        segment.close()
+        self.assertFalse(os.path.exists(segment.path))
+
+    def test_segment_compact(self):
+        """Test whether the segment file doesn't grow when the items are appended while they are read"""
+
+        segment = ArthurItemsSegment(os.path.join(self.spill_dir, 'segment'))
+        segment.COMPACT_MIN_SIZE = 100
+        segment.COMPACT_CHUNK = 7
+
+        payloads = [('payload %i' % i).encode('utf-8') for i in range(1000)]
+        segment.append(payloads[0])
+        segment.append(payloads[1])
+        popped = []
+        max_file_size = 0
+        for payload in payloads[2:]:
+            segment.append(payload)
+            popped.append(segment.pop())
+            max_file_size = max(max_file_size, os.path.getsize(segment.path))
+        while segment.count:
+            popped.append(segment.pop())
+
+        # the items are read in order, and the file never grows beyond twice the compaction size
+        self.assertListEqual(popped, payloads)
+        self.assertLess(max_file_size, 2 * (segment.COMPACT_MIN_SIZE + 20))
+        self.assertEqual(segment.size, 0)
+
+        segment.close()
+
+    def test_spill(self):
+        """Test whether the items are spilled to disk when the memory is full"""
+
+        items = [arthur_item('tag_a', str(uuid)) for uuid in range(10)]
+        max_memory = sum([len(payload) for (_, payload) in items[:3]])
+
+        buffer = ArthurItemsBuffer()
+        buffer.set_spill(max_memory, self.spill_dir)
+        for (_, payload) in items:
+            buffer.append(ArthurItem(payload))
+
+        self.assertFalse(buffer.is_full)
+        self.assertEqual(buffer.size, max_memory)
+        self.assertEqual(buffer.spilled_size, sum([len(payload) for (_, payload) in items[3:]]))
+        self.assertEqual(buffer.count('tag_a'), 10)
+        self.assertEqual(len(buffer), 10)
+
+        # items are consumed from memory first and then from disk
+        popped = [buffer.pop('tag_a') for _ in range(10)]
+        self.assertEqual(popped[:3], [item for (item, _) in reversed(items[:3])])
+        self.assertEqual(popped[3:], [item for (item, _) in items[3:]])
+        self.assertIsNone(buffer.pop('tag_a'))
+        self.assertEqual(buffer.size, 0)
+        self.assertEqual(buffer.spilled_size, 0)
+
+        buffer.remove_tag('tag_a')
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_spill_removed_tag(self):
+        """Test whether no segments are left for the items of a tag removed while they are appended"""
+
+        _, payload = arthur_item('tag_a', '1')
+        buffer = ArthurItemsBuffer()
+        buffer.set_spill(0, self.spill_dir)
+        buffer.append(ArthurItem(payload))
+        queue = buffer._queues['tag_a']
+
+        buffer.remove_tag('tag_a')
+        # an append which got the queue before the tag was removed
+        with unittest.mock.patch.object(buffer, '_ArthurItemsBuffer__get_queue', return_value=queue):
+            self.assertTrue(buffer.append(ArthurItem(payload)))
+
+        self.assertIsNone(queue.segment)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_full(self):
+        """Test whether the buffer is full without a spill directory"""
+
+        _, payload = arthur_item('tag_a', '1')
+
+        buffer = ArthurItemsBuffer(max_memory=len(payload) - 1)
+        self.assertFalse(buffer.is_full)
+        buffer.append(ArthurItem(payload))
+        self.assertTrue(buffer.is_full)
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')
@@ -124,6 +124,55 @@ class TestConfig(unittest.TestCase):
         with self.assertRaises(Exception):
             Config(CONF_WRONG)
 
+    def test_check_config_dag(self):
+        """Test whether the options not supported by the dag scheduler are warned"""
+
+        config = Config(CONF_FULL)
+        conf = config.get_conf()
+        conf['general']['scheduler'] = 'dag'
+        conf['general']['process_managers'] = True
+
+        with self.assertLogs(logger, level='WARNING') as cm:
+            Config.check_config(conf)
+        self.assertEqual(cm.output, ['WARNING:sirmordred.config:general.process_managers is ignored by the dag scheduler'])
+
+    def test_check_config_process_managers_arthur(self):
+        """Test whether the process managers are rejected when arthur is enabled"""
+
+        config = Config(CONF_FULL)
+        conf = config.get_conf()
+        conf['general']['process_managers'] = True
+        conf['es_collection']['arthur'] = True
+
+        with self.assertRaises(RuntimeError):
+            Config.check_config(conf)
+
+        # the dag scheduler ignores the process managers
+        conf['general']['scheduler'] = 'dag'
+        with self.assertLogs(logger, level='WARNING'):
+            Config.check_config(conf)
+
+        conf['general']['scheduler'] = 'managers'
+        conf['es_collection']['arthur'] = False
+        Config.check_config(conf)
+
+    def test_check_config_values(self):
+        """Test whether the params with a set of allowed values are checked"""
+
+        config = Config(CONF_FULL)
+        conf = config.get_conf()
+        conf['es_enrichment']['enrich_pool'] = 'process'
+        Config.check_config(conf)
+
+        conf['general']['scheduler'] = 'graph'
+        with self.assertRaises(RuntimeError):
+            Config.check_config(conf)
+
+        conf['general']['scheduler'] = 'dag'
+        conf['es_enrichment']['enrich_pool'] = 'threads'
+        with self.assertRaises(RuntimeError):
+            Config.check_config(conf)
+
     def test_get_data_sources(self):
         """Test whether all data sources are properly retrieved"""
 
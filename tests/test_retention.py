@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+
+import json
+import sys
+import time
+import unittest
+
+import httpretty
+import requests
+
+# Hack to make sure that tests import the right packages
+# due to setuptools behaviour
+sys.path.insert(0, '..')
+
+from sirmordred.retention import DataRetention
+
+ES_URL = 'http://localhost:9200'
+INDEX = 'git_test-raw'
+INDEX_URL = ES_URL + '/' + INDEX
+TASK_ID = 'node:1234'
+
+
+def setup_http_server(oldest_hours, completed=False):
+    """Serve an index with its oldest item oldest_hours ago and the delete tasks"""
+
+    http_requests = []
+
+    def search_callback(request, uri, headers):
+        http_requests.append(request)
+        oldest = (time.time() - oldest_hours * 3600) * 1000 if oldest_hours is not None else None
+        return 200, headers, json.dumps({"aggregations": {"oldest": {"value": oldest}}})
+
+    def delete_callback(request, uri, headers):
+        http_requests.append(request)
+        return 200, headers, json.dumps({"task": TASK_ID})
+
+    def task_callback(request, uri, headers):
+        http_requests.append(request)
+        return 200, headers, json.dumps({"completed": completed, "response": {"deleted": 10}})
+
+    def task_result_callback(request, uri, headers):
+        http_requests.append(request)
+        return 200, headers, json.dumps({"deleted": 1})
+
+    httpretty.register_uri(httpretty.POST, INDEX_URL + '/_search', body=search_callback)
+    httpretty.register_uri(httpretty.POST, INDEX_URL + '/_delete_by_query', body=delete_callback)
+    httpretty.register_uri(httpretty.GET, ES_URL + '/_tasks/' + TASK_ID, body=task_callback)
+    httpretty.register_uri(httpretty.POST, ES_URL + '/.tasks/_delete_by_query', body=task_result_callback)
+
+    return http_requests
+
+
+class TestDataRetention(unittest.TestCase):
+    """DataRetention tests"""
+
+    def tearDown(self):
+        DataRetention.tasks.clear()
+
+    def test_retention_disabled(self):
+        """Test whether no items are deleted when the retention is disabled"""
+
+        retention = DataRetention(requests.Session())
+        self.assertIsNone(retention.retain(None, ES_URL, INDEX))
+        self.assertIsNone(retention.retain(0, ES_URL, INDEX))
+
+    @httpretty.activate
+    def test_retain(self):
+        """Test whether the old items are deleted in a background ES task"""
+
+        http_requests = setup_http_server(oldest_hours=48)
+
+        retention = DataRetention(requests.Session(), slices=4, requests_per_second=500)
+        task_id = retention.retain(24, ES_URL, INDEX)
+        self.assertEqual(task_id, TASK_ID)
+        self.assertEqual(len(http_requests), 2)
+
+        delete_request = http_requests[-1]
+        self.assertEqual(delete_request.path.split('?')[0], '/' + INDEX + '/_delete_by_query')
+        self.assertDictEqual(delete_request.querystring, {
+            'wait_for_completion': ['false'],
+            'conflicts': ['proceed'],
+            'slices': ['4'],
+            'requests_per_second': ['500']
+        })
+        query = json.loads(delete_request.body)
+        self.assertIn('lte', query['query']['range']['metadata__updated_on'])
+        self.assertDictEqual(DataRetention.tasks, {INDEX_URL: (ES_URL, TASK_ID)})
+
+    @httpretty.activate
+    def test_retain_no_old_items(self):
+        """Test whether the index is skipped when its oldest item is newer than the horizon"""
+
+        http_requests = setup_http_server(oldest_hours=12)
+
+        retention = DataRetention(requests.Session())
+        self.assertIsNone(retention.retain(24, ES_URL, INDEX))
+        self.assertEqual(len(http_requests), 1)
+        self.assertEqual(http_requests[0].path, '/' + INDEX + '/_search')
+
+        http_requests = setup_http_server(oldest_hours=None)
+        self.assertIsNone(retention.retain(24, ES_URL, INDEX))
+        self.assertEqual(len(http_requests), 1)
+
+    @httpretty.activate
+    def test_retain_running(self):
+        """Test whether a new task is not submitted while the previous one is running"""
+
+        http_requests = setup_http_server(oldest_hours=48)
+
+        retention = DataRetention(requests.Session())
+        self.assertEqual(retention.retain(24, ES_URL, INDEX), TASK_ID)
+
+        # the task is running, only its status is checked
+        del http_requests[:]
+        self.assertIsNone(retention.retain(24, ES_URL, INDEX))
+        self.assertEqual(len(http_requests), 1)
+        self.assertEqual(http_requests[0].path, '/_tasks/' + TASK_ID)
+        self.assertTrue(retention.is_running(INDEX_URL))
+
+        # the task is completed, a new one is submitted
+        http_requests = setup_http_server(oldest_hours=48, completed=True)
+        self.assertEqual(retention.retain(24, ES_URL, INDEX), TASK_ID)
+        self.assertEqual([request.path.split('?')[0] for request in http_requests],
+                         ['/_tasks/' + TASK_ID, '/.tasks/_delete_by_query',
+                          '/' + INDEX + '/_search', '/' + INDEX + '/_delete_by_query'])
+
+        # the result of the completed task is deleted
+        result_request = http_requests[1]
+        self.assertDictEqual(json.loads(result_request.body), {"query": {"ids": {"values": [TASK_ID]}}})
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')
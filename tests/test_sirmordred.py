@@ -23,6 +23,7 @@
 
 import sys
 import unittest
+import unittest.mock
 
 # Hack to make sure that tests import the right packages
 # due to setuptools behaviour
@@ -30,6 +31,9 @@ sys.path.insert(0, '..')
 
 from sirmordred.config import Config
 from sirmordred.sirmordred import logger, SirMordred
+from sirmordred.task_enrich import TaskEnrich
+from sirmordred.task_identities import TaskIdentitiesMerge
+from sirmordred.task_projects import TaskProjects
 
 CONF_FILE = 'test.cfg'
 
@@ -72,6 +76,62 @@ class TestTaskRawDataCollection(unittest.TestCase):
             self.sirmordred.check_es_access()
             self.assertTrue(cm.output[-1], 'ERROR:sirmordred.sirmordred:Cannot connect to Elasticsearch: ')
 
+    def test_execute_dag_tasks_global_tasks(self):
+        """Test whether the global tasks are included in the DAG cycles every sleep_for seconds, or when forced"""
+
+        tasks_cls = [TaskProjects, TaskIdentitiesMerge]
+        self.config.conf['sortinghat']['sleep_for'] = 3600
+        self.sirmordred.dag_tasks[(TaskProjects, None)] = unittest.mock.Mock()
+
+        with unittest.mock.patch.object(SirMordred, 'build_tasks_graph') as mock_graph:
+            self.sirmordred.execute_dag_tasks(tasks_cls)
+            self.sirmordred.execute_dag_tasks(tasks_cls)
+            self.sirmordred.execute_dag_tasks(tasks_cls, global_tasks=True)
+
+        self.assertEqual([call[0][1] for call in mock_graph.call_args_list], [True, False, True])
+
+    def test_build_tasks_graph(self):
+        """Test whether the enrichment steps are chained in the order of TaskEnrich.execute"""
+
+        with unittest.mock.patch.object(SirMordred, '_get_repos_by_backend', return_value={'git': []}), \
+                unittest.mock.patch('sirmordred.sirmordred.TaskEnrich.__init__', return_value=None), \
+                unittest.mock.patch('sirmordred.sirmordred.TaskEnrich.set_backend_section'):
+            scheduler = self.sirmordred.build_tasks_graph([TaskEnrich])
+
+        deps = {name: node.deps for name, node in scheduler.nodes.items()}
+        self.assertDictEqual(deps, {
+            'enrich:git': [],
+            'autorefresh:git': ['enrich:git'],
+            'studies:git': ['autorefresh:git'],
+            'autorefresh_studies:git': ['studies:git']
+        })
+
+    def test_execute_dag_tasks_projects(self):
+        """Test whether the backend nodes are built from the projects updated in the same cycle"""
+
+        projects = {'grimoire': {'git': ['https://github.com/chaoss/grimoirelab-perceval']}}
+        projects_task = unittest.mock.Mock()
+        projects_task.execute.side_effect = lambda: TaskProjects.set_projects(projects)
+        self.sirmordred.dag_tasks[(TaskProjects, None)] = projects_task
+        TaskProjects.set_projects({})
+
+        schedulers = []
+        build_tasks_graph = self.sirmordred.build_tasks_graph
+
+        def build(*args):
+            schedulers.append(build_tasks_graph(*args))
+            return schedulers[-1]
+
+        with unittest.mock.patch.object(self.sirmordred, 'build_tasks_graph', side_effect=build), \
+                unittest.mock.patch('sirmordred.sirmordred.TasksScheduler.run'), \
+                unittest.mock.patch('sirmordred.sirmordred.TaskEnrich.__init__', return_value=None), \
+                unittest.mock.patch('sirmordred.sirmordred.TaskEnrich.set_backend_section'):
+            self.sirmordred.execute_dag_tasks([TaskProjects, TaskEnrich], global_tasks=False)
+
+        projects_task.execute.assert_called_once_with()
+        self.assertListEqual(sorted(schedulers[0].nodes),
+                             ['autorefresh:git', 'autorefresh_studies:git', 'enrich:git', 'studies:git'])
+
 
 if __name__ == "__main__":
     unittest.main(warnings='ignore')
@@ -25,7 +25,9 @@ import os
 import json
 import sys
 import unittest
+import unittest.mock
 
+import requests
 
 # Hack to make sure that tests import the right packages
 # due to setuptools behaviour
@@ -33,6 +35,7 @@ sys.path.insert(0, '..')
 
 from sirmordred.config import Config
 from sirmordred.task import Task
+from sirmordred.task_projects import TaskProjects
 
 CONF_FILE = 'test.cfg'
 BACKEND_NAME = 'stackexchange'
@@ -100,6 +103,136 @@ class TestTask(unittest.TestCase):
 
         self.assertEqual(task._get_collection_url(), COLLECTION_URL_STACKEXCHANGE)
 
+    @unittest.mock.patch('sirmordred.task.get_ocean_backend')
+    @unittest.mock.patch('sirmordred.task.get_elastic')
+    @unittest.mock.patch('sirmordred.task.get_connector_from_name')
+    def test_get_backends_cached(self, mock_connector, mock_elastic, mock_ocean):
+        """Test whether the backends are built again only when the projects or the config change"""
+
+        enrich_class = unittest.mock.MagicMock(side_effect=lambda *args: unittest.mock.MagicMock())
+        ocean_class = unittest.mock.MagicMock()
+        ocean_class.get_p2o_params_from_url.side_effect = lambda repo: {'url': repo}
+        mock_connector.return_value = [None, ocean_class, enrich_class]
+        mock_ocean.side_effect = lambda *args: unittest.mock.MagicMock()
+
+        config = Config(CONF_FILE)
+        TaskProjects.set_projects({'grimoire': {'git': ['https://github.com/chaoss/grimoirelab-perceval']}})
+        Task.invalidate_backends()
+        task = Task(config)
+        task.backend_section = 'git'
+
+        enrich_backend = task._get_enrich_backend()
+        task._get_ocean_backend(enrich_backend)
+        self.assertIs(task._get_enrich_backend(), enrich_backend)
+        self.assertEqual(enrich_class.call_count, 1)
+        self.assertEqual(mock_elastic.call_count, 2)
+
+        # the projects change
+        TaskProjects.set_projects({'grimoire': {'git': ['https://github.com/chaoss/grimoirelab-elk']}})
+        self.assertIsNot(task._get_enrich_backend(), enrich_backend)
+        self.assertEqual(enrich_class.call_count, 2)
+
+        # the config changes
+        enrich_backend = task._get_enrich_backend()
+        config.set_param('git', 'studies', ['enrich_demography:git'])
+        self.assertIsNot(task._get_enrich_backend(), enrich_backend)
+        self.assertEqual(enrich_class.call_count, 3)
+
+        # explicit invalidation
+        enrich_backend = task._get_enrich_backend()
+        Task.invalidate_backends('git')
+        self.assertIsNot(task._get_enrich_backend(), enrich_backend)
+        self.assertEqual(enrich_class.call_count, 4)
+
+        Task.invalidate_backends()
+
+    def test_backends_cache_key(self):
+        """Test whether the backends cache key changes only when the projects or the config are updated"""
+
+        config = Config(CONF_FILE)
+        task = Task(config)
+        task.backend_section = 'git'
+
+        key = task._backends_cache_key()
+        self.assertEqual(task._backends_cache_key(), key)
+
+        # the config of other backend sections does not change the key
+        config.set_param('mbox', 'raw_index', 'mbox_test_new-raw')
+        self.assertEqual(task._backends_cache_key(), key)
+
+        config.set_param('git', 'studies', ['enrich_demography:git'])
+        self.assertNotEqual(task._backends_cache_key(), key)
+
+        key = task._backends_cache_key()
+        config.set_param('es_enrichment', 'url', 'http://localhost:9201')
+        self.assertNotEqual(task._backends_cache_key(), key)
+
+        key = task._backends_cache_key()
+        TaskProjects.set_projects({'grimoire': {'git': ['https://github.com/chaoss/grimoirelab-elk']}})
+        self.assertNotEqual(task._backends_cache_key(), key)
+
+    @unittest.mock.patch('sirmordred.task.get_ocean_backend')
+    @unittest.mock.patch('sirmordred.task.get_elastic')
+    @unittest.mock.patch('sirmordred.task.get_connector_from_name')
+    def test_get_ocean_backend_cycles(self, mock_connector, mock_elastic, mock_ocean):
+        """Test whether the ocean backend of each cycle starts from the last enriched item"""
+
+        enrich_class = unittest.mock.MagicMock(side_effect=lambda *args: unittest.mock.MagicMock())
+        ocean_class = unittest.mock.MagicMock()
+        ocean_class.get_p2o_params_from_url.side_effect = lambda repo: {'url': repo}
+        mock_connector.return_value = [None, ocean_class, enrich_class]
+
+        def new_ocean_backend(backend_cmd, enrich_backend, *args):
+            ocean_backend = unittest.mock.MagicMock()
+            ocean_backend.from_date = enrich_backend.get_last_update_from_es()
+            ocean_backend.set_elastic.side_effect = lambda elastic: setattr(ocean_backend, 'elastic', elastic)
+            return ocean_backend
+        mock_ocean.side_effect = new_ocean_backend
+
+        config = Config(CONF_FILE)
+        TaskProjects.set_projects({'grimoire': {'git': ['https://github.com/chaoss/grimoirelab-perceval']}})
+        task = Task(config)
+        task.backend_section = 'git'
+
+        # first cycle
+        enrich_backend = task._get_enrich_backend()
+        enrich_backend.get_last_update_from_es.return_value = '2020-01-01'
+        ocean_backend = task._get_ocean_backend(enrich_backend)
+        self.assertEqual(ocean_backend.from_date, '2020-01-01')
+
+        # second cycle, the enriched index has new items
+        enrich_backend.get_last_update_from_es.return_value = '2020-02-01'
+        self.assertIs(task._get_enrich_backend(), enrich_backend)
+        second_ocean_backend = task._get_ocean_backend(enrich_backend)
+        self.assertEqual(second_ocean_backend.from_date, '2020-02-01')
+
+        # the connection to the raw index is reused
+        self.assertIs(second_ocean_backend.elastic, ocean_backend.elastic)
+        self.assertEqual(mock_elastic.call_count, 2)
+
+        # the config and projects updates drop the cached backends
+        config.set_param('es_collection', 'url', 'http://localhost:9201')
+        self.assertIsNone(Task.backends_cache.get('git'))
+        task._get_enrich_backend()
+        TaskProjects.set_projects({'grimoire': {'git': ['https://github.com/chaoss/grimoirelab-elk']}})
+        self.assertIsNone(Task.backends_cache.get('git'))
+
+        Task.invalidate_backends()
+
+    @unittest.mock.patch('sirmordred.task.DataRetention.retain')
+    def test_retain_data_errors(self, mock_retain):
+        """Test whether only the transport errors of the data retention are caught"""
+
+        config = Config(CONF_FILE)
+        task = Task(config)
+
+        mock_retain.side_effect = requests.exceptions.ConnectionError('refused')
+        task.retain_data(1, 'http://localhost:9200', 'git_test')
+
+        mock_retain.side_effect = KeyError('task')
+        with self.assertRaises(KeyError):
+            task.retain_data(1, 'http://localhost:9200', 'git_test')
+
 
 if __name__ == "__main__":
     unittest.main(warnings='ignore')
@@ -26,6 +26,7 @@ import unittest
 
 import requests
 
+from sortinghat import api
 from sortinghat.db.database import Database
 
 # Hack to make sure that tests import the right packages
@@ -99,6 +100,64 @@ class TestTaskEnrich(unittest.TestCase):
         # see [git] section in tests/test-projects.json
         self.assertGreater(raw_items, enriched_items)
 
+    def test_run_pooled(self):
+        """Test whether the Task could be run with the pooled enrichment"""
+        config = Config(CONF_FILE)
+        cfg = config.get_conf()
+        cfg['es_enrichment']['pooled_enrichment'] = True
+        cfg['es_enrichment']['enrich_workers'] = 2
+        # We need to load the projects
+        TaskProjects(config).execute()
+        backend_section = GIT_BACKEND_SECTION
+        task = TaskEnrich(config, backend_section=backend_section)
+        self.assertEqual(task.execute(), None)
+        pool = task.enrich_pool[1]
+
+        # The pool, and the backends of its workers, are reused in the next executions
+        self.assertEqual(task.execute(), None)
+        self.assertIs(task.enrich_pool[1], pool)
+        cfg['es_enrichment']['enrich_workers'] = 3
+        self.assertEqual(task.execute(), None)
+        self.assertIsNot(task.enrich_pool[1], pool)
+
+        # The backends of a worker are its own, not the ones shared by the tasks
+        repo = 'https://github.com/MetricsGrimoire/CMetrics'
+        (enriched_repo, items, spent) = task.enrich_repo(repo)
+        self.assertEqual(enriched_repo, repo)
+        (key, backends) = task.pooled_backends
+        self.assertEqual(key, task._backends_cache_key())
+        self.assertIsNot(backends[1], task._get_enrich_backend())
+
+        # The backends are reused until the config of the section changes
+        task.enrich_repo(repo)
+        self.assertIs(task.pooled_backends[1], backends)
+        config.set_param(backend_section, 'studies', [])
+        task.enrich_repo(repo)
+        self.assertIsNot(task.pooled_backends[1], backends)
+
+    def test_run_pooled_identities(self):
+        """Test whether the pooled enrichment loads the identities as the non pooled one"""
+        config = Config(CONF_FILE)
+        cfg = config.get_conf()
+        # We need to load the projects
+        TaskProjects(config).execute()
+        backend_section = GIT_BACKEND_SECTION
+        task = TaskEnrich(config, backend_section=backend_section)
+        self.assertEqual(task.execute(), None)
+
+        uuids = sorted([uidentity.uuid for uidentity in api.unique_identities(self.sh_db)])
+        self.assertNotEqual(uuids, [])
+
+        # Enrich again with the pooled enrichment on an empty database
+        Database.drop(**self.sh_kwargs)
+        Database.create(**self.sh_kwargs)
+        cfg['es_enrichment']['pooled_enrichment'] = True
+        task = TaskEnrich(config, backend_section=backend_section)
+        self.assertEqual(task.execute(), None)
+
+        pooled_uuids = sorted([uidentity.uuid for uidentity in api.unique_identities(self.sh_db)])
+        self.assertListEqual(pooled_uuids, uuids)
+
     def test_studies(self):
         """Test whether the studies configuration works """
         config = Config(CONF_FILE)
@@ -20,26 +20,45 @@
 # Authors:
 #     Alvaro del Castillo <acs@bitergia.com>
 
+import base64
+import collections
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
 import sys
 import unittest
+import unittest.mock
 
 import httpretty
 
 from sortinghat import api
+from sortinghat.command import CMD_FAILURE, CMD_SUCCESS
 from sortinghat.db.database import Database
+from sortinghat.db.model import Profile
+from sortinghat.exceptions import NotFoundError
 
 # Hack to make sure that tests import the right packages
 # due to setuptools behaviour
 sys.path.insert(0, '..')
 
 from sirmordred.config import Config
-from sirmordred.task_identities import TaskIdentitiesLoad, TaskIdentitiesMerge
+from sirmordred.task_identities import (IdentitiesSnapshot, SortingHatCommands, TaskIdentitiesExport,
+                                        TaskIdentitiesLoad, TaskIdentitiesMerge, logger)
 
 
 CONF_FILE = 'test.cfg'
 REMOTE_IDENTITIES_FILE = 'data/remote_identities_sortinghat.json'
 # REMOTE_IDENTITIES_FILE_URL = 'http://example.com/identities.json'
 REMOTE_IDENTITIES_FILE_URL = 'https://github.com/fake/repo/identities.json'
+GITHUB_IDENTITIES_FILE_URL = 'https://github.com/fake/repo/blob/master/identities.json'
+GITHUB_TREE_URL = 'https://api.github.com/repos/fake/repo/git/trees/master'
+GITHUB_BLOBS_URL = 'https://api.github.com/repos/fake/repo/git/blobs/'
+GITHUB_EXPORT_FILE_URL = 'https://github.com/fake/repo/blob/master/identities.json.gz'
+GITHUB_CONTENTS_URL = 'https://api.github.com/repos/fake/repo/contents/identities.json.gz'
+LOCAL_IDENTITIES_FILE = 'data/perceval_identities_sortinghat.json'
 
 
 def read_file(filename, mode='r'):
@@ -71,6 +90,534 @@ def setup_http_server():
     return http_requests
 
 
+class MockFilteredIdentity():
+    """Filtered identity with the email as matching criteria"""
+
+    def __init__(self, uuid, email):
+        self.uuid = uuid
+        self.email = email
+
+    def to_dict(self):
+        return {'id': self.uuid, 'uuid': self.uuid, 'email': self.email}
+
+
+class MockEmailMatcher():
+    """Matcher by email supporting the fast mode"""
+
+    def filter(self, uidentity):
+        return [MockFilteredIdentity(uidentity.uuid, email) for email in uidentity.emails]
+
+    @staticmethod
+    def matching_criteria():
+        return ['email']
+
+
+class MockCommand():
+    """sortinghat command connecting to its own database when it is created"""
+
+    def __init__(self, **kwargs):
+        self.calls = []
+        self._set_database(**kwargs)
+
+    def _set_database(self, **kwargs):
+        self.db = 'own database'
+
+    def unify(self, **kwargs):
+        self.calls.append(('unify', kwargs))
+        return CMD_SUCCESS
+
+    def affiliate(self):
+        self.calls.append(('affiliate', {}))
+        return CMD_SUCCESS
+
+    def autocomplete(self, sources):
+        self.calls.append(('autocomplete', {'sources': sources}))
+        return CMD_SUCCESS
+
+
+class MockFailingCommand(MockCommand):
+    """sortinghat command failing when it is created"""
+
+    def __init__(self, **kwargs):
+        raise RuntimeError('command error')
+
+
+class MockFailingRunCommand(MockCommand):
+    """sortinghat command failing when it is run"""
+
+    def unify(self, **kwargs):
+        self.calls.append(('unify', kwargs))
+        raise RuntimeError('unify error')
+
+
+def setup_http_server_github(blobs):
+    """Serve the identities files in blobs, by SHA, with the GitHub Data API"""
+
+    http_requests = []
+
+    def tree_callback(request, uri, headers):
+        http_requests.append(request)
+        tree = [{'path': 'identities.json', 'sha': sha} for sha in blobs]
+        return 200, headers, json.dumps({'tree': tree})
+
+    def blob_callback(request, uri, headers):
+        http_requests.append(request)
+        content = base64.b64encode(blobs[uri.rsplit('/', 1)[1]].encode('utf-8')).decode('utf-8')
+        return 200, headers, json.dumps({'content': content})
+
+    httpretty.register_uri(httpretty.GET, GITHUB_TREE_URL, body=tree_callback)
+    httpretty.register_uri(httpretty.GET, re.compile(GITHUB_BLOBS_URL + '.*'), body=blob_callback)
+
+    return http_requests
+
+
+class TestSortingHatCommands(unittest.TestCase):
+    """SortingHatCommands tests"""
+
+    def setUp(self):
+        self.sh_kwargs = {'user': 'root', 'password': 'pass', 'database': 'test_sh',
+                          'host': 'localhost', 'port': None}
+
+    def tearDown(self):
+        SortingHatCommands.databases.clear()
+
+    @unittest.mock.patch('sirmordred.task_identities.subprocess.Popen')
+    @unittest.mock.patch('sirmordred.task_identities.Affiliate', MockCommand)
+    @unittest.mock.patch('sirmordred.task_identities.Unify', MockCommand)
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_inprocess(self, mock_database, mock_popen):
+        """Test whether the commands are executed in process sharing the database"""
+
+        commands = SortingHatCommands(self.sh_kwargs, inprocess=True)
+        self.assertEqual(commands.unify('email', False), CMD_SUCCESS)
+        self.assertEqual(commands.unify('username', True), CMD_SUCCESS)
+        self.assertEqual(commands.affiliate(), CMD_SUCCESS)
+
+        # the commands are created once, and share the database without connecting their own
+        command = commands.commands[MockCommand]
+        self.assertIsInstance(command, MockCommand)
+        self.assertEqual(mock_database.call_count, 1)
+        self.assertIs(command.db, mock_database.return_value)
+        self.assertEqual(command.calls, [
+            ('unify', {'matching': 'email', 'fast_matching': True, 'no_strict_matching': True}),
+            ('unify', {'matching': 'username', 'fast_matching': True, 'no_strict_matching': False}),
+            ('affiliate', {})
+        ])
+        mock_popen.assert_not_called()
+
+    @unittest.mock.patch('sirmordred.task_identities.subprocess.Popen')
+    @unittest.mock.patch('sirmordred.task_identities.AutoProfile', MockCommand)
+    @unittest.mock.patch('sirmordred.task_identities.Unify', MockFailingCommand)
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_cli_fallback(self, mock_database, mock_popen):
+        """Test whether the sortinghat CLI is used when the command can not be executed in process"""
+
+        mock_popen.return_value.communicate.return_value = (b'', None)
+        mock_popen.return_value.returncode = 0
+
+        commands = SortingHatCommands(self.sh_kwargs, inprocess=True)
+        self.assertEqual(commands.unify('email', False), 0)
+
+        expected = ['sortinghat', '-u', 'root', '-p', 'pass', '--host', 'localhost', '-d', 'test_sh',
+                    'unify', '--fast-matching', '-m', 'email', '--no-strict-matching']
+        self.assertEqual(mock_popen.call_args[0][0], expected)
+
+        # the CLI is used directly when the commands are not executed in process, the default
+        commands = SortingHatCommands(self.sh_kwargs)
+        self.assertEqual(commands.autoprofile(['git', 'github']), 0)
+        self.assertDictEqual(commands.commands, {})
+        self.assertEqual(mock_popen.call_args[0][0][-3:], ['autoprofile', 'git', 'github'])
+
+    @unittest.mock.patch('sirmordred.task_identities.subprocess.Popen')
+    @unittest.mock.patch('sirmordred.task_identities.Unify', MockFailingRunCommand)
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_run_failure(self, mock_database, mock_popen):
+        """Test whether the errors of a command run in process are reported and not run again with the CLI"""
+
+        commands = SortingHatCommands(self.sh_kwargs, inprocess=True)
+        with self.assertLogs(logger, level='ERROR') as cm:
+            self.assertEqual(commands.unify('email', False), CMD_FAILURE)
+        self.assertIn('unify error', cm.output[-1])
+
+        self.assertEqual(len(commands.commands[MockFailingRunCommand].calls), 1)
+        mock_popen.assert_not_called()
+
+    @unittest.mock.patch('sirmordred.task_identities.create_identity_matcher')
+    @unittest.mock.patch('sirmordred.task_identities.api')
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_unify_incremental(self, mock_database, mock_api, mock_matcher):
+        """Test whether only the identities matching the modified ones are merged"""
+
+        uidentities = {
+            'a': ['a@example.com'],
+            'b': ['a@example.com', 'b@example.com'],
+            'c': ['b@example.com'],
+            'd': ['d@example.com'],
+            'e': ['d@example.com'],
+            'f': ['f@example.com']
+        }
+        mock_api.unique_identities.return_value = [unittest.mock.Mock(uuid=uuid, emails=emails)
+                                                   for uuid, emails in uidentities.items()]
+        mock_matcher.return_value = MockEmailMatcher()
+
+        commands = SortingHatCommands(self.sh_kwargs)
+        self.assertEqual(commands.unify_incremental('email', True, ['c', 'f']), CMD_SUCCESS)
+
+        # c is merged with b, and transitively with a; d and e are not matched
+        mock_api.merge_unique_identities.assert_has_calls([
+            unittest.mock.call(mock_database.return_value, 'b', 'a'),
+            unittest.mock.call(mock_database.return_value, 'c', 'a')
+        ])
+        self.assertEqual(mock_api.merge_unique_identities.call_count, 2)
+
+    @unittest.mock.patch('sirmordred.task_identities.subprocess.Popen')
+    @unittest.mock.patch('sirmordred.task_identities.Unify', MockCommand)
+    @unittest.mock.patch('sirmordred.task_identities.create_identity_matcher')
+    @unittest.mock.patch('sirmordred.task_identities.api')
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_unify_snapshot(self, mock_database, mock_api, mock_matcher, mock_popen):
+        """Test whether the algorithms of a unify share the snapshot of the unique identities"""
+
+        uidentities = {
+            'a': ['a@example.com'],
+            'b': ['a@example.com', 'b@example.com'],
+            'c': ['c@example.com'],
+            'd': ['c@example.com']
+        }
+
+        def unique_identities(db, uuid=None):
+            if uuid:
+                return [unittest.mock.Mock(uuid=uuid, emails=[])]
+            return [unittest.mock.Mock(uuid=uuid, emails=emails) for uuid, emails in uidentities.items()]
+
+        mock_api.unique_identities.side_effect = unique_identities
+        mock_matcher.return_value = MockEmailMatcher()
+
+        commands = SortingHatCommands(self.sh_kwargs, inprocess=True)
+        snapshot = IdentitiesSnapshot(SortingHatCommands.get_database(self.sh_kwargs))
+        self.assertEqual(commands.unify('email', True, snapshot), CMD_SUCCESS)
+        self.assertEqual(commands.unify_incremental('email-name', True, ['a'], snapshot), CMD_SUCCESS)
+
+        # all the identities are loaded once, then only the ones merged into
+        mock_api.unique_identities.assert_has_calls([
+            unittest.mock.call(mock_database.return_value),
+            unittest.mock.call(mock_database.return_value, uuid='a'),
+            unittest.mock.call(mock_database.return_value, uuid='c')
+        ])
+        self.assertEqual(mock_api.unique_identities.call_count, 3)
+        mock_api.merge_unique_identities.assert_has_calls([
+            unittest.mock.call(mock_database.return_value, 'b', 'a'),
+            unittest.mock.call(mock_database.return_value, 'd', 'c')
+        ])
+        self.assertEqual(mock_api.merge_unique_identities.call_count, 2)
+        self.assertListEqual(sorted(snapshot.get_unique_identities()), ['a', 'c'])
+        mock_popen.assert_not_called()
+
+        # the snapshot is loaded again after a unify out of it
+        mock_matcher.return_value = unittest.mock.Mock(**{'matching_criteria.side_effect': NotImplementedError})
+        self.assertEqual(commands.unify('default', True, snapshot), CMD_SUCCESS)
+        self.assertEqual(commands.commands[MockCommand].calls[-1][0], 'unify')
+        self.assertIsNone(snapshot.uidentities)
+        mock_popen.assert_not_called()
+
+    @unittest.mock.patch('sirmordred.task_identities.subprocess.Popen')
+    @unittest.mock.patch('sirmordred.task_identities.create_identity_matcher')
+    @unittest.mock.patch('sirmordred.task_identities.api')
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_unify_incremental_refresh(self, mock_database, mock_api, mock_matcher, mock_popen):
+        """Test whether the incremental unifies only load the modified identities"""
+
+        uidentities = {
+            'a': ['a@example.com'],
+            'b': ['b@example.com']
+        }
+
+        def unique_identities(db, uuid=None):
+            if uuid:
+                if uuid not in uidentities:
+                    raise NotFoundError(entity=uuid)
+                return [unittest.mock.Mock(uuid=uuid, emails=uidentities[uuid])]
+            return [unittest.mock.Mock(uuid=uuid, emails=emails) for uuid, emails in uidentities.items()]
+
+        mock_api.unique_identities.side_effect = unique_identities
+        mock_matcher.return_value = MockEmailMatcher()
+
+        commands = SortingHatCommands(self.sh_kwargs)
+        snapshot = IdentitiesSnapshot(SortingHatCommands.get_database(self.sh_kwargs))
+        self.assertEqual(commands.unify_incremental('email', True, ['a', 'b'], snapshot), CMD_SUCCESS)
+        mock_api.merge_unique_identities.assert_not_called()
+
+        # 'c' is new and matches 'a', 'b' was removed
+        uidentities['c'] = ['a@example.com']
+        del uidentities['b']
+        snapshot.refresh(['b', 'c'])
+        self.assertListEqual(sorted(snapshot.get_unique_identities()), ['a', 'c'])
+        self.assertEqual(commands.unify_incremental('email', True, ['c'], snapshot), CMD_SUCCESS)
+        mock_api.merge_unique_identities.assert_called_once_with(mock_database.return_value, 'c', 'a')
+
+        # all the identities were loaded just once
+        self.assertEqual(mock_api.unique_identities.call_args_list.count(
+            unittest.mock.call(mock_database.return_value)), 1)
+        index, keys = list(snapshot.indexes.values())[0][2:]
+        self.assertDictEqual(index, {('email', 'a@example.com'): set(['a'])})
+        self.assertListEqual(list(keys), ['a'])
+
+        # a failure reading the blacklist is reported, without a full unify
+        mock_api.blacklist.side_effect = RuntimeError('database error')
+        with self.assertLogs(logger, level='ERROR') as cm:
+            self.assertEqual(commands.unify_incremental('email', True, ['a'], snapshot), CMD_FAILURE)
+        self.assertIn('database error', cm.output[-1])
+        mock_popen.assert_not_called()
+        self.assertIsNone(snapshot.uidentities)
+
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_merge_incremental(self, mock_database):
+        """Test whether the unify is skipped when no identities were modified since the last one"""
+
+        config = Config(CONF_FILE)
+        config.set_param('sortinghat', 'incremental_unify', True)
+        task = TaskIdentitiesMerge(config)
+        task.sh_commands = unittest.mock.Mock()
+        task.sh_commands.unify.return_value = CMD_SUCCESS
+        task.sh_commands.unify_incremental.return_value = CMD_SUCCESS
+
+        # the first unify is a full one
+        task.execute()
+        task.sh_commands.unify.assert_called_once_with('email', True, unittest.mock.ANY)
+        task.sh_commands.modified_unique_identities.assert_not_called()
+        self.assertIsNotNone(task.last_unify)
+
+        # nothing modified, the unify is skipped
+        last_unify = task.last_unify
+        task.sh_commands.modified_unique_identities.return_value = []
+        task.execute()
+        task.sh_commands.modified_unique_identities.assert_called_once_with(last_unify)
+        task.sh_commands.unify_incremental.assert_not_called()
+
+        # only the modified identities are unified
+        task.sh_commands.modified_unique_identities.return_value = ['a']
+        task.execute()
+        task.sh_commands.unify_incremental.assert_called_once_with('email', True, ['a'], unittest.mock.ANY)
+        self.assertEqual(task.sh_commands.unify.call_count, 1)
+
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_merge_incremental_algorithms(self, mock_database):
+        """Test whether the modified identities are refreshed between matching algorithms"""
+
+        config = Config(CONF_FILE)
+        config.set_param('sortinghat', 'incremental_unify', True)
+        config.set_param('sortinghat', 'matching', ['email', 'email-name'])
+        task = TaskIdentitiesMerge(config)
+        task.sh_commands = unittest.mock.Mock()
+        task.sh_commands.unify_incremental.return_value = CMD_SUCCESS
+        task.last_unify = datetime.datetime(2020, 1, 1)
+
+        # 'b' is merged into 'c' by the first algorithm
+        task.sh_commands.modified_unique_identities.side_effect = [['a', 'b'], ['a', 'c']]
+        task.execute()
+
+        self.assertEqual(task.sh_commands.modified_unique_identities.call_count, 2)
+        task.sh_commands.modified_unique_identities.assert_called_with(datetime.datetime(2020, 1, 1))
+        snapshot = task.sh_commands.unify_incremental.call_args[0][3]
+        self.assertIsInstance(snapshot, IdentitiesSnapshot)
+        calls = [unittest.mock.call('email', True, ['a', 'b'], snapshot),
+                 unittest.mock.call('email-name', True, ['a', 'c'], snapshot)]
+        self.assertEqual(task.sh_commands.unify_incremental.call_args_list, calls)
+
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_bots(self, mock_database):
+        """Test whether the bots are updated in bulk only when they change"""
+
+        ProfileRow = collections.namedtuple('ProfileRow', ['uuid', 'name', 'is_bot'])
+
+        config = Config(CONF_FILE)
+        task = TaskIdentitiesMerge(config)
+        session = task.db.connect.return_value.__enter__.return_value
+        query = session.query.return_value.filter.return_value
+        query.all.return_value = [ProfileRow('a', 'Bot A', False),
+                                  ProfileRow('b', 'Bot A', True),
+                                  ProfileRow('c', 'Bot C', True),
+                                  ProfileRow('d', 'Not Bot', True)]
+
+        task.do_bots(['Bot A', 'Bot C'], ['Not Bot'])
+
+        # a single query for all the names, and only the changed profiles are updated:
+        # 'a' as bot and 'd' as no bot, each one with the update of its unique identity
+        self.assertEqual(query.all.call_count, 1)
+        self.assertEqual(query.update.call_count, 4)
+        self.assertDictEqual(query.update.call_args_list[0][0][0], {Profile.is_bot: True})
+        self.assertDictEqual(query.update.call_args_list[2][0][0], {Profile.is_bot: False})
+        self.assertEqual(task.last_bots_state, ({'a', 'b', 'c'}, {'d'}))
+
+        # nothing changed, nothing is updated
+        query.all.return_value = [ProfileRow('a', 'Bot A', True),
+                                  ProfileRow('b', 'Bot A', True),
+                                  ProfileRow('c', 'Bot C', True),
+                                  ProfileRow('d', 'Not Bot', False)]
+        task.do_bots(['Bot A', 'Bot C'], ['Not Bot'])
+        self.assertEqual(query.all.call_count, 2)
+        self.assertEqual(query.update.call_count, 4)
+
+        # a new bot is found
+        query.all.return_value.append(ProfileRow('e', 'Bot C', False))
+        task.do_bots(['Bot A', 'Bot C'], ['Not Bot'])
+        self.assertEqual(query.update.call_count, 6)
+        self.assertEqual(task.last_bots_state, ({'a', 'b', 'c', 'e'}, {'d'}))
+
+
+class TestTaskIdentitiesLoadFiles(unittest.TestCase):
+    """Tests of the load of the identities files"""
+
+    @httpretty.activate
+    @unittest.mock.patch('sirmordred.task_identities.Init')
+    @unittest.mock.patch('sirmordred.task_identities.Load')
+    @unittest.mock.patch('sirmordred.task_identities.Database')
+    def test_load_changed_files(self, mock_database, mock_load, mock_init):
+        """Test whether only the changed identities files are loaded"""
+
+        blobs = {'sha1': '{"uidentities": {}}'}
+        http_requests = setup_http_server_github(blobs)
+        loaded_files = []
+
+        def load(*args):
+            with open(args[-1]) as f:
+                loaded_files.append(f.read())
+            return CMD_SUCCESS
+
+        mock_load.return_value.run.side_effect = load
+
+        config = Config(CONF_FILE)
+        config.set_param('sortinghat', 'identities_file', [LOCAL_IDENTITIES_FILE, GITHUB_IDENTITIES_FILE_URL])
+        config.set_param('sortinghat', 'load_orgs', False)
+        task = TaskIdentitiesLoad(config)
+        task.sh_commands = unittest.mock.Mock()
+
+        # all the files are loaded in order, and then unified
+        task.execute()
+        self.assertEqual(len(loaded_files), 2)
+        self.assertEqual(loaded_files[0], read_file(LOCAL_IDENTITIES_FILE))
+        self.assertEqual(loaded_files[1], blobs['sha1'])
+        self.assertEqual(task.identities_versions[GITHUB_IDENTITIES_FILE_URL], 'sha1')
+        self.assertEqual(task.sh_commands.unify.call_count, 1)
+        self.assertEqual(len(http_requests), 2)
+
+        # nothing changed, the blob is not downloaded and nothing is loaded nor unified
+        del http_requests[:]
+        task.execute()
+        self.assertEqual(len(loaded_files), 2)
+        self.assertEqual(task.sh_commands.unify.call_count, 1)
+        self.assertEqual([request.path for request in http_requests], ['/repos/fake/repo/git/trees/master'])
+
+        # only the remote file changed
+        del blobs['sha1']
+        blobs['sha2'] = '{"uidentities": {"a": {}}}'
+        task.execute()
+        self.assertEqual(len(loaded_files), 3)
+        self.assertEqual(loaded_files[2], blobs['sha2'])
+        self.assertEqual(task.identities_versions[GITHUB_IDENTITIES_FILE_URL], 'sha2')
+        self.assertEqual(task.sh_commands.unify.call_count, 2)
+
+
+class TestTaskIdentitiesExport(unittest.TestCase):
+    """Tests of the export of the identities to GitHub"""
+
+    @httpretty.activate
+    @unittest.mock.patch('sirmordred.task_identities.Export')
+    def test_export(self, mock_export):
+        """Test whether the identities are uploaded only when they change, even after a restart"""
+
+        tree = []
+        uploads = []
+        exports = []
+        identities = ['{\n    "time": "2019-01-01 00:00:00",\n    "uidentities": {}\n}\n']
+
+        def export(option, filename):
+            exports.append(filename)
+            with open(filename, 'w') as f:
+                f.write(identities[-1])
+            return CMD_SUCCESS
+
+        def tree_callback(request, uri, headers):
+            return 200, headers, json.dumps({'tree': tree})
+
+        def upload_callback(request, uri, headers):
+            uploads.append(request)
+            return 201, headers, json.dumps({})
+
+        def read_upload(request):
+            upload = json.loads(request.body.decode('ascii'))
+            gzipped_identities = base64.b64decode(upload['content'])
+            blob_sha = hashlib.sha1(b"blob %d\0" % len(gzipped_identities) + gzipped_identities).hexdigest()
+            return upload, gzip.decompress(gzipped_identities).decode('utf-8'), blob_sha
+
+        mock_export.return_value.run.side_effect = export
+        httpretty.register_uri(httpretty.GET, GITHUB_TREE_URL, body=tree_callback)
+        httpretty.register_uri(httpretty.PUT, GITHUB_CONTENTS_URL, body=upload_callback)
+
+        config = Config(CONF_FILE)
+        config.set_param('sortinghat', 'identities_export_url', GITHUB_EXPORT_FILE_URL)
+        task = TaskIdentitiesExport(config)
+
+        # the file is created with the gzipped identities, and the temp files removed
+        task.execute()
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(int(uploads[0].headers['Content-Length']), len(uploads[0].body))
+        upload, content, blob_sha = read_upload(uploads[0])
+        self.assertEqual(upload['message'], 'sirmordred automatic update')
+        self.assertNotIn('sha', upload)
+        self.assertEqual(content, identities[-1])
+        self.assertEqual(task.last_export[1], blob_sha)
+        self.assertFalse(os.path.exists(os.path.dirname(exports[-1])))
+
+        # only the export time changed, the identities are not uploaded
+        tree.append({'path': 'identities.json.gz', 'sha': blob_sha})
+        identities.append(identities[-1].replace('2019', '2020'))
+        task.execute()
+        self.assertEqual(len(exports), 2)
+        self.assertEqual(len(uploads), 1)
+
+        # the identities changed, the file is updated
+        identities.append(identities[-1].replace('{}', '{"a": {}}'))
+        task.execute()
+        self.assertEqual(len(uploads), 2)
+        upload, content, blob_sha = read_upload(uploads[1])
+        self.assertEqual(upload['sha'], tree[0]['sha'])
+        self.assertEqual(content, identities[-1])
+
+        # after a restart, the remote file has the same identities exported at other time, it is not uploaded
+        blobs = {'remote_sha': gzip.compress(identities[-1].replace('2020', '2018').encode('utf-8'))}
+        blob_requests = []
+
+        def blob_callback(request, uri, headers):
+            blob_requests.append(request)
+            content = base64.b64encode(blobs[uri.rsplit('/', 1)[1]]).decode('utf-8')
+            return 200, headers, json.dumps({'content': content})
+
+        httpretty.register_uri(httpretty.GET, re.compile(GITHUB_BLOBS_URL + '.*'), body=blob_callback)
+        tree[0]['sha'] = 'remote_sha'
+        task.last_export = None
+        task.execute()
+        self.assertEqual(len(uploads), 2)
+        self.assertEqual(len(blob_requests), 1)
+        self.assertEqual(task.last_export[1], 'remote_sha')
+
+        # the remote file is known, it is not downloaded again
+        task.execute()
+        self.assertEqual(len(uploads), 2)
+        self.assertEqual(len(blob_requests), 1)
+
+        # the remote file has other identities, the file is updated
+        blobs['other_sha'] = gzip.compress(identities[0].encode('utf-8'))
+        tree[0]['sha'] = 'other_sha'
+        task.execute()
+        self.assertEqual(len(blob_requests), 2)
+        self.assertEqual(len(uploads), 3)
+        upload, content, blob_sha = read_upload(uploads[2])
+        self.assertEqual(upload['sha'], 'other_sha')
+        self.assertEqual(content, identities[-1])
+        self.assertEqual(task.last_export[1], blob_sha)
+
+
 class TestTaskIdentitiesLoad(unittest.TestCase):
     """Task tests"""
 
@@ -20,8 +20,14 @@
 # Authors:
 #     Valerio Cosentino <valcos@bitergia.com>
 
+import json
+import multiprocessing
+import os
+import pickle
 import sys
+import tempfile
 import threading
+import time
 import unittest
 
 # Hack to make sure that tests import the right packages
@@ -30,7 +36,15 @@ sys.path.insert(0, '..')
 
 from sirmordred.sirmordred import SirMordred
 from sirmordred.config import Config
-from sirmordred.task_manager import TasksManager
+from sirmordred.task import Task
+from sirmordred.task_manager import (AdaptiveDelay,
+                                     PhaseGate,
+                                     ProcessCommQueue,
+                                     ProcessPhaseGate,
+                                     ProcessProjectsUpdates,
+                                     ProcessTasksManager,
+                                     TasksManager,
+                                     TasksSpec)
 from sirmordred.task_collection import TaskRawDataCollection
 from sirmordred.task_enrich import TaskEnrich
 from sirmordred.task_projects import TaskProjects
@@ -257,6 +271,276 @@ class TestTasksManager(unittest.TestCase):
             manager.run()
 
 
+class TestPhaseGate(unittest.TestCase):
+    """PhaseGate tests"""
+
+    def test_readers_share_the_gate(self):
+        """Test whether several readers can be in the gate at the same time"""
+
+        gate = PhaseGate()
+        gate.acquire_read('git')
+        gate.acquire_read('github')
+
+        stats = gate.get_wait_stats()
+        self.assertEqual(stats['git']['waits'], 1)
+        self.assertEqual(stats['github']['waits'], 1)
+
+        gate.release_read()
+        gate.release_read()
+
+    def test_writer_waits_for_readers(self):
+        """Test whether a writer enters the gate right after the last reader leaves"""
+
+        gate = PhaseGate()
+        events = []
+
+        def writer():
+            with gate.write('Global tasks'):
+                events.append('writer')
+
+        gate.acquire_read('git')
+        thread = threading.Thread(target=writer)
+        thread.start()
+        time.sleep(0.2)
+        events.append('reader')
+        gate.release_read()
+        thread.join(1)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(events, ['reader', 'writer'])
+        self.assertGreater(gate.get_wait_stats()['Global tasks']['total'], 0)
+
+    def test_writer_preference(self):
+        """Test whether new readers give way to a waiting writer"""
+
+        gate = PhaseGate()
+        events = []
+
+        def writer():
+            with gate.write('Global tasks'):
+                events.append('writer')
+
+        def reader():
+            with gate.read('github'):
+                events.append('reader')
+
+        gate.acquire_read('git')
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+        time.sleep(0.2)
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        time.sleep(0.2)
+        gate.release_read()
+        writer_thread.join(1)
+        reader_thread.join(1)
+
+        self.assertEqual(events, ['writer', 'reader'])
+
+    def test_reader_bounded_wait(self):
+        """Test whether a reader stops giving way to waiting writers after max_reader_wait"""
+
+        gate = PhaseGate(max_reader_wait=0.2)
+        events = []
+
+        def writer():
+            with gate.write('Global tasks'):
+                events.append('writer')
+
+        def reader():
+            with gate.read('github'):
+                events.append('reader')
+
+        gate.acquire_read('git')
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+        time.sleep(0.1)
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        reader_thread.join(1)
+
+        self.assertFalse(reader_thread.is_alive())
+        self.assertEqual(events, ['reader'])
+
+        gate.release_read()
+        writer_thread.join(1)
+        self.assertEqual(events, ['reader', 'writer'])
+
+
+def write_gate(gate, events):
+    with gate.write('Global tasks'):
+        events.put('writer')
+
+
+class RecordDeltaTask(Task):
+    """Task sending the repos to process in each round to the parent process"""
+
+    events = None
+
+    def execute(self):
+        self.events.put(self.repos_delta)
+
+
+class TestProcessTasksManager(unittest.TestCase):
+    """ProcessTasksManager tests"""
+
+    def test_tasks_spec(self):
+        """Test whether the tasks description can be pickled and loaded"""
+
+        spec = TasksSpec.from_tasks_cls([TaskRawDataCollection, TaskEnrich], 'git', 10)
+        self.assertEqual(spec.tasks_cls, ['sirmordred.task_collection:TaskRawDataCollection',
+                                          'sirmordred.task_enrich:TaskEnrich'])
+        self.assertEqual(spec.backend_section, 'git')
+        self.assertEqual(spec.timer, 10)
+
+        spec = pickle.loads(pickle.dumps(spec))
+        self.assertEqual(spec.get_tasks_cls(), [TaskRawDataCollection, TaskEnrich])
+
+    def test_process_gate(self):
+        """Test whether the gate works between processes"""
+
+        gate = ProcessPhaseGate()
+        events = multiprocessing.Queue()
+
+        gate.acquire_read('git')
+        process = multiprocessing.Process(target=write_gate, args=(gate, events))
+        process.start()
+        time.sleep(0.5)
+        events.put('reader')
+        gate.release_read()
+        process.join(5)
+
+        self.assertEqual(events.get(timeout=1), 'reader')
+        self.assertEqual(events.get(timeout=1), 'writer')
+        self.assertEqual(gate.get_wait_stats()['Global tasks']['waits'], 1)
+        gate.close()
+
+    def test_run_on_error(self):
+        """Test whether the exception of a task is sent to the parent process"""
+
+        config = Config(CONF_FILE)
+        spec = TasksSpec.from_tasks_cls([TaskRawDataCollection, TaskEnrich], "fake-section")
+        comm_queue = ProcessCommQueue()
+        gate = ProcessPhaseGate()
+        stopper = multiprocessing.Event()
+
+        manager = ProcessTasksManager(spec, stopper, config, comm_queue, gate, TaskProjects.get_projects())
+        manager.start()
+        manager.join()
+        gate.close()
+
+        self.assertEqual(manager.exitcode, 1)
+        exc_type, exc_obj, exc_trace = comm_queue.get(timeout=5)
+        self.assertTrue(isinstance(exc_obj, exc_type))
+        self.assertTrue(isinstance(exc_trace, str))
+
+    def test_projects_updates(self):
+        """Test whether the repos added to the projects are processed at once by the other processes"""
+
+        projects_file = tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False)
+        self.addCleanup(os.remove, projects_file.name)
+        json.dump({'grimoire': {'git': ['repo1']}}, projects_file)
+        projects_file.close()
+
+        config = Config(CONF_FILE)
+        config.set_param('projects', 'projects_file', projects_file.name)
+        config.set_param('general', 'update', True)
+        TaskProjects(config).execute()
+
+        spec = TasksSpec.from_tasks_cls([RecordDeltaTask], 'git', 3600)
+        comm_queue = ProcessCommQueue()
+        gate = ProcessPhaseGate()
+        projects_updates = ProcessProjectsUpdates()
+        stopper = multiprocessing.Event()
+        RecordDeltaTask.events = multiprocessing.Queue()
+
+        manager = ProcessTasksManager(spec, stopper, config, comm_queue, gate, TaskProjects.get_projects(),
+                                      projects_updates)
+        manager.start()
+        self.addCleanup(gate.close)
+        self.addCleanup(manager.join)
+        self.addCleanup(manager.terminate)
+
+        # full round
+        self.assertIsNone(RecordDeltaTask.events.get(timeout=10))
+
+        # the process reading the projects publishes the update, the delta is processed without waiting the round
+        with open(projects_file.name, 'w') as fprojects:
+            json.dump({'grimoire': {'git': ['repo1', 'repo2']}}, fprojects)
+        TaskProjects.projects_updates = projects_updates
+        self.addCleanup(setattr, TaskProjects, 'projects_updates', None)
+        TaskProjects(config).execute()
+
+        self.assertEqual(projects_updates.get_version(), 1)
+        self.assertEqual(RecordDeltaTask.events.get(timeout=10), ['repo2'])
+
+
+class TestAdaptiveDelay(unittest.TestCase):
+    """AdaptiveDelay tests"""
+
+    def test_update(self):
+        """Test whether the delay backs off without new items and follows the change rate with them"""
+
+        delay = AdaptiveDelay(60, 300)
+        self.assertEqual(delay.delay, 60)
+
+        # the first round finds all the items, it is not used
+        self.assertEqual(delay.update(50000, 10), 60)
+        self.assertListEqual(delay.history, [])
+
+        self.assertEqual(delay.update(0, 10), 120)
+        self.assertEqual(delay.update(0, 10), 240)
+        self.assertEqual(delay.update(0, 10), 300)
+        self.assertEqual(delay.update(0, 10), 300)
+        self.assertEqual(delay.update(None, 10), 300)
+        self.assertEqual(len(delay.history), 4)
+
+        # 1 item in 1070s of rounds and delays, expected again in 1070s
+        self.assertEqual(delay.update(1, 10), 300)
+
+        # 11 items in 1380s: one each 125s, minus the 10s of the rounds
+        self.assertEqual(delay.update(10, 10), 115)
+
+        # busy sections are updated as often as allowed
+        self.assertEqual(delay.update(100, 10), 60)
+
+    def test_update_durations(self):
+        """Test whether the duration of the rounds is discounted from the delay"""
+
+        short_rounds = AdaptiveDelay(10, 3600)
+        long_rounds = AdaptiveDelay(10, 3600)
+        for _ in range(3):
+            short_rounds.update(1, 10)
+            long_rounds.update(1, 100)
+
+        self.assertEqual(short_rounds.delay, 10)
+        self.assertEqual(long_rounds.delay, 10)
+        short_rounds.update(0, 10)
+        long_rounds.update(0, 100)
+        # 2 items in 60s vs 2 items in 330s, one each 30s or 165s, minus the rounds durations
+        self.assertEqual(short_rounds.delay, 20)
+        self.assertEqual(long_rounds.delay, 65)
+
+    def test_change_rate(self):
+        """Test whether the change rate is computed from the last rounds"""
+
+        delay = AdaptiveDelay(60, 300)
+        self.assertIsNone(delay.change_rate())
+
+        delay.update(None, 10)
+        delay.update(None, 10)
+        self.assertIsNone(delay.change_rate())
+
+        delay.update(10, 5)
+        delay.update(0, 15)
+        self.assertEqual(delay.change_rate(), 10 / 140)
+
+        for _ in range(AdaptiveDelay.HISTORY_SIZE):
+            delay.update(0, 1)
+        self.assertEqual(len(delay.history), AdaptiveDelay.HISTORY_SIZE)
+        self.assertEqual(delay.change_rate(), 0)
+
+
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
     unittest.main(warnings='ignore')
@@ -21,7 +21,11 @@
 #     Alvaro del Castillo <acs@bitergia.com>
 
 import json
+import os
+import pickle
 import sys
+import tempfile
+import threading
 import unittest
 
 import httpretty
@@ -33,7 +37,7 @@ from os import remove
 sys.path.insert(0, '..')
 
 from sirmordred.config import Config
-from sirmordred.task_projects import TaskProjects
+from sirmordred.task_projects import TaskProjects, thaw_data
 
 
 CONF_FILE = 'test.cfg'
@@ -81,6 +85,29 @@ def setup_http_server():
     return http_requests
 
 
+def setup_http_server_etag(projects):
+    """Serve the projects with the ETag in projects['etag'] and the body in projects['body']"""
+
+    http_requests = []
+
+    def request_callback(request, uri, headers):
+        http_requests.append(request)
+
+        headers['ETag'] = projects['etag']
+        if request.headers.get('If-None-Match') == projects['etag']:
+            return (304, headers, '')
+
+        return (200, headers, projects['body'])
+
+    httpretty.register_uri(httpretty.GET,
+                           PROJECTS_URL,
+                           responses=[
+                               httpretty.Response(body=request_callback)
+                           ])
+
+    return http_requests
+
+
 class TestTaskProjects(unittest.TestCase):
     """Task tests"""
 
@@ -302,6 +329,117 @@ class TestTaskProjects(unittest.TestCase):
         self.assertEqual(task.execute(), None)
         self.assertEqual(len(task.get_projects().keys()), 1)
 
+    def test_projects_snapshot(self):
+        """Test whether the projects are shared as a read only snapshot"""
+
+        config = Config(CONF_FILE)
+        task = TaskProjects(config)
+        self.assertEqual(task.execute(), None)
+        version = TaskProjects.get_projects_version()
+
+        projects = TaskProjects.get_projects()
+        self.assertIs(projects, TaskProjects.get_projects())
+        with self.assertRaises(TypeError):
+            projects['new_project'] = {}
+        with self.assertRaises(TypeError):
+            projects[list(projects.keys())[0]]['git'] = []
+
+        new_projects = thaw_data(projects)
+        new_projects['new_project'] = {'git': ['https://github.com/chaoss/grimoirelab-sirmordred']}
+        TaskProjects.set_projects(new_projects)
+
+        self.assertEqual(TaskProjects.get_projects_version(), version + 1)
+        self.assertFalse('new_project' in projects)
+        self.assertEqual(TaskProjects.get_projects()['new_project']['git'],
+                         ('https://github.com/chaoss/grimoirelab-sirmordred',))
+
+    def test_sections_index(self):
+        """Test whether the repos by backend section are indexed when setting the projects"""
+
+        projects = {
+            TaskProjects.GLOBAL_PROJECT: {
+                "gerrit": ["gerrit.example.com"]
+            },
+            "project_a": {
+                "git": ["https://github.com/chaoss/grimoirelab-perceval"],
+                "gerrit": ["gerrit.example.com_perceval"]
+            },
+            "project_b": {
+                "git": ["https://github.com/chaoss/grimoirelab-perceval",
+                        "https://github.com/chaoss/grimoirelab-elk"]
+            }
+        }
+        TaskProjects.set_projects(projects)
+
+        index = TaskProjects.get_sections_index()
+        self.assertEqual(sorted(index.keys()), ['gerrit', 'git'])
+        self.assertEqual(index['gerrit']['all'], ("gerrit.example.com", "gerrit.example.com_perceval"))
+
+        self.assertEqual(TaskProjects.get_repos_by_backend_section('gerrit'), ["gerrit.example.com"])
+        self.assertEqual(TaskProjects.get_repos_by_backend_section('gerrit', raw=False),
+                         ["gerrit.example.com_perceval"])
+        self.assertEqual(TaskProjects.get_repos_by_backend_section('git'),
+                         ["https://github.com/chaoss/grimoirelab-perceval",
+                          "https://github.com/chaoss/grimoirelab-perceval",
+                          "https://github.com/chaoss/grimoirelab-elk"])
+        self.assertEqual(TaskProjects.get_repos_by_backend_section('jira'), [])
+
+        self.assertEqual(TaskProjects.get_repo_projects('git', "https://github.com/chaoss/grimoirelab-perceval"),
+                         ["project_a", "project_b"])
+        self.assertEqual(TaskProjects.get_repo_projects('git', "https://github.com/chaoss/grimoirelab-elk"),
+                         ["project_b"])
+        self.assertEqual(TaskProjects.get_repo_projects('jira', "https://github.com/chaoss/grimoirelab-elk"), [])
+
+        # the lists are read only and shared by the callers, not copied
+        repos = TaskProjects.get_repos_by_backend_section('git')
+        self.assertIs(TaskProjects.get_repos_by_backend_section('git'), repos)
+        with self.assertRaises(TypeError):
+            repos.append("https://github.com/chaoss/grimoirelab-sirmordred")
+        with self.assertRaises(TypeError):
+            repos[0] = "https://github.com/chaoss/grimoirelab-sirmordred"
+        self.assertEqual(pickle.loads(pickle.dumps(repos)), repos)
+
+    def test_repos_diff(self):
+        """Test whether the repos added and removed in each update are tracked"""
+
+        perceval = "https://github.com/chaoss/grimoirelab-perceval"
+        elk = "https://github.com/chaoss/grimoirelab-elk"
+        mordred = "https://github.com/chaoss/grimoirelab-sirmordred"
+
+        TaskProjects.set_projects({"project_a": {"git": [perceval]}})
+        version = TaskProjects.get_projects_version()
+        self.assertEqual(TaskProjects.get_repos_diff('git', version), {'added': [], 'removed': []})
+
+        TaskProjects.set_projects({"project_a": {"git": [perceval, elk]}})
+        self.assertEqual(TaskProjects.get_projects_last_diff(), [])
+        self.assertEqual(TaskProjects.get_projects_last_repos_diff(),
+                         {"project_a": {"git": {'added': (elk,), 'removed': ()}}})
+        self.assertEqual(TaskProjects.get_repos_diff('git', version), {'added': [elk], 'removed': []})
+
+        TaskProjects.set_projects({"project_a": {"git": [elk]},
+                                   "project_b": {"git": [mordred]}})
+        self.assertEqual(TaskProjects.get_repos_diff('git', version),
+                         {'added': [elk, mordred], 'removed': [perceval]})
+        self.assertEqual(TaskProjects.get_repos_diff('git', version + 1),
+                         {'added': [mordred], 'removed': [perceval]})
+        self.assertEqual(TaskProjects.get_repos_diff('jira', version + 1), {'added': [], 'removed': []})
+
+        for _ in range(TaskProjects.REPOS_DIFFS_HISTORY):
+            TaskProjects.set_projects({"project_a": {"git": [elk]}})
+        self.assertIsNone(TaskProjects.get_repos_diff('git', version))
+
+    def test_wait_projects_update(self):
+        """Test whether the projects updates are notified"""
+
+        TaskProjects.set_projects({"project_a": {"git": []}})
+        version = TaskProjects.get_projects_version()
+        self.assertEqual(TaskProjects.wait_projects_update(version, 0.1), version)
+
+        timer = threading.Timer(0.1, TaskProjects.set_projects, args=({"project_b": {"git": []}},))
+        timer.start()
+        self.assertEqual(TaskProjects.wait_projects_update(version, 5), version + 1)
+        timer.join()
+
     @httpretty.activate
     def test_run_eclipse(self):
         """Test whether the Task could be run getting projects from Eclipse"""
@@ -364,6 +502,81 @@ class TestTaskProjects(unittest.TestCase):
         projects = task.get_projects()
         self.assertTrue(URL_PROJECTS_MAIN in projects)
 
+    @httpretty.activate
+    def test_projects_not_modified(self):
+        """Test whether unchanged projects are not downloaded and loaded again"""
+
+        url_projects = read_file(URL_PROJECTS_FILE)
+        served_projects = {'etag': '"v1"', 'body': url_projects}
+        http_requests = setup_http_server_etag(served_projects)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        projects_file = os.path.join(tmp_dir.name, 'test-projects-url.json')
+        config = Config(CONF_FILE)
+        config.set_param('projects', 'projects_url', PROJECTS_URL)
+        config.set_param('projects', 'projects_file', projects_file)
+        task = TaskProjects(config)
+
+        self.assertEqual(task.execute(), None)
+        version = TaskProjects.get_projects_version()
+        unchanged_cycles = TaskProjects.projects_unchanged_cycles
+        self.assertTrue(URL_PROJECTS_MAIN in task.get_projects())
+        self.assertIsNone(http_requests[-1].headers.get('If-None-Match'))
+
+        with open(projects_file + TaskProjects.FETCH_META_SUFFIX) as fmeta:
+            meta = json.load(fmeta)
+        self.assertEqual(meta[PROJECTS_URL]['etag'], '"v1"')
+
+        # The projects are not modified, so they are not loaded again
+        self.assertEqual(task.execute(), None)
+        self.assertEqual(http_requests[-1].headers.get('If-None-Match'), '"v1"')
+        self.assertEqual(TaskProjects.get_projects_version(), version)
+        self.assertEqual(TaskProjects.projects_unchanged_cycles, unchanged_cycles + 1)
+
+        # A new version of the projects is downloaded and loaded
+        new_projects = json.loads(url_projects)
+        new_projects['new_project'] = {}
+        served_projects['etag'] = '"v2"'
+        served_projects['body'] = json.dumps(new_projects)
+        self.assertEqual(task.execute(), None)
+        self.assertEqual(http_requests[-1].headers.get('If-None-Match'), '"v1"')
+        self.assertEqual(TaskProjects.projects_unchanged_cycles, unchanged_cycles + 1)
+        self.assertTrue('new_project' in task.get_projects())
+
+        # The projects file is modified locally, so it is downloaded again
+        with open(projects_file, 'w') as fprojects:
+            json.dump({}, fprojects)
+        self.assertEqual(task.execute(), None)
+        self.assertIsNone(http_requests[-1].headers.get('If-None-Match'))
+        self.assertTrue(URL_PROJECTS_MAIN in task.get_projects())
+
+    @httpretty.activate
+    def test_projects_not_modified_eclipse_and_url(self):
+        """Test whether the Eclipse projects are not loaded when they are replaced by the ones from the URL"""
+
+        served_projects = {'etag': '"v1"', 'body': read_file(URL_PROJECTS_FILE)}
+        http_requests = setup_http_server_etag(served_projects)
+        httpretty.register_uri(httpretty.GET, ECLIPSE_PROJECTS_URL, body='{"projects": {}}')
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = Config(CONF_FILE)
+        config.set_param('projects', 'load_eclipse', True)
+        config.set_param('projects', 'projects_url', PROJECTS_URL)
+        config.set_param('projects', 'projects_file', os.path.join(tmp_dir.name, 'test-projects-url.json'))
+        task = TaskProjects(config)
+
+        self.assertEqual(task.execute(), None)
+        unchanged_cycles = TaskProjects.projects_unchanged_cycles
+        self.assertTrue(URL_PROJECTS_MAIN in task.get_projects())
+
+        self.assertEqual(task.execute(), None)
+        self.assertEqual(http_requests[-1].headers.get('If-None-Match'), '"v1"')
+        self.assertEqual(TaskProjects.projects_unchanged_cycles, unchanged_cycles + 1)
+        self.assertEqual([request.path for request in httpretty.latest_requests()
+                          if request.path.startswith('/json/projects')], [])
+
 
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
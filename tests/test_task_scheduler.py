@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+
+import sys
+import threading
+import time
+import unittest
+
+# Hack to make sure that tests import the right packages
+# due to setuptools behaviour
+sys.path.insert(0, '..')
+
+from sirmordred.task_scheduler import TasksScheduler
+
+
+class TestTasksScheduler(unittest.TestCase):
+    """TasksScheduler tests"""
+
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def step(self, name, delay=0):
+        def execute():
+            time.sleep(delay)
+            with self.lock:
+                self.events.append(name)
+        return execute
+
+    def test_dependencies_order(self):
+        """Test whether nodes are executed after their dependencies"""
+
+        scheduler = TasksScheduler(max_workers=4)
+        scheduler.add_node('projects', self.step('projects'))
+        scheduler.add_node('collection:git', self.step('collection:git', 0.2), ['projects'])
+        scheduler.add_node('collection:gerrit', self.step('collection:gerrit'), ['projects'])
+        scheduler.add_node('enrich:git', self.step('enrich:git'), ['collection:git'])
+        scheduler.add_node('enrich:gerrit', self.step('enrich:gerrit'), ['collection:gerrit'])
+        scheduler.run()
+
+        self.assertEqual(self.events[0], 'projects')
+        self.assertLess(self.events.index('collection:git'), self.events.index('enrich:git'))
+        # enrichment of gerrit doesn't wait for the collection of git
+        self.assertLess(self.events.index('enrich:gerrit'), self.events.index('collection:git'))
+
+    def test_critical_path(self):
+        """Test whether the critical path follows the slowest chain"""
+
+        scheduler = TasksScheduler(max_workers=4)
+        scheduler.add_node('projects', self.step('projects'))
+        scheduler.add_node('collection:git', self.step('collection:git', 0.3), ['projects'])
+        scheduler.add_node('collection:gerrit', self.step('collection:gerrit'), ['projects'])
+        scheduler.add_node('report', self.step('report'), ['collection:git', 'collection:gerrit'])
+        path = scheduler.run()
+
+        self.assertEqual([node.name for node in path], ['projects', 'collection:git', 'report'])
+
+    def test_failed_dependency(self):
+        """Test whether the nodes depending on a failed one are skipped"""
+
+        def fail():
+            raise RuntimeError('collection failed')
+
+        scheduler = TasksScheduler(max_workers=2)
+        scheduler.add_node('collection:git', fail)
+        scheduler.add_node('enrich:git', self.step('enrich:git'), ['collection:git'])
+        scheduler.add_node('collection:gerrit', self.step('collection:gerrit'))
+
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+
+        self.assertEqual(self.events, ['collection:gerrit'])
+
+    def test_wrong_graph(self):
+        """Test whether unknown dependencies and cycles are detected"""
+
+        scheduler = TasksScheduler()
+        scheduler.add_node('enrich:git', self.step('enrich:git'), ['collection:git'])
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+
+        scheduler = TasksScheduler()
+        scheduler.add_node('a', self.step('a'), ['b'])
+        scheduler.add_node('b', self.step('b'), ['a'])
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+
+        with self.assertRaises(RuntimeError):
+            scheduler.add_node('a', self.step('a'))
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')